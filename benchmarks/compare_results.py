@@ -0,0 +1,97 @@
+#! /usr/bin/python
+"""
+Compare the benchmark results of 2 commits, recorded by `run_benchmarks.py`: for each benchmark, the median of the
+wall time, bytes read and peak RSS of the runs, and the ratio new/old.
+Runs with different Python versions are compared separately. Runs on different trees should not be compared: use
+the same make_tree options, on the same machine.
+
+Usage:
+    $ ./compare_results.py [--results=benchmarks/results.jsonl] [old_commit] [new_commit]
+Options:
+    --results   The JSONL file with the results. Default: results.jsonl in this dir.
+By default the last 2 commits in the results file are compared.
+"""
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import utils
+
+
+DEFAULT_RESULTS_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'results.jsonl')
+METRICS = (('wall_s', 'wall s'), ('rchar', 'bytes read'), ('max_rss_kib', 'peak RSS KiB'))
+
+
+def parse_args():
+    results_path = DEFAULT_RESULTS_PATH
+    for argv in sys.argv[1:]:
+        if argv.startswith('--results='):
+            results_path = os.path.abspath(os.path.expanduser(argv.split('=', 1)[1]))
+            sys.argv.remove(argv)
+            break
+    if not os.path.isfile(results_path):
+        utils.exit_with_error_msg('Please provide a valid results file')
+    return results_path, sys.argv[1:3]
+
+
+def load_results(results_path):
+    """
+    Return a list of the results (dicts) of the successful runs, in the order they were recorded.
+    """
+    results = []
+    with open(results_path) as fin:
+        for line in fin:
+            if line.strip():
+                result = json.loads(line)
+                if result['exit_code'] == 0:
+                    results.append(result)
+    return results
+
+
+def compare(results, old_commit=None, new_commit=None):
+    commits = []
+    for result in results:
+        if result['commit'] in commits:
+            commits.remove(result['commit'])
+        commits.append(result['commit'])
+    if not (old_commit and new_commit):
+        if len(commits) < 2:
+            utils.exit_with_error_msg('At least 2 commits are needed in the results file')
+        old_commit, new_commit = commits[-2:]
+    medians = {}  # (commit, benchmark) -> {metric: median}.
+    for commit in (old_commit, new_commit):
+        runs_by_benchmark = {}
+        for result in results:
+            if result['commit'] == commit:
+                benchmark = '{} py{}'.format(result['benchmark'], result['python'])
+                runs_by_benchmark.setdefault(benchmark, []).append(result)
+        if not runs_by_benchmark:
+            utils.exit_with_error_msg('No results for commit: {}'.format(commit))
+        for benchmark, runs in runs_by_benchmark.items():
+            medians[(commit, benchmark)] = dict((m, _median([r[m] for r in runs])) for m, _ in METRICS)
+
+    utils.print_msg('> Old: {}, new: {}\n'.format(old_commit, new_commit))
+    header = '{:<36}'.format('benchmark') + ''.join('{:>36}'.format(label + ' old/new (ratio)') for _, label in METRICS)
+    utils.print_msg(header)
+    for benchmark in sorted(set(b for _, b in medians)):
+        old = medians.get((old_commit, benchmark))
+        new = medians.get((new_commit, benchmark))
+        if not old or not new:
+            continue
+        cells = []
+        for metric, _ in METRICS:
+            ratio = float(new[metric]) / old[metric] if old[metric] else float('nan')
+            cells.append('{:>36}'.format('{:,} / {:,} ({:.2f})'.format(old[metric], new[metric], ratio)))
+        utils.print_msg('{:<36}'.format(benchmark) + ''.join(cells))
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+if __name__ == '__main__':
+    results_path, commits = parse_args()
+    compare(load_results(results_path), *commits)
+    sys.exit(0)
@@ -0,0 +1,249 @@
+#! /usr/bin/python
+"""
+Generate a synthetic NAS-like tree for benchmarks: nested dirs with files of random sizes, exact dupes (copies with
+the same name in another dir), hardlinks, files with the same size as others but different content, and photos
+with an EXIF header (capture time and camera model), like the ones from smartphones.
+The content is pseudo-random but reproducible: the same options and seed always generate the same tree.
+
+Usage:
+    $ ./make_tree.py [--files=1000] [--min-size-kib=4] [--max-size-kib=1024] [--dupe-ratio=0.1]
+                     [--hardlink-ratio=0.02] [--same-size-ratio=0.05] [--photo-ratio=0.3] [--depth=4]
+                     [--files-per-dir=50] [--seed=0] dest
+Options:
+    --files             The number of files (hardlinks included). Default: 1000.
+    --min-size-kib      The min size of a file in KiB. Default: 4.
+    --max-size-kib      The max size of a file in KiB. Sizes are log-uniform distributed. Default: 1024.
+    --dupe-ratio        The ratio of files that are a copy of another file. Default: 0.1.
+    --hardlink-ratio    The ratio of files that are a hardlink to another file. Default: 0.02.
+    --same-size-ratio   The ratio of files with the same size as another file, but a different content (at the end
+                        of the file). Default: 0.05.
+    --photo-ratio       The ratio of files that are JPEG photos with an EXIF header. Default: 0.3.
+    --depth             The nesting level of the dirs. Default: 4.
+    --files-per-dir     The number of files in each dir. Default: 50.
+    --seed              The seed of the pseudo-random generator. Default: 0.
+"""
+import math
+import os
+import random
+import struct
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import utils
+
+
+POOL_SIZE = 1024 * 1024  # Random bytes, sliced to build the content of the files.
+DIR_FANOUT = 8
+ID_SIZE = 16  # Every file has a unique id written in its content, so only dupes have the same content.
+
+# Option -> (argument name, type).
+TREE_OPTIONS = (
+    ('--files', 'n_files', int),
+    ('--min-size-kib', 'min_size_kib', int),
+    ('--max-size-kib', 'max_size_kib', int),
+    ('--dupe-ratio', 'dupe_ratio', float),
+    ('--hardlink-ratio', 'hardlink_ratio', float),
+    ('--same-size-ratio', 'same_size_ratio', float),
+    ('--photo-ratio', 'photo_ratio', float),
+    ('--depth', 'depth', int),
+    ('--files-per-dir', 'files_per_dir', int),
+    ('--seed', 'seed', int),
+)
+
+
+def parse_tree_options(argv):
+    """
+    Parse the `TREE_OPTIONS` in `argv` (removing them) and return them as kwargs for `make_tree`.
+    """
+    kwargs = {}
+    for option, name, type_ in TREE_OPTIONS:
+        for arg in argv:
+            if arg.startswith(option + '='):
+                try:
+                    kwargs[name] = type_(arg.split('=')[1])
+                except ValueError:
+                    utils.exit_with_error_msg('Invalid value for {}: {}'.format(option, arg.split('=')[1]))
+                argv.remove(arg)
+                break
+    return kwargs
+
+
+def make_tree(dest, n_files=1000, min_size_kib=4, max_size_kib=1024, dupe_ratio=0.1, hardlink_ratio=0.02,
+              same_size_ratio=0.05, photo_ratio=0.3, depth=4, files_per_dir=50, seed=0):
+    """
+    Generate the tree in `dest` and return a dict with some counters.
+    """
+    rnd = random.Random(seed)
+    pool = bytearray(rnd.getrandbits(8) for _ in range(POOL_SIZE))
+    counters = {'files': 0, 'dupes': 0, 'hardlinks': 0, 'same_size': 0, 'photos': 0, 'bytes': 0}
+    originals = []  # (path, size, header, offset in the pool) of the files that can be copied or linked.
+    for i in range(n_files):
+        dirpath = os.path.join(dest, _get_dir_relative_path(i // files_per_dir, depth))
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        kind = rnd.random()
+        if originals and kind < dupe_ratio:
+            src, size, _, _ = rnd.choice(originals)
+            path = _get_free_path(dirpath, os.path.basename(src))
+            _copy_file(src, path)
+            counters['dupes'] += 1
+        elif originals and kind < dupe_ratio + hardlink_ratio:
+            src, size, _, _ = rnd.choice(originals)
+            path = _get_free_path(dirpath, os.path.basename(src))
+            os.link(src, path)
+            counters['hardlinks'] += 1
+        else:
+            if originals and kind < dupe_ratio + hardlink_ratio + same_size_ratio:
+                # Same size and same start as another file: they differ only at the end.
+                _, size, header, offset = rnd.choice(originals)
+                counters['same_size'] += 1
+            else:
+                size = int(math.exp(rnd.uniform(math.log(min_size_kib * 1024), math.log(max_size_kib * 1024))))
+                header = _make_jpeg_header(rnd, i) if rnd.random() < photo_ratio else b''
+                offset = rnd.randrange(POOL_SIZE)
+            name = 'IMG_{:07}.jpg'.format(i) if header else 'file_{:07}.bin'.format(i)
+            path = os.path.join(dirpath, name)
+            _write_file(path, size, header, i, pool, offset)
+            originals.append((path, size, header, offset))
+            counters['photos'] += bool(header)
+        counters['files'] += 1
+        counters['bytes'] += size
+    return counters
+
+
+def make_similar_tree(src, dest, change_ratio=0.05, seed=0):
+    """
+    Generate in `dest` a tree like the one in `src`, as for a backup that is a bit out of date: the files are
+    hardlinks to the ones in `src` (it takes no space), but some are missing, some have a different size and some
+    are new. Return a dict with some counters.
+    """
+    rnd = random.Random(seed)
+    counters = {'files': 0, 'missing': 0, 'changed': 0, 'new': 0}
+    for path, st in utils.iter_files(src):
+        dest_path = os.path.join(dest, path)
+        if not os.path.isdir(os.path.dirname(dest_path)):
+            os.makedirs(os.path.dirname(dest_path))
+        kind = rnd.random()
+        if kind < change_ratio / 3:
+            counters['missing'] += 1
+            continue
+        if kind < change_ratio * 2 / 3:
+            with open(dest_path, 'wb') as fout:
+                fout.write(b'x' * (st.st_size // 2))
+            counters['changed'] += 1
+        else:
+            os.link(os.path.join(src, path), dest_path)
+        if kind > 1 - change_ratio / 3:
+            with open(dest_path + '.new', 'wb') as fout:
+                fout.write(b'y' * rnd.randrange(1, 10000))
+            counters['new'] += 1
+        counters['files'] += 1
+    return counters
+
+
+def make_lines_file(path, n_lines=100000, dupe_ratio=0.5, seed=0):
+    """
+    Generate a text file like a shell history: `n_lines` lines, `dupe_ratio` of them repeating a previous line.
+    """
+    rnd = random.Random(seed)
+    commands = ('ls -la', 'cd', 'git status', 'git diff', 'vim', 'python', 'grep -rn', 'ssh', 'tail -f', 'make')
+    lines = []
+    with open(path, 'w') as fout:
+        for i in range(n_lines):
+            if lines and rnd.random() < dupe_ratio:
+                line = rnd.choice(lines)
+            else:
+                line = '{} /home/me/project{}/file_{}.txt\n'.format(rnd.choice(commands), rnd.randrange(100), i)
+                lines.append(line)
+            fout.write(line)
+    return {'lines': n_lines, 'unique_lines': len(lines)}
+
+
+def _get_dir_relative_path(dir_index, depth):
+    names = []
+    for level in range(depth):
+        names.append('dir{}_{:02}'.format(level, (dir_index // DIR_FANOUT ** (depth - level - 1)) % DIR_FANOUT))
+    return os.path.join(*names) if names else ''
+
+
+def _get_free_path(dirpath, name):
+    path = os.path.join(dirpath, name)
+    while os.path.lexists(path):
+        name = 'copy_' + name
+        path = os.path.join(dirpath, name)
+    return path
+
+
+def _copy_file(src, dest):
+    with open(src, 'rb') as fin:
+        with open(dest, 'wb') as fout:
+            while True:
+                data = fin.read(1024 * 1024)
+                if not data:
+                    break
+                fout.write(data)
+
+
+def _write_file(path, size, header, file_id, pool, offset):
+    """
+    Write `header` followed by bytes from `pool` (from `offset`, wrapping around) up to `size`, and the unique
+    `file_id` at the end, so files of the same size differ only in their last bytes.
+    """
+    id_bytes = struct.pack('>Q', file_id) * (ID_SIZE // 8)
+    body_size = max(0, size - len(header) - ID_SIZE)
+    with open(path, 'wb') as fout:
+        fout.write(header[:size])
+        while body_size > 0:
+            chunk = pool[offset:offset + body_size]
+            fout.write(chunk)
+            body_size -= len(chunk)
+            offset = 0
+        fout.write(id_bytes[:max(0, size - len(header))])
+
+
+def _make_jpeg_header(rnd, file_id):
+    """
+    A JPEG start (SOI, APP1 with EXIF, SOF0) with a random capture time and camera model.
+    """
+    taken_at = '20{:02}:{:02}:{:02} {:02}:{:02}:{:02}'.format(
+        rnd.randrange(10, 25), rnd.randrange(1, 13), rnd.randrange(1, 29), rnd.randrange(24), rnd.randrange(60),
+        file_id % 60)
+    model = rnd.choice(('Pixel 3', 'iPhone X', 'iPhone 11', 'SM-G960F'))
+    tiff = _make_tiff(taken_at, model)
+    app1 = b'Exif\x00\x00' + tiff
+    sof = struct.pack('>HBHHB', 11, 8, 3024, 4032, 1) + b'\x01\x11\x00'
+    return (b'\xff\xd8' + b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 +
+            b'\xff\xc0' + sof + b'\xff\xda' + struct.pack('>H', 8) + b'\x01\x01\x00\x00\x3f\x00')
+
+
+def _make_tiff(taken_at, model):
+    # IFD0: Model and pointer to the EXIF IFD; EXIF IFD: DateTimeOriginal and dimensions. Big endian.
+    model_bytes = model.encode('ascii') + b'\x00'
+    taken_at_bytes = taken_at.encode('ascii') + b'\x00'
+    ifd0_offset = 8
+    exif_offset = ifd0_offset + 2 + 2 * 12 + 4
+    data_offset = exif_offset + 2 + 3 * 12 + 4
+    model_offset = data_offset
+    taken_at_offset = model_offset + len(model_bytes)
+    ifd0 = (struct.pack('>H', 2) + struct.pack('>HHII', 0x0110, 2, len(model_bytes), model_offset) +
+            struct.pack('>HHII', 0x8769, 4, 1, exif_offset) + b'\x00' * 4)
+    exif = (struct.pack('>H', 3) + struct.pack('>HHII', 0x9003, 2, len(taken_at_bytes), taken_at_offset) +
+            struct.pack('>HHIHH', 0xA002, 3, 1, 4032, 0) + struct.pack('>HHII', 0xA003, 4, 1, 3024) + b'\x00' * 4)
+    return b'MM\x00*' + struct.pack('>I', ifd0_offset) + ifd0 + exif + model_bytes + taken_at_bytes
+
+
+if __name__ == '__main__':
+    kwargs = parse_tree_options(sys.argv)
+    try:
+        dest = os.path.abspath(sys.argv[1])
+    except IndexError:
+        utils.exit_with_error_msg('Please provide a dest dir as argument')
+    if os.path.exists(dest) and os.listdir(dest):
+        utils.exit_with_error_msg('The dest dir is not empty: {}'.format(dest))
+
+    utils.print_msg('MAKE TREE')
+    utils.print_msg('=========')
+    counters = make_tree(dest, **kwargs)
+    utils.print_msg('> Generated: {}'.format(', '.join('{} {}'.format(v, k) for k, v in sorted(counters.items()))))
+    utils.print_msg('\nNo errors - DONE')
+    sys.exit(0)
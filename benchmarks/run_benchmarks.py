@@ -0,0 +1,289 @@
+#! /usr/bin/python
+"""
+Benchmark the dedupe and compare tools end-to-end on synthetic trees, and append the results to a JSONL file, so
+they can be compared across commits with `compare_results.py`.
+
+The trees are generated in the work dir with `make_tree.py` (and re-used by the next runs with the same options):
+ - tree: the main tree, with dupes, hardlinks, photos...
+ - tree2: a copy of the tree a bit out of date, for `cmp_dirs.py`;
+ - lines.txt: a text file with repeated lines, for `dedupe_lines.py`.
+Each tool runs in a new process. Measured for each run:
+ - wall time, and the stats of each phase (written by the tool with `--stats-json`): wall and CPU time, files,
+   bytes read, subprocesses...;
+ - bytes read: by the tool process through read syscalls (`rchar`, incl. pipes from the commands it spawns), and from
+   the disk by the tool and its subprocesses (`disk_read_bytes`, 0 when the files are in the page cache);
+ - peak RSS of the tool process and of its biggest subprocess.
+Linux only: bytes read come from /proc/self/io.
+
+Usage:
+    $ ./run_benchmarks.py [--workdir=/tmp/nasutils-benchmarks] [--results=benchmarks/results.jsonl] [--repeat=3]
+                          [--only=dedupe_files] [--python=/usr/bin/python3] [--drop-caches] [make_tree options]
+Options:
+    --workdir           The dir where the trees are generated. Default: /tmp/nasutils-benchmarks.
+    --results           The JSONL file where the results are appended. Default: results.jsonl in this dir.
+    --repeat            The number of runs of each benchmark. Default: 3.
+    --only              Run only the benchmarks whose name starts with this. It can be used multiple times.
+    --python            The Python interpreter running the tools. Default: the one running this script.
+    --drop-caches       Drop the page cache before each run (Linux, root only), to measure cold reads.
+    make_tree options   The options of `make_tree.py` (eg. --files=10000), to customize the main tree.
+"""
+import datetime
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import utils
+import make_tree
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_WORKDIR = os.path.join(tempfile.gettempdir(), 'nasutils-benchmarks')
+DEFAULT_RESULTS_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'results.jsonl')
+STATS_PATH_ENV_VAR = 'NASUTILS_BENCHMARK_STATS_PATH'
+
+# (name, script, args). In args: {tree}, {tree2}, {lines} and {workdir} are replaced with their paths.
+BENCHMARKS = (
+    ('dedupe_files', 'dedupe_files/dedupe_files.py', ['--no-cache', '{tree}']),
+    ('dedupe_files-jobs4', 'dedupe_files/dedupe_files.py', ['--no-cache', '--jobs=4', '{tree}']),
+    ('dedupe_files-byte-compare', 'dedupe_files/dedupe_files.py', ['--no-cache', '--byte-compare', '{tree}']),
+    ('dedupe_files-metadata', 'dedupe_files/dedupe_files.py', ['--no-cache', '--metadata-checksum-first', '{tree}']),
+    # The first run fills the cache, the next ones hit it.
+    ('dedupe_files-cache', 'dedupe_files/dedupe_files.py', ['--cache-path={workdir}/hashes.sqlite', '{tree}']),
+    ('dedupe_files_by_name', 'dedupe_files/dedupe_files_by_name.py', ['{tree}']),
+    ('cmp_dirs', 'dedupe_files/cmp_dirs.py', ['{tree}', '{tree2}']),
+    ('dedupe_lines', 'dedupe_lines/dedupe_lines.py', ['{lines}']),
+)
+
+
+workdir = DEFAULT_WORKDIR
+results_path = DEFAULT_RESULTS_PATH
+repeat = 3
+only = []
+python = sys.executable
+do_drop_caches = False
+tree_options = {}
+
+
+def parse_args():
+    global workdir, results_path, repeat, python, do_drop_caches, tree_options
+    for argv in sys.argv[1:]:
+        if argv.startswith('--workdir='):
+            workdir = os.path.abspath(os.path.expanduser(argv.split('=', 1)[1]))
+            sys.argv.remove(argv)
+            break
+    for argv in sys.argv[1:]:
+        if argv.startswith('--results='):
+            results_path = os.path.abspath(os.path.expanduser(argv.split('=', 1)[1]))
+            sys.argv.remove(argv)
+            break
+    for argv in sys.argv[1:]:
+        if argv.startswith('--repeat='):
+            try:
+                repeat = int(argv.split('=')[1])
+            except ValueError:
+                repeat = 0
+            if repeat < 1:
+                utils.exit_with_error_msg('Invalid value for --repeat: {}'.format(argv.split('=')[1]))
+            sys.argv.remove(argv)
+            break
+    for argv in sys.argv[1:]:
+        if argv.startswith('--python='):
+            python = argv.split('=', 1)[1]
+            sys.argv.remove(argv)
+            break
+    if '--drop-caches' in sys.argv:
+        sys.argv.remove('--drop-caches')
+        do_drop_caches = True
+
+    # Handle '--only' option. It can be used multiple times.
+    for argv in list(sys.argv[1:]):
+        if argv.startswith('--only='):
+            only.append(argv.split('=')[1])
+            sys.argv.remove(argv)
+
+    tree_options = make_tree.parse_tree_options(sys.argv)
+    if len(sys.argv) > 1:
+        utils.exit_with_error_msg('Unknown arguments: {}'.format(' '.join(sys.argv[1:])))
+
+
+def run_benchmarks():
+    paths = _make_trees()
+    revision = _get_git_revision()
+    utils.print_msg('\n> Git revision: {}{}'.format(revision['commit'], ' (dirty)' if revision['dirty'] else ''))
+    python_version = subprocess.check_output(
+        [python, '-c', 'import sys; print(".".join(str(n) for n in sys.version_info[:3]))']).decode().strip()
+    run_at = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    cache_path = os.path.join(workdir, 'hashes.sqlite')
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+    with open(results_path, 'a') as fout:
+        for name, script, args in BENCHMARKS:
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+            args = [arg.format(**paths) for arg in args]
+            for i in range(repeat):
+                if do_drop_caches:
+                    _drop_caches()
+                result = _run_tool(script, args)
+                result.update({
+                    'benchmark': name,
+                    'run': i + 1,
+                    'commit': revision['commit'],
+                    'dirty': revision['dirty'],
+                    'python': python_version,
+                    'run_at': run_at,
+                    'tree': tree_options,
+                    'cold_cache': do_drop_caches,
+                })
+                fout.write(json.dumps(result, sort_keys=True) + '\n')
+                fout.flush()
+                utils.print_msg('> {} #{}: {:.2f} s, {:,} bytes read ({:,} from disk), peak RSS {:,} KiB{}'.format(
+                    name, i + 1, result['wall_s'], result['rchar'], result['disk_read_bytes'],
+                    result['max_rss_kib'], '' if result['exit_code'] == 0 else ', FAILED: see ' + result['log']))
+    utils.print_msg('\n> Results appended to: {}'.format(results_path))
+
+
+def _make_trees():
+    """
+    Generate the trees, unless they already exist with the same options. Return a dict with their paths.
+    """
+    paths = {
+        'workdir': workdir,
+        'tree': os.path.join(workdir, 'tree'),
+        'tree2': os.path.join(workdir, 'tree2'),
+        'lines': os.path.join(workdir, 'lines.txt'),
+    }
+    options_path = os.path.join(workdir, 'tree_options.json')
+    try:
+        with open(options_path) as fin:
+            if json.load(fin) == tree_options:
+                utils.print_msg('> Re-using the trees in: {}'.format(workdir))
+                return paths
+    except (IOError, OSError, ValueError):
+        pass
+    if os.path.exists(workdir):
+        utils.print_msg('> Removing the old trees in: {}'.format(workdir))
+        subprocess.check_call(['rm', '-rf', workdir])
+    os.makedirs(workdir)
+    utils.print_msg('> Generating the trees in: {}'.format(workdir))
+    counters = make_tree.make_tree(paths['tree'], **tree_options)
+    utils.print_msg('> tree: {}'.format(', '.join('{} {}'.format(v, k) for k, v in sorted(counters.items()))))
+    counters = make_tree.make_similar_tree(paths['tree'], paths['tree2'], seed=tree_options.get('seed', 0))
+    utils.print_msg('> tree2: {}'.format(', '.join('{} {}'.format(v, k) for k, v in sorted(counters.items()))))
+    counters = make_tree.make_lines_file(paths['lines'], seed=tree_options.get('seed', 0))
+    utils.print_msg('> lines: {}'.format(', '.join('{} {}'.format(v, k) for k, v in sorted(counters.items()))))
+    with open(options_path, 'w') as fout:
+        json.dump(tree_options, fout)
+    return paths
+
+
+def _get_git_revision():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR).decode().strip()
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR)
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+    return {'commit': commit, 'dirty': bool(status.strip())}
+
+
+def _drop_caches():
+    subprocess.check_call(['sync'])
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as fout:
+            fout.write('3\n')
+    except (IOError, OSError) as ex:
+        utils.exit_with_error_msg('Cannot drop the page cache (root is needed): {}'.format(ex))
+
+
+def _run_tool(script, args):
+    """
+    Run the tool in a new process, through `_run_tool_and_write_stats`, and return its measurements.
+    The output of the tool is saved in a log file in the work dir.
+    """
+    fd, stats_path = tempfile.mkstemp(prefix='stats-', suffix='.json', dir=workdir)
+    os.close(fd)
+    fd, phase_stats_path = tempfile.mkstemp(prefix='phase-stats-', suffix='.json', dir=workdir)
+    os.close(fd)
+    log_path = os.path.join(workdir, '{}.log'.format(os.path.basename(script)))
+    env = dict(os.environ, **{STATS_PATH_ENV_VAR: stats_path})
+    cmd = [python, os.path.realpath(__file__), '--run-tool', os.path.join(REPO_DIR, script),
+           '--stats-json={}'.format(phase_stats_path)] + args
+    start = time.time()
+    with open(log_path, 'wb') as log:
+        exit_code = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT, env=env, cwd=workdir)
+    end = time.time()
+    stats = {'rchar': 0, 'disk_read_bytes': 0, 'max_rss_kib': 0, 'max_rss_subprocesses_kib': 0, 'phases': {}}
+    try:
+        with open(stats_path) as fin:
+            stats.update(json.load(fin))
+        with open(phase_stats_path) as fin:
+            stats['phases'] = json.load(fin)['phases']
+    except ValueError:  # The tool was killed.
+        pass
+    os.remove(stats_path)
+    os.remove(phase_stats_path)
+    stats.update({'wall_s': round(end - start, 3), 'exit_code': exit_code, 'log': log_path})
+    return stats
+
+
+def _run_tool_and_write_stats(script, args):
+    """
+    Run in the benchmark process: run the tool as a script, and then write its measurements as JSON to the path in
+    the env var `STATS_PATH_ENV_VAR`.
+    """
+    import runpy
+    import traceback
+    sys.argv = [script] + args
+    exit_code = 0
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as ex:
+        exit_code = ex.code
+    except Exception:
+        traceback.print_exc()
+        exit_code = 1
+    sys.stdout.flush()
+    io_counters = {}
+    try:
+        with open('/proc/self/io') as fin:
+            for line in fin:
+                key, value = line.split(':')
+                io_counters[key] = int(value)
+    except (IOError, OSError):
+        pass
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    stats = {
+        'rchar': io_counters.get('rchar', 0),
+        # Blocks of 512 bytes, incl. the subprocesses.
+        'disk_read_bytes': (usage.ru_inblock + children_usage.ru_inblock) * 512,
+        'max_rss_kib': _to_kib(usage.ru_maxrss),
+        'max_rss_subprocesses_kib': _to_kib(children_usage.ru_maxrss),
+    }
+    with open(os.environ[STATS_PATH_ENV_VAR], 'w') as fout:
+        json.dump(stats, fout)
+    return exit_code
+
+
+def _to_kib(max_rss):
+    # In bytes on macOS, in KiB on Linux.
+    return max_rss // 1024 if sys.platform == 'darwin' else max_rss
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run-tool']:
+        sys.exit(_run_tool_and_write_stats(sys.argv[2], sys.argv[3:]))
+
+    utils.print_msg('RUN BENCHMARKS')
+    utils.print_msg('==============')
+
+    parse_args()
+    run_benchmarks()
+
+    utils.print_msg('\nNo errors - DONE')
+    sys.exit(0)
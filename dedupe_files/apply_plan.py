@@ -0,0 +1,152 @@
+#! /usr/bin/python
+"""
+Apply a dedupe plan in-process: the NDJSON output of `dedupe_files.py --output-format=ndjson` (or of
+`dedupe_files_by_name.py`), where in each group the first file is the one to keep and the others are dupes.
+The dupes are deleted, moved to a quarantine dir, or replaced with links to the kept file, with no Bash script and no
+process per file: in batches grouped by dir, each file stat'ed again right before being acted on and skipped if it
+changed since the scan. Every action done is written to an undo log, that can be undone with `--undo`.
+
+Usage:
+    $ ./apply_plan.py [--action=delete] [--quarantine-dir=/volume1/quarantine] [--dry-run] [--undo-log=undo.ndjson]
+                      [--stats] [--stats-json=stats.json] [--profile=apply_plan.pstats] plan.ndjson
+    $ ./apply_plan.py --undo=undo.ndjson [--dry-run]
+Options:
+    --action                What to do with the dupes: delete (default), quarantine (move them to the quarantine
+                            dir, with their full path), hardlink or reflink (replace them with links to the kept
+                            file, see `dedupe_files.py --link-dupes`).
+    --quarantine-dir        The dir where the dupes are moved with --action=quarantine. It must be in the same
+                            filesystem as the dupes.
+    --dry-run               Only check the files and report the bytes that would be reclaimed. With --undo: only
+                            report the files that would be restored.
+    --undo-log              The file where the actions done are appended, to undo them.
+                            Default: undo_<plan name>_<date>.ndjson in this dir.
+    --undo                  Undo the actions in this undo log, from the last one: quarantined files are moved back,
+                            deleted files are restored as copies of the kept file, hardlinks replaced with copies.
+    --stats                 Print a table with the cost of each phase at exit: wall and CPU time, files listed
+                            and stat'ed, bytes read, subprocesses spawned, cache hits, MB/s and files/s.
+    --stats-json            Write the stats of each phase to this JSON file.
+    --profile               Run under cProfile and write the stats to this .pstats file.
+                            Default: apply_plan.pstats
+Use `-` as plan to read it from stdin, eg. to apply the dupes while the scan is still running:
+    $ ./dedupe_files.py --output-format=ndjson root | ./apply_plan.py --action=quarantine --quarantine-dir=q -
+"""
+import datetime
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import utils
+
+
+plan_path = None
+action = 'delete'
+quarantine_dir = None
+do_dry_run = False
+undo_log_path = None
+undo_path = None
+
+
+def parse_args():
+    # Handle '--stats', '--stats-json' and '--profile' options.
+    utils.parse_stats_options(sys.argv)
+
+    # Handle '--action' option.
+    for argv in sys.argv:
+        if argv.startswith('--action'):
+            global action
+            action = argv.split('=')[1]
+            sys.argv.remove(argv)
+            break
+    if action not in utils.APPLY_ACTIONS:
+        utils.exit_with_error_msg('Invalid value for --action: {}, valid values: {}'.format(
+            action, ', '.join(utils.APPLY_ACTIONS)))
+
+    # Handle '--quarantine-dir' option.
+    for argv in sys.argv:
+        if argv.startswith('--quarantine-dir'):
+            global quarantine_dir
+            quarantine_dir = os.path.abspath(os.path.expanduser(argv.split('=', 1)[1]))
+            sys.argv.remove(argv)
+            break
+    if (action == 'quarantine') != (quarantine_dir is not None):
+        utils.exit_with_error_msg('Option --quarantine-dir is required with --action=quarantine, and only with it')
+
+    # Handle '--dry-run' option.
+    if '--dry-run' in sys.argv:
+        sys.argv.remove('--dry-run')
+        global do_dry_run
+        do_dry_run = True
+
+    # Handle '--undo-log' and '--undo' options.
+    for argv in sys.argv:
+        if argv.startswith('--undo-log'):
+            global undo_log_path
+            undo_log_path = os.path.abspath(os.path.expanduser(argv.split('=', 1)[1]))
+            sys.argv.remove(argv)
+            break
+    for argv in sys.argv:
+        if argv.startswith('--undo='):
+            global undo_path
+            undo_path = os.path.abspath(os.path.expanduser(argv.split('=', 1)[1]))
+            sys.argv.remove(argv)
+            break
+    if undo_path:
+        if not os.path.isfile(undo_path):
+            utils.exit_with_error_msg('Please provide a valid undo log')
+        return
+
+    global plan_path
+    try:
+        plan_path = sys.argv[1]
+    except IndexError:
+        utils.exit_with_error_msg('Please provide a plan as argument')
+    if plan_path != '-':
+        plan_path = os.path.abspath(plan_path)
+        if not os.path.isfile(plan_path):
+            utils.exit_with_error_msg('Please provide a valid plan')
+    if undo_log_path is None:
+        now = datetime.datetime.now()
+        name = 'stdin' if plan_path == '-' else os.path.splitext(os.path.basename(plan_path))[0]
+        undo_log_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'undo_{}_{}.ndjson'.format(
+            name, now.strftime("%Y-%m-%d-%Hh%Mm")))
+
+
+def apply_plan():
+    executor = utils.PlanExecutor(action, quarantine_dir, do_dry_run, undo_log_path).open()
+    if do_dry_run:
+        utils.print_msg('\n> Dry run: checking the files, nothing is changed...')
+    else:
+        utils.print_msg('\n> Applying "{}" to the dupes, writing the undo log: {}'.format(action, undo_log_path))
+    n_groups = 0
+    with utils.phase_stats.phase('apply'):
+        for size, _, keep_files, remove_files in utils.iter_plan(plan_path):
+            n_groups += 1
+            utils.phase_stats.count('files', len(remove_files))
+            utils.phase_stats.count('files_stated', len(remove_files) + 1)
+            executor.add_group(size, keep_files, remove_files)
+        executor.close()
+    utils.print_msg('\n> Groups in the plan: {}'.format(n_groups))
+    utils.print_msg('> {} "{}" to {} files, skipped {} changed since the scan, failed {}'.format(
+        'Would apply' if do_dry_run else 'Applied', action, executor.n_done, executor.n_skipped, executor.n_failed))
+    utils.print_msg('> Bytes {}reclaimed: {:,}'.format('that would be ' if do_dry_run else '',
+                                                       executor.bytes_reclaimed))
+    if action == 'quarantine' and not do_dry_run:
+        utils.print_msg('> The space is reclaimed when the quarantine dir is emptied: {}'.format(quarantine_dir))
+
+
+def undo():
+    with utils.phase_stats.phase('undo'):
+        n_restored, n_skipped = utils.undo_actions(undo_path, do_dry_run)
+    utils.print_msg('\n> {} {} files, skipped {}'.format(
+        'Would restore' if do_dry_run else 'Restored', n_restored, n_skipped))
+
+
+if __name__ == '__main__':
+    parse_args()
+    utils.print_msg('APPLY PLAN')
+    utils.print_msg('==========')
+
+    utils.run_with_stats(undo if undo_path else apply_plan)
+
+    utils.print_msg('\nNo errors - DONE')
+    sys.exit(0)
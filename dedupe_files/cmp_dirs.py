@@ -1,68 +1,559 @@
 #! /usr/bin/python
 """
 Compare 2 dirs that look similar. The comparison is recursive and based on file names and file size.
-The comparison does not consider owner, group, permissions, times, checksum of the content.
+The comparison does not consider owner, group, permissions, times, nor the content (unless with `--content`).
 
 The 2 dirs can contain many files and subdirs.
 The diff files are printed in output.
-It is a wrapper around the command:
-$ find dir1 dir2 -printf "%P\t%s\n" | sort | uniq -u
+Both trees are walked at the same time, dir by dir, each by its own thread: the sorted listings of each dir are
+merge-joined, and only the subdirs on both sides are walked into. A subdir on one side only is reported as a single
+entry, without walking it. Nothing is sorted but the listing of each dir.
+With `--content` the files with the same size on both sides are compared byte by byte, to find files corrupted or
+truncated but with the same size (eg. on a backup disk). The 2 files of a pair are read in lockstep, each by the
+thread pool of its dir, and the reading stops at the first chunk that differs.
+
+Any of the 2 dirs can be a manifest instead: a snapshot of a tree written with `--write-manifest` (see
+`utils/manifest.py`), eg. of a backup disk that is not always plugged in. It is read as a stream, in the same order
+in which the trees are compared. With `--content` the checksums in the manifests are compared, and the files in a dir
+compared with a manifest are hashed.
+With `--moves` the files on one side only are matched with the files on the other side only, by size (and checksum,
+for the sizes shared by many of them), and reported as moved instead of missing on both sides: a renamed dir is
+reported with one line, not 2 for each of its files.
 
 Usage:
-    $ ./cmp_dirs.py dir1 dir
+    $ ./cmp_dirs.py [--content] [--moves] [--jobs=1] [--stats] [--stats-json=stats.json] [--profile=cmp_dirs.pstats]
+                    dir1|manifest1 dir2|manifest2
+    $ ./cmp_dirs.py --write-manifest=manifest.gz [--hash-algorithm=md5] [--jobs=1] dir
+Options:
+    --content           Compare also the content of the files with the same size. With manifests: their checksums.
+    --moves             Report the files and dirs moved or renamed, instead of missing in dir1 and in dir2.
+                        The files are matched by size, and by checksum when the size is not enough (always with
+                        --content). A dir is reported as moved when all of its files moved to the same new dir.
+    --jobs              With --content: the number of pairs of files compared at once, and of threads reading each
+                        dir. With --write-manifest or --moves: the number of files hashed in parallel. Default: 1.
+    --write-manifest    Write the manifest of the dir to this file (gzip-compressed NDJSON), instead of comparing.
+    --hash-algorithm    With --write-manifest: add the checksums of the files, with this algorithm: md5, sha1, sha256,
+                        blake2b. Default: no checksums.
+    --stats             Print a table with the cost of each phase at exit: wall and CPU time, subprocesses spawned...
+    --stats-json        Write the stats of each phase to this JSON file.
+    --profile           Run under cProfile and write the stats to this .pstats file. Default: cmp_dirs.pstats
 """
 import os
-import subprocess
+import stat
 import sys
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 import utils
 
 
-FIND_CMD = utils.config.get('main', 'find-cmd')
-WC_CMD = utils.config.get('main', 'wc-cmd')
-SORT_CMD = utils.config.get('main', 'sort-cmd')
-UNIQ_CMD = utils.config.get('main', 'uniq-cmd')
+BATCH_NUM_PAIRS = 1000  # Diffs reported at once, with --content.
+
+DIFF_CONTENT = 'content differs'
+DIFF_UNREADABLE = 'cannot be read'
+
+do_compare_content = False
+do_detect_moves = False
+jobs = 1
+manifest_path = None
+hash_algorithm = None
 
 
 def parse_args():
+    # Handle '--stats', '--stats-json' and '--profile' options.
+    utils.parse_stats_options(sys.argv)
+
+    # Handle '--content' option.
+    if '--content' in sys.argv:
+        sys.argv.remove('--content')
+        global do_compare_content
+        do_compare_content = True
+
+    # Handle '--moves' option.
+    if '--moves' in sys.argv:
+        sys.argv.remove('--moves')
+        global do_detect_moves
+        do_detect_moves = True
+
+    # Handle '--jobs' option.
+    for argv in sys.argv:
+        if argv.startswith('--jobs='):
+            global jobs
+            try:
+                jobs = int(argv.split('=')[1])
+            except ValueError:
+                jobs = 0
+            if jobs < 1:
+                utils.exit_with_error_msg('Invalid value for --jobs: {}'.format(argv.split('=')[1]))
+            sys.argv.remove(argv)
+            break
+
+    # Handle '--write-manifest' and '--hash-algorithm' options.
+    for argv in sys.argv:
+        if argv.startswith('--write-manifest'):
+            global manifest_path
+            manifest_path = os.path.abspath(os.path.expanduser(argv.split('=', 1)[1]))
+            sys.argv.remove(argv)
+            break
+    for argv in sys.argv:
+        if argv.startswith('--hash-algorithm'):
+            global hash_algorithm
+            hash_algorithm = argv.split('=')[1]
+            sys.argv.remove(argv)
+            break
+    if hash_algorithm is not None:
+        if not manifest_path:
+            utils.exit_with_error_msg('Option --hash-algorithm requires --write-manifest')
+        if hash_algorithm not in utils.HASH_ALGORITHMS:
+            utils.exit_with_error_msg('Invalid hash algorithm: {}, valid values: {}'.format(
+                hash_algorithm, ', '.join(utils.HASH_ALGORITHMS)))
+        if not utils.is_hash_algorithm_available(hash_algorithm):
+            utils.exit_with_error_msg('Hash algorithm not available in this Python: {}'.format(hash_algorithm))
+
+    if manifest_path:
+        if do_compare_content or do_detect_moves:
+            utils.exit_with_error_msg('Options --write-manifest and --content or --moves cannot be used together')
+        try:
+            root = os.path.abspath(sys.argv[1])
+        except IndexError:
+            utils.exit_with_error_msg('Please provide a dir as argument')
+        if not os.path.isdir(root):
+            utils.exit_with_error_msg('Please provide a valid dir')
+        return root, None
+
     try:
         dir1 = os.path.abspath(sys.argv[1])
         dir2 = os.path.abspath(sys.argv[2])
     except IndexError:
-        utils.exit_with_error_msg('Please provide two dirs as arguments')
+        utils.exit_with_error_msg('Please provide two dirs (or manifests) as arguments')
 
     # Ensure the dirs are valid.
-    if not os.path.isdir(dir1) or not os.path.isdir(dir2):
-        utils.exit_with_error_msg('Please provide valid dirs')
+    for path in (dir1, dir2):
+        if not os.path.isdir(path) and not os.path.isfile(path):
+            utils.exit_with_error_msg('Please provide valid dirs or manifests')
 
     return dir1, dir2
 
 
+def write_manifest(root):
+    writer = utils.ManifestWriter(manifest_path, hash_algorithm, jobs)
+    utils.print_msg('> Writing the manifest of {}{}: {}'.format(
+        root, ', with the {} checksums of the files'.format(hash_algorithm) if hash_algorithm else '', manifest_path))
+    with utils.phase_stats.phase('write manifest'):
+        writer.write_tree(root)
+        utils.phase_stats.count('files_stated', writer.n_entries)
+        utils.phase_stats.count('files', writer.n_hashed)
+        utils.phase_stats.count('bytes_read', writer.bytes_hashed)
+    utils.print_msg('> Wrote {} dirs and {} entries, {:,} bytes compressed'.format(
+        writer.n_dirs, writer.n_entries, os.path.getsize(manifest_path)))
+
+
 def find_diff(dir1, dir2):
-    # Eg.: $ gfind dir1 dir2 -printf "%P\t%s\n" | sort | uniq -u
-    cmd = '{} "{}" "{}" -printf "%P\\t%s\\n" | {} | {} -u'.format(
-        FIND_CMD, dir1, dir2, SORT_CMD, UNIQ_CMD)
-    output = subprocess.check_output(cmd, shell=True).rstrip()
-    if not output:
+    tree1 = _open_tree(dir1, 'dir1')
+    tree2 = _open_tree(dir2, 'dir2')
+    if do_compare_content and tree1.hash_algorithm and tree2.hash_algorithm and \
+            tree1.hash_algorithm != tree2.hash_algorithm:
+        utils.exit_with_error_msg('Option --content requires manifests with checksums of the same algorithm')
+    content_comparer = ContentComparer(tree1, tree2).open() if do_compare_content else None
+    move_detector = MoveDetector(tree1, tree2) if do_detect_moves else None
+    n_diffs = 0
+    try:
+        with utils.phase_stats.phase('walk and compare'):
+            # With --content the diffs are reported in batches, in the order of the walk, after the content of the
+            # files with the same size in the batch is compared.
+            batch = []
+            for diff in utils.iter_tree_diff(tree1, tree2, with_same_size=do_compare_content):
+                if move_detector and diff[0] in (utils.DIFF_MISSING_IN_1, utils.DIFF_MISSING_IN_2):
+                    move_detector.add(*diff)  # Reported at the end, with the moves.
+                    continue
+                batch.append(diff)
+                if len(batch) >= BATCH_NUM_PAIRS:
+                    n_diffs += _report_batch(batch, content_comparer)
+                    batch = []
+            n_diffs += _report_batch(batch, content_comparer)
+            utils.phase_stats.count('files_stated', tree1.n_entries + tree2.n_entries)
+        if move_detector:
+            utils.print_msg('> Matching the files on one side only, to find the moved ones...\n')
+            n_diffs += move_detector.report()
+    finally:
+        tree1.close()
+        tree2.close()
+        if content_comparer:
+            content_comparer.close()
+    utils.print_msg('> Listed {} dirs and {} entries in dir1, {} dirs and {} entries in dir2'.format(
+        tree1.n_dirs, tree1.n_entries, tree2.n_dirs, tree2.n_entries))
+    if content_comparer:
+        utils.print_msg('> Compared the content of {} files with the same size'.format(content_comparer.n_compared))
+    if move_detector:
+        utils.print_msg('> Hashed {} files ({:,} bytes) to match the moved ones'.format(
+            move_detector.n_hashed, move_detector.bytes_hashed))
+    if not n_diffs:
         utils.print_msg('No diff\n')
-    for line in output.splitlines():
-        if line:
-            relative_path, size = line.split('\t')
-            _print_diff(relative_path, size, dir1, dir2)
 
 
-def _print_diff(relative_path, size, dir1, dir2):
-    if relative_path == '':
-        utils.print_msg('The 2 given dirs have diff size: {} bytes'.format(size))
-        return
+def _open_tree(path, label):
+    """
+    Return a lister of the dirs in the tree at `path`: a dir, or a manifest written with --write-manifest.
+    """
+    if os.path.isdir(path):
+        return utils.DirLister(path).open()
+    try:
+        tree = utils.ManifestLister(path).open()
+    except (IOError, ValueError) as ex:
+        utils.exit_with_error_msg(str(ex))
+    checksums_msg = ', with {} checksums'.format(tree.hash_algorithm) if tree.hash_algorithm else ''
+    utils.print_msg('> {}: manifest of {}, written on {}{}'.format(label, tree.root, tree.created, checksums_msg))
+    if do_compare_content and not tree.hash_algorithm:
+        utils.exit_with_error_msg('Option --content requires manifests with checksums (--hash-algorithm): {}'.format(
+            path))
+    return tree
+
+
+def _report_batch(batch, content_comparer):
+    """
+    Print the diffs in `batch` and return their number.
+    """
+    same_size_files = [(relative_path, entry1, entry2) for status, relative_path, entry1, entry2 in batch
+                       if status == utils.SAME_SIZE]
+    if same_size_files:
+        with utils.phase_stats.phase('compare content'):
+            content_statuses = iter(content_comparer.compare(same_size_files))
+    n_diffs = 0
+    for status, relative_path, entry1, entry2 in batch:
+        if status == utils.SAME_SIZE:
+            status = next(content_statuses)
+            if status is None:
+                continue
+        n_diffs += 1
+        _print_diff(status, relative_path, entry1, entry2)
+    return n_diffs
+
+
+class ContentComparer(object):
+    """
+    Compare the content of the files with the same relative path and size in the 2 trees. Each dir is read by its own
+    pool of `--jobs` threads, so 2 disks are read at full speed at the same time; `--jobs` pairs are compared at once,
+    each in lockstep, stopping at the first chunk that differs. Small files are read directly: for them, handing
+    each read to the pools costs more than reading.
+    With a manifest, the checksums in the manifest are compared instead: a file in a dir is hashed with the algorithm
+    of the manifest.
+    """
+    def __init__(self, tree1, tree2):
+        self.tree1 = tree1
+        self.tree2 = tree2
+        self.hash_algorithm = tree1.hash_algorithm or tree2.hash_algorithm
+        self.n_compared = 0
+        self._pool = None
+        self._pool1 = None
+        self._pool2 = None
+
+    def open(self):
+        self._pool = ThreadPool(jobs)
+        self._pool1 = ThreadPool(jobs)
+        self._pool2 = ThreadPool(jobs)
+        return self
+
+    def compare(self, files):
+        """
+        Return a status for each file in `files`, a list of (relative path, entry 1, entry 2): None if the content is
+        the same (or unknown, for a file without a checksum in a manifest), DIFF_CONTENT otherwise, or
+        DIFF_UNREADABLE.
+        """
+        results = self._pool.map(self._compare, files)
+        statuses = []
+        for status, bytes_read in results:
+            utils.phase_stats.count('files', 2)
+            utils.phase_stats.count('bytes_read', bytes_read)
+            statuses.append(status)
+        self.n_compared += len(files)
+        return statuses
+
+    def close(self):
+        for pool in (self._pool, self._pool1, self._pool2):
+            pool.close()
+            pool.join()
+
+    def _compare(self, file_and_entries):
+        relative_path, entry1, entry2 = file_and_entries
+        if self.hash_algorithm:
+            return self._compare_checksums(relative_path, entry1, entry2)
+        path1 = os.path.join(self.tree1.root, relative_path)
+        path2 = os.path.join(self.tree2.root, relative_path)
+        try:
+            if os.path.islink(path1) or os.path.islink(path2):  # Compare the targets, not what they point to.
+                return (None if os.readlink(path1) == os.readlink(path2) else DIFF_CONTENT), 0
+            if entry1[2] > utils.MAX_CHUNK_SIZE:
+                is_same, bytes_read = utils.compare_files(path1, path2, self._pool1, self._pool2)
+            else:
+                is_same, bytes_read = utils.compare_files(path1, path2)
+        except (IOError, OSError) as ex:
+            utils.print_wrn('WARNING: cannot compare {}: {}'.format(relative_path, ex))
+            return DIFF_UNREADABLE, 0
+        return (None if is_same else DIFF_CONTENT), bytes_read
 
-    # Find out if it is missing in dir1 or dir2.
-    if os.path.isfile(os.path.join(dir1, relative_path)):
-        which_dir = 'dir2'
+    def _compare_checksums(self, relative_path, entry1, entry2):
+        checksums = []
+        bytes_read = 0
+        for tree, entry, pool in ((self.tree1, entry1, self._pool1), (self.tree2, entry2, self._pool2)):
+            if isinstance(tree, utils.ManifestLister):
+                checksums.append(entry[4])
+                continue
+            path = os.path.join(tree.root, relative_path)
+            if os.path.islink(path):  # Not hashed in a manifest either.
+                checksums.append(None)
+                continue
+            try:
+                checksums.append(pool.apply(utils.hash_file, (path, self.hash_algorithm)))
+            except (IOError, OSError) as ex:
+                utils.print_wrn('WARNING: cannot hash {}: {}'.format(path, ex))
+                return DIFF_UNREADABLE, bytes_read
+            bytes_read += entry[2]
+        if None in checksums:
+            return None, bytes_read
+        return (None if checksums[0] == checksums[1] else DIFF_CONTENT), bytes_read
+
+
+class MoveDetector(object):
+    """
+    Match the files on one side only with the files on the other side only, to report them as moved (or renamed)
+    instead of missing on both sides. A dir on one side only is listed right when the merge yields it.
+    Files are matched by size: a pair with a size unique on both sides and the same name is a move, with no file read.
+    In the other size buckets with files on both sides (the ambiguous ones, or all of them with --content) the files
+    are hashed, in parallel with `--jobs`, and matched by checksum. A file in a manifest is not read: its checksum is
+    in the manifest, if any.
+    When all the files of a dir on a side only moved to a dir on the other side only, with the same relative paths,
+    the dir is reported as moved, with one line. The dirs on a side only are walked into to find the highest such
+    dirs: eg. photos/2019 moved to archive/photos2019, with photos and archive on a side only.
+    """
+    def __init__(self, tree1, tree2):
+        self.trees = (tree1, tree2)
+        self.hash_algorithm = tree1.hash_algorithm or tree2.hash_algorithm or utils.DEFAULT_HASH_ALGORITHM
+        self.n_hashed = 0
+        self.bytes_hashed = 0
+        self._roots = ([], [])  # For each side: (relative path, is_dir) of the entries on that side only.
+        self._files = ([], [])  # For each side: [relative path, size, checksum, root] of the files on that side only.
+
+    def add(self, status, relative_path, entry1, entry2):
+        side = 0 if status == utils.DIFF_MISSING_IN_2 else 1
+        entry = entry1 or entry2
+        self._roots[side].append((relative_path, entry[1]))
+        if entry[1]:
+            for path, file_entry in utils.iter_subtree_files(self.trees[side], relative_path):
+                self._files[side].append(
+                    [path, file_entry[2], self._get_known_checksum(side, file_entry), relative_path])
+        else:
+            self._files[side].append([relative_path, entry[2], self._get_known_checksum(side, entry), relative_path])
+
+    def report(self):
+        """
+        Match the files, print the moves and the entries still missing on a side, sorted by path, and return their
+        number.
+        """
+        matches = self._match_files()  # Relative path in dir1 -> relative path in dir2.
+        matched2 = set(matches.values())
+        files_by_root = (defaultdict(list), defaultdict(list))
+        for side in (0, 1):
+            for path, _, _, root in self._files[side]:
+                files_by_root[side][root].append(path)
+        n_files_by_dirpath2 = self._count_files_by_dirpath(1)
+        root_dirs2 = set(path for path, is_dir in self._roots[1] if is_dir)
+
+        lines = []  # (relative path, message)
+        for root, is_dir in self._roots[0]:
+            if is_dir:
+                self._add_dir1_lines(lines, root, files_by_root[0][root], matches, n_files_by_dirpath2, root_dirs2)
+            elif root in matches:
+                lines.append((root, '> File: {}\nmoved to: {}\n'.format(root, matches[root])))
+            else:
+                lines.append((root, '> File: {}\n{}\n'.format(root, utils.DIFF_MISSING_IN_2)))
+        for root, is_dir in self._roots[1]:
+            if is_dir:
+                self._add_dir2_lines(lines, root, files_by_root[1][root], matched2)
+            elif root not in matched2:
+                lines.append((root, '> File: {}\n{}\n'.format(root, utils.DIFF_MISSING_IN_1)))
+        lines.sort(key=lambda line: line[0].split(os.sep))
+        for _, msg in lines:
+            utils.print_msg(msg)
+        return len(lines)
+
+    def _get_known_checksum(self, side, entry):
+        # A checksum in a manifest can be used only if of the same algorithm.
+        return entry[4] if self.trees[side].hash_algorithm == self.hash_algorithm else None
+
+    def _match_files(self):
+        files_by_size = (defaultdict(list), defaultdict(list))
+        for side in (0, 1):
+            for f in self._files[side]:
+                files_by_size[side][f[1]].append(f)
+        matches = {}
+        ambiguous_sizes = []
+        for size, files1 in files_by_size[0].items():
+            files2 = files_by_size[1].get(size)
+            if not files2:
+                continue
+            if not do_compare_content and len(files1) == len(files2) == 1 and \
+                    os.path.basename(files1[0][0]) == os.path.basename(files2[0][0]):
+                matches[files1[0][0]] = files2[0][0]
+            else:
+                ambiguous_sizes.append(size)
+
+        with utils.phase_stats.phase('hash moves'):
+            self._compute_checksums([(side, f) for size in ambiguous_sizes for side in (0, 1)
+                                     for f in files_by_size[side][size]])
+        for size in ambiguous_sizes:
+            files2_by_checksum = defaultdict(list)
+            for f in files_by_size[1][size]:
+                if f[2] is not None:
+                    files2_by_checksum[f[2]].append(f)
+            for f in files_by_size[0][size]:
+                candidates = files2_by_checksum.get(f[2]) if f[2] is not None else None
+                if not candidates:
+                    continue
+                # Among identical files, the one with the same name first.
+                names = [os.path.basename(candidate[0]) for candidate in candidates]
+                name = os.path.basename(f[0])
+                matches[f[0]] = candidates.pop(names.index(name) if name in names else 0)[0]
+        return matches
+
+    def _compute_checksums(self, files):
+        """
+        Compute the checksums missing of `files`, a list of (side, file), in place.
+        """
+        tasks = []
+        task_files = []
+        for side, f in files:
+            tree = self.trees[side]
+            if f[2] is not None or isinstance(tree, utils.ManifestLister):
+                continue
+            path = os.path.join(tree.root, f[0])
+            try:
+                st = os.lstat(path)
+            except OSError as ex:
+                utils.print_wrn('WARNING: {}'.format(ex))
+                continue
+            if stat.S_ISLNK(st.st_mode):
+                continue
+            tasks.append((st.st_dev, _hash_file_or_none, (path, self.hash_algorithm)))
+            task_files.append(f)
+            self.n_hashed += 1
+            self.bytes_hashed += f[1]
+            utils.phase_stats.count('files')
+            utils.phase_stats.count('bytes_read', f[1])
+        for f, checksum in zip(task_files, utils.run_per_device(tasks, jobs)):
+            f[2] = checksum
+
+    def _add_dir1_lines(self, lines, dirpath, paths, matches, n_files_by_dirpath2, root_dirs2):
+        """
+        Add the lines of the dir `dirpath` in dir1, with the files `paths` in its subtree: one line if it moved as a
+        whole or if none of its files moved, else the lines of its files and of its subdirs, walked into.
+        """
+        if not any(path in matches for path in paths):
+            lines.append((dirpath, '> Dir: {}\n{}\n'.format(dirpath, utils.DIFF_MISSING_IN_2)))
+            return
+        to_dirpath = self._get_moved_dirpath(dirpath, paths, matches, n_files_by_dirpath2, root_dirs2)
+        if to_dirpath is not None:
+            lines.append((dirpath, '> Dir: {}\nmoved to: {}\n'.format(dirpath, to_dirpath)))
+            return
+        file_paths, paths_by_subdirpath = _group_by_child(dirpath, paths)
+        for path in file_paths:
+            if path in matches:
+                lines.append((path, '> File: {}\nmoved to: {}\n'.format(path, matches[path])))
+            else:
+                lines.append((path, '> File: {}\n{}\n'.format(path, utils.DIFF_MISSING_IN_2)))
+        for subdirpath, subdir_paths in paths_by_subdirpath.items():
+            self._add_dir1_lines(lines, subdirpath, subdir_paths, matches, n_files_by_dirpath2, root_dirs2)
+
+    def _add_dir2_lines(self, lines, dirpath, paths, matched2):
+        """
+        Add the lines of the dir `dirpath` in dir2, with the files `paths` in its subtree: one line if none of its
+        files was matched, none if all of them were (they are in the lines of dir1), else the lines of its files
+        not matched and of its subdirs, walked into.
+        """
+        if not any(path in matched2 for path in paths):
+            lines.append((dirpath, '> Dir: {}\n{}\n'.format(dirpath, utils.DIFF_MISSING_IN_1)))
+            return
+        file_paths, paths_by_subdirpath = _group_by_child(dirpath, paths)
+        for path in file_paths:
+            if path not in matched2:
+                lines.append((path, '> File: {}\n{}\n'.format(path, utils.DIFF_MISSING_IN_1)))
+        for subdirpath, subdir_paths in paths_by_subdirpath.items():
+            self._add_dir2_lines(lines, subdirpath, subdir_paths, matched2)
+
+    def _count_files_by_dirpath(self, side):
+        """
+        Return a dict: relative dir path -> number of the files on the side only in its subtree.
+        """
+        counts = defaultdict(int)
+        for path, _, _, _ in self._files[side]:
+            dirpath = os.path.dirname(path)
+            while dirpath:
+                counts[dirpath] += 1
+                dirpath = os.path.dirname(dirpath)
+        return counts
+
+    def _get_moved_dirpath(self, root, paths, matches, n_files_by_dirpath2, root_dirs2):
+        """
+        Return the dir in dir2 where the dir `root` in dir1 moved, if all of its files moved there with the same
+        relative paths and nothing else is there, or None.
+        """
+        if not paths or not all(path in matches for path in paths):
+            return None
+        to_dirpath = None
+        for path in paths:
+            relative_path = path[len(root) + 1:]
+            to_path = matches[path]
+            if not to_path.endswith(os.sep + relative_path):
+                return None
+            dirpath = to_path[:-len(relative_path) - 1]
+            if to_dirpath is not None and dirpath != to_dirpath:
+                return None
+            to_dirpath = dirpath
+        if n_files_by_dirpath2.get(to_dirpath) != len(paths):
+            return None
+        # The dir must be on the side 2 only, or in a dir on the side 2 only.
+        dirpath = to_dirpath
+        while dirpath and dirpath not in root_dirs2:
+            dirpath = os.path.dirname(dirpath)
+        return to_dirpath if dirpath else None
+
+
+def _group_by_child(dirpath, paths):
+    """
+    Split the file paths in the subtree of `dirpath`: return the paths of the files right in it, and a dict: path of
+    each subdir -> the paths in its subtree.
+    """
+    file_paths = []
+    paths_by_subdirpath = defaultdict(list)
+    for path in paths:
+        relative_path = path[len(dirpath) + 1:]
+        if os.sep in relative_path:
+            paths_by_subdirpath[os.path.join(dirpath, relative_path.split(os.sep, 1)[0])].append(path)
+        else:
+            file_paths.append(path)
+    return file_paths, paths_by_subdirpath
+
+
+def _hash_file_or_none(path, algorithm):
+    try:
+        return utils.hash_file(path, algorithm)
+    except (IOError, OSError) as ex:
+        utils.print_wrn('WARNING: cannot hash {}: {}'.format(path, ex))
+        return None
+
+
+def _print_diff(status, relative_path, entry1, entry2):
+    if status == utils.DIFF_SIZE:
+        utils.print_msg('> File: {}\nsize differs: {} bytes in dir1, {} bytes in dir2\n'.format(
+            relative_path, entry1[2], entry2[2]))
+    elif status == utils.DIFF_TYPE:
+        utils.print_msg('> Path: {}\n{} in dir1, {} in dir2\n'.format(
+            relative_path, 'dir' if entry1[1] else 'file', 'dir' if entry2[1] else 'file'))
+    elif status in (DIFF_CONTENT, DIFF_UNREADABLE):
+        utils.print_msg('> File: {}\n{}\n'.format(relative_path, status))
     else:
-        which_dir = 'dir1'
-    utils.print_msg('> File: {}\nmissing in {}\n'.format(relative_path, which_dir))
+        is_dir = (entry1 or entry2)[1]
+        utils.print_msg('> {}: {}\n{}\n'.format('Dir' if is_dir else 'File', relative_path, status))
 
 
 if __name__ == '__main__':
@@ -70,7 +561,10 @@ if __name__ == '__main__':
     utils.print_msg('============')
 
     dir1, dir2 = parse_args()
-    find_diff(dir1, dir2)
+    if manifest_path:
+        utils.run_with_stats(write_manifest, dir1)
+    else:
+        utils.run_with_stats(find_diff, dir1, dir2)
 
     utils.print_msg('No errors - DONE')
     sys.exit(0)
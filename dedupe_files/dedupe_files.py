@@ -1,15 +1,57 @@
 #! /usr/bin/python
 """
 Search for duplicate files in a root dir. The comparison is based on file size. If there is a match, their checksum
-is compared. With the option `--metadata-checksum-first` a checksum of the metadata is computed and compared first.
+is compared, in stages: first the checksum of the first 64 KiB, then of the last 64 KiB and finally of the full
+content. Each stage discards the files left without a match, so they are not fully read.
+Paths to the same inode (hardlinks) are the same file: they are hashed once and never reported as dupes.
+With the option `--metadata-checksum-first` a checksum of the metadata is computed and compared first.
 This is particularly useful with photos and video from cameras and smartphones.
+The metadata (capture timestamp, camera, dimensions...) is read in-process, reading only the header of JPEG, HEIC,
+PNG, TIFF-based raw and MP4/MOV files.
 If the reading of the metadata fails, then a checksum of the content is computed and compared.
+The checksum of the content is computed in-process (md5 by default), without spawning any external command.
+Checksums are stored in a persistent cache, so re-running on an unchanged tree is almost instant.
+With `--jobs` checksums are computed in parallel, with a limit of concurrent reads for each disk.
+With `--tree-hash` the full content of big files (ISO images, videos...) is hashed as a tree of chunks: the chunks of
+the same file are hashed in parallel, so one group of huge files uses all the `--jobs`, and the files of a group are
+compared chunk by chunk, so a file is not read any further after its first chunk that differs from all the others.
 
-The root dir can contain many files and subdirs.
+The root dir can contain many files and subdirs, walked natively (no `find` needed): files are stored in a compact
+index (sizes in an array, dir paths interned, names packed in a buffer) and then grouped by size.
 The duplicated files are printed in output.
 
+With `--reference` the root is a candidate dir (eg. a new camera dump) checked against one or more reference dirs (eg.
+the photo archive): only the candidate files already in a reference dir are reported, with the reference copy as the
+one to keep. The reference dirs are stored in a persistent index of sizes and checksums, updated incrementally at
+each run: only the candidate files with the same size as a reference file are hashed, and a reference file is hashed
+only once, when a candidate file first has its size.
+
+With `--similar-photos` near-duplicate photos are searched instead: resized, re-encoded or rotated copies, with a
+different content. A perceptual hash (dHash) is computed for each photo, by default in pure Python from its EXIF
+thumbnail (or from the DC coefficients of the full JPEG), and the photos with hashes within a max Hamming distance are
+grouped, looking up the near hashes in a multi-index hash table (no comparison of every pair). The largest photo of
+each group is the one to keep.
+
+With `--apply` the dupes are deleted, moved to a quarantine dir or replaced with links in-process, batch by batch as
+soon as they are confirmed, instead of writing a Bash script with a `rm` per file (see `apply_plan.py`, that applies the
+NDJSON output of a previous scan). Each file is stat'ed again right before being acted on, and skipped if it changed
+since the scan; the actions done are written to an undo log.
+
+With `--journal` the progress of the scan is written to a journal file: checkpoints of the walk, and the batches of
+groups that went through all the stages. After an interruption, `--resume` skips the work already done: the files
+already walked are not listed again, and the batches done are not compared again if their files are unchanged (same
+paths, size and mtime).
+
 Usage:
-    $ ./dedupe_files.py [--write-rm-script] [--exclude-pathname="*.iso"] [--metadata-checksum-first] root
+    $ ./dedupe_files.py [--write-rm-script] [--exclude-pathname="*.iso"] [--metadata-checksum-first]
+                        [--hash-algorithm=md5] [--checksum-cmd] [--no-cache] [--rebuild-cache] [--vacuum-cache]
+                        [--cache-path=~/.cache/nasutils/hashes.sqlite] [--partial-hash-kib=64] [--tree-hash=64]
+                        [--jobs=1] [--jobs-per-device=N] [--processes] [--link-dupes=hardlink] [--byte-compare]
+                        [--apply=delete] [--quarantine-dir=/volume1/quarantine] [--dry-run] [--undo-log=undo.ndjson]
+                        [--output-format=ndjson] [--output=dupes.ndjson] [--stats] [--stats-json=stats.json]
+                        [--profile=dedupe_files.pstats] [--reference=archive_dir]
+                        [--reference-index-path=~/.cache/nasutils/reference_index.sqlite] [--no-reference-walk]
+                        [--similar-photos=8] [--image-hash-backend=pure] [--journal=scan.ndjson] [--resume] root
 Options:
     --write-rm-script           Write a Bash script for the actual deletion of duplicated files
     --metadata-checksum-first   Try to read the metadata and compute the checksum on metadata. Particularly efficient
@@ -18,25 +60,84 @@ Options:
                                 Eg. to exclude a subdir: -exclude-pathname="*/my subdir/*"
                                 Eg. to exclude all *.iso files: -exclude-pathname="*.iso"
                                 This option can be used multiple times.
+    --hash-algorithm            The algorithm used to hash the content: md5 (default), sha1, sha256, blake2b.
+                                blake2b is the fastest, but requires Python 3.6+.
+    --checksum-cmd              Hash the content with the external command `checksumfile-cmd` in config.ini
+                                (slow, one process per file). Use only as a fallback.
+    --no-cache                  Do not read nor write the persistent cache of checksums.
+    --rebuild-cache             Empty the persistent cache of checksums before running.
+    --vacuum-cache              Evict from the persistent cache the files that do not exist anymore or have changed.
+    --cache-path                The path of the persistent cache of checksums (a SQLite db).
+                                Default: ~/.cache/nasutils/hashes.sqlite
+    --partial-hash-kib          The size in KiB of the first and last blocks hashed before the full content.
+                                Default: 64. Use 0 to hash the full content straight away.
+    --tree-hash                 Hash the full content of the files bigger than this size in MiB as a tree of chunks
+                                of this size, hashed in parallel (with --jobs) and compared chunk by chunk. The
+                                digests of the chunks are stored in the cache. Default: 64. Not with --checksum-cmd,
+                                --byte-compare nor --reference.
+    --jobs                      The number of files hashed in parallel. Default: 1.
+    --jobs-per-device           The max number of files hashed in parallel on the same device (st_dev).
+                                Default: 1 for spinning disks (detected on Linux only), --jobs otherwise.
+    --processes                 Hash the full content in processes instead of threads (for CPU-bound hashing).
+                                By default threads are used, as hashing the full content releases the GIL.
+    --link-dupes                Replace the duplicated files with links to the kept file, instead of deleting them:
+                                `hardlink` (same filesystem only) or `reflink` (copy-on-write clone, Linux only,
+                                on Btrfs, XFS...). Every path stays valid, and the space is reclaimed.
+                                The same as --apply=hardlink or --apply=reflink.
+    --apply                     Act on the duplicated files in-process, as soon as they are confirmed: delete,
+                                quarantine (move them to --quarantine-dir, with their full path), hardlink or reflink
+                                (see --link-dupes). Files changed since the scan are skipped.
+    --quarantine-dir            The dir where the dupes are moved with --apply=quarantine (same filesystem).
+    --dry-run                   With --apply: only check the files and report the bytes that would be reclaimed.
+    --undo-log                  The file where the actions done with --apply are written, to undo them with
+                                `apply_plan.py --undo`. Default: undo_<date>.ndjson in this dir.
+    --byte-compare              Confirm the dupes comparing their bytes, all the files of a group in lockstep, instead
+                                of comparing the checksum of their full content (with `--metadata-checksum-first`:
+                                after comparing the checksum of their metadata). Exact, and cheaper when the files
+                                differ near the start, but the result is not cached.
+    --output-format             The format of the dupes found: text (default), ndjson (one JSON object per group,
+                                with size, hash, and path, dev and inode of each file) or csv (one row per file).
+                                Each group is written as soon as it is confirmed. With ndjson or csv written to
+                                stdout, all the other messages are printed to stderr.
+    --output                    The file where the dupes are written with --output-format=ndjson or csv.
+                                Default: stdout.
+    --stats                     Print a table with the cost of each phase at exit: wall and CPU time, files listed
+                                and stat'ed, bytes read, subprocesses spawned, cache hits, MB/s and files/s.
+    --stats-json                Write the stats of each phase to this JSON file.
+    --profile                   Run under cProfile and write the stats to this .pstats file.
+                                Default: dedupe_files.pstats
+    --reference                 A reference dir: report only the files in root already in a reference dir, keeping
+                                the reference copy. Not with --metadata-checksum-first nor --byte-compare.
+                                This option can be used multiple times.
+    --reference-index-path      The path of the persistent index of the reference dirs (a SQLite db).
+                                Default: ~/.cache/nasutils/reference_index.sqlite
+    --no-reference-walk         Use the reference index as it is, without walking the reference dirs to update it (eg.
+                                an archive on a slow disk). The reference files with a matching size are still
+                                checked before being used. A reference dir never indexed is walked anyway.
+    --similar-photos            Search for similar photos instead of dupes: the photos whose perceptual hashes differ
+                                at most by this number of bits (out of 64). Default: 8. Not with --reference,
+                                --apply, --link-dupes, --metadata-checksum-first nor --byte-compare.
+    --image-hash-backend        How the perceptual hashes are computed: pure (Python, JPEG only, from the EXIF
+                                thumbnail when present) or pil (Pillow, any format). Default: pil if Pillow is
+                                installed, pure otherwise.
+    --journal                   Write the progress of the scan to this journal file, to resume it if interrupted. It
+                                is deleted when the scan is complete.
+                                Default: ~/.cache/nasutils/journals/dedupe_files_<hash of root>.ndjson
+    --resume                    Resume an interrupted scan from its journal (implies --journal): skip the files
+                                already walked and the groups already compared, if unchanged. The options must be the
+                                same as in the interrupted scan.
 """
 import datetime
+import hashlib
 import os
-import subprocess
 import sys
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 import utils
 
 
-FIND_CMD = utils.config.get('main', 'find-cmd')
-WC_CMD = utils.config.get('main', 'wc-cmd')
-SORT_CMD = utils.config.get('main', 'sort-cmd')
-UNIQ_CMD = utils.config.get('main', 'uniq-cmd')
 CHECKSUMFILE_CMD = utils.config.get('main', 'checksumfile-cmd')
-CHECKSUMSTRING_CMD = utils.config.get('main', 'checksumstring-cmd')
-TAIL_CMD = utils.config.get('main', 'tail-cmd')
-SIPS_CMD = utils.config.get('main', 'sips-cmd')
 
 
 root = None
@@ -44,9 +145,46 @@ extensions = set()
 do_write_rm_script = False
 exclude_pathnames = []
 do_metadata_checksum_first = False
+hash_algorithm = utils.DEFAULT_HASH_ALGORITHM
+do_use_checksum_cmd = False
+do_use_hash_cache = True
+do_rebuild_hash_cache = False
+do_vacuum_hash_cache = False
+hash_cache_path = None
+hash_cache = None
+partial_hash_size = 64 * 1024
+tree_hash_chunk_size = None
+jobs = 1
+jobs_per_device = None
+do_use_processes = False
+apply_action = None
+quarantine_dir = None
+do_dry_run = False
+undo_log_path = None
+plan_executor = None
+do_byte_compare = False
+output_format = 'text'
+output_path = None
+dupes_writer = None
+rm_script = None
+reference_roots = []
+reference_index_path = None
+do_walk_reference = True
+reference_index = None
+similar_max_distance = None
+image_hash_backend = utils.get_default_image_hash_backend()
+perceptual_hashes = {}  # Path -> perceptual hash (int), with `--similar-photos`.
+journal_path = None
+do_resume = False
+journal = None
+stats_map = {}  # Path -> stat result, for files with potential dupes.
+hardlinks_map = {}  # Path -> other paths to the same inode.
 
 
 def parse_args():
+    # Handle '--stats', '--stats-json' and '--profile' options.
+    utils.parse_stats_options(sys.argv)
+
     # Handle '--write-rm-script' option.
     if '--write-rm-script' in sys.argv:
         sys.argv.remove('--write-rm-script')
@@ -59,6 +197,181 @@ def parse_args():
         global do_metadata_checksum_first
         do_metadata_checksum_first = True
 
+    # Handle '--checksum-cmd' option.
+    if '--checksum-cmd' in sys.argv:
+        sys.argv.remove('--checksum-cmd')
+        global do_use_checksum_cmd
+        do_use_checksum_cmd = True
+
+    # Handle '--hash-algorithm' option.
+    for argv in sys.argv:
+        if argv.startswith('--hash-algorithm'):
+            global hash_algorithm
+            hash_algorithm = argv.split('=')[1]
+            sys.argv.remove(argv)
+            break
+    if hash_algorithm not in utils.HASH_ALGORITHMS:
+        utils.exit_with_error_msg('Invalid hash algorithm: {}, valid values: {}'.format(
+            hash_algorithm, ', '.join(utils.HASH_ALGORITHMS)))
+    if not utils.is_hash_algorithm_available(hash_algorithm):
+        utils.exit_with_error_msg('Hash algorithm not available in this Python: {}'.format(hash_algorithm))
+    if do_use_checksum_cmd and hash_algorithm != utils.DEFAULT_HASH_ALGORITHM:
+        utils.exit_with_error_msg('Options --checksum-cmd and --hash-algorithm cannot be used together')
+
+    # Handle '--no-cache' option.
+    if '--no-cache' in sys.argv:
+        sys.argv.remove('--no-cache')
+        global do_use_hash_cache
+        do_use_hash_cache = False
+
+    # Handle '--rebuild-cache' option.
+    if '--rebuild-cache' in sys.argv:
+        sys.argv.remove('--rebuild-cache')
+        global do_rebuild_hash_cache
+        do_rebuild_hash_cache = True
+
+    # Handle '--vacuum-cache' option.
+    if '--vacuum-cache' in sys.argv:
+        sys.argv.remove('--vacuum-cache')
+        global do_vacuum_hash_cache
+        do_vacuum_hash_cache = True
+
+    # Handle '--cache-path' option.
+    for argv in sys.argv:
+        if argv.startswith('--cache-path'):
+            global hash_cache_path
+            hash_cache_path = os.path.abspath(os.path.expanduser(argv.split('=')[1]))
+            sys.argv.remove(argv)
+            break
+
+    # Handle '--partial-hash-kib' option.
+    for argv in sys.argv:
+        if argv.startswith('--partial-hash-kib'):
+            global partial_hash_size
+            try:
+                partial_hash_size = int(argv.split('=')[1]) * 1024
+            except ValueError:
+                utils.exit_with_error_msg('Invalid value for --partial-hash-kib: {}'.format(argv.split('=')[1]))
+            sys.argv.remove(argv)
+            break
+
+    # Handle '--tree-hash' option.
+    for argv in sys.argv:
+        if argv == '--tree-hash' or argv.startswith('--tree-hash='):
+            global tree_hash_chunk_size
+            tree_hash_chunk_size = utils.TREE_HASH_CHUNK_SIZE
+            if '=' in argv:
+                try:
+                    tree_hash_chunk_size = int(argv.split('=')[1]) * 1024 * 1024
+                except ValueError:
+                    tree_hash_chunk_size = 0
+                if tree_hash_chunk_size < 1:
+                    utils.exit_with_error_msg('Invalid value for --tree-hash: {}'.format(argv.split('=')[1]))
+            sys.argv.remove(argv)
+            break
+    if tree_hash_chunk_size and do_use_checksum_cmd:
+        utils.exit_with_error_msg('Options --tree-hash and --checksum-cmd cannot be used together')
+
+    # Handle '--processes' option.
+    if '--processes' in sys.argv:
+        sys.argv.remove('--processes')
+        global do_use_processes
+        do_use_processes = True
+
+    # Handle '--jobs' and '--jobs-per-device' options.
+    global jobs, jobs_per_device
+    for argv in list(sys.argv):
+        for option in ('--jobs-per-device', '--jobs'):
+            if argv.startswith(option + '='):
+                try:
+                    value = int(argv.split('=')[1])
+                except ValueError:
+                    value = 0
+                if value < 1:
+                    utils.exit_with_error_msg('Invalid value for {}: {}'.format(option, argv.split('=')[1]))
+                if option == '--jobs':
+                    jobs = value
+                else:
+                    jobs_per_device = value
+                sys.argv.remove(argv)
+
+    # Handle '--byte-compare' option.
+    if '--byte-compare' in sys.argv:
+        sys.argv.remove('--byte-compare')
+        global do_byte_compare
+        do_byte_compare = True
+
+    # Handle '--link-dupes' and '--apply' options.
+    global apply_action
+    for argv in sys.argv:
+        if argv.startswith('--link-dupes'):
+            apply_action = argv.split('=')[1]
+            sys.argv.remove(argv)
+            if apply_action not in ('hardlink', 'reflink'):
+                utils.exit_with_error_msg('Invalid value for --link-dupes: {}, valid values: hardlink, reflink'.format(
+                    apply_action))
+            break
+    for argv in sys.argv:
+        if argv.startswith('--apply'):
+            if apply_action:
+                utils.exit_with_error_msg('Options --link-dupes and --apply cannot be used together')
+            apply_action = argv.split('=')[1]
+            sys.argv.remove(argv)
+            if apply_action not in utils.APPLY_ACTIONS:
+                utils.exit_with_error_msg('Invalid value for --apply: {}, valid values: {}'.format(
+                    apply_action, ', '.join(utils.APPLY_ACTIONS)))
+            break
+    if apply_action and do_write_rm_script:
+        utils.exit_with_error_msg('Options --apply (or --link-dupes) and --write-rm-script cannot be used together')
+
+    # Handle '--quarantine-dir', '--dry-run' and '--undo-log' options.
+    for argv in sys.argv:
+        if argv.startswith('--quarantine-dir'):
+            global quarantine_dir
+            quarantine_dir = os.path.abspath(os.path.expanduser(argv.split('=', 1)[1]))
+            sys.argv.remove(argv)
+            break
+    if (apply_action == 'quarantine') != (quarantine_dir is not None):
+        utils.exit_with_error_msg('Option --quarantine-dir is required with --apply=quarantine, and only with it')
+    if '--dry-run' in sys.argv:
+        sys.argv.remove('--dry-run')
+        global do_dry_run
+        do_dry_run = True
+    for argv in sys.argv:
+        if argv.startswith('--undo-log'):
+            global undo_log_path
+            undo_log_path = os.path.abspath(os.path.expanduser(argv.split('=', 1)[1]))
+            sys.argv.remove(argv)
+            break
+    if (do_dry_run or undo_log_path) and not apply_action:
+        utils.exit_with_error_msg('Options --dry-run and --undo-log require --apply')
+    if apply_action and undo_log_path is None:
+        now = datetime.datetime.now()
+        undo_log_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'undo_{}.ndjson'.format(
+            now.strftime("%Y-%m-%d-%Hh%Mm")))
+
+    # Handle '--output-format' and '--output' options.
+    for argv in sys.argv:
+        if argv.startswith('--output-format'):
+            global output_format
+            output_format = argv.split('=')[1]
+            sys.argv.remove(argv)
+            break
+    if output_format not in utils.OUTPUT_FORMATS:
+        utils.exit_with_error_msg('Invalid value for --output-format: {}, valid values: {}'.format(
+            output_format, ', '.join(utils.OUTPUT_FORMATS)))
+    for argv in sys.argv:
+        if argv.startswith('--output='):
+            global output_path
+            output_path = argv.split('=', 1)[1]
+            sys.argv.remove(argv)
+            break
+    if output_path and output_format == 'text':
+        utils.exit_with_error_msg('Option --output requires --output-format=ndjson or --output-format=csv')
+    if output_format != 'text' and output_path in (None, '-'):
+        # Stdout is for the dupes only.
+        utils.print_msgs_to_stderr()
+
     # Handle '--exclude-pathname' option. It can be used multiple times.
     idx_to_delete = []
     for i, argv in enumerate(sys.argv):
@@ -71,6 +384,79 @@ def parse_args():
     for idx in idx_to_delete:
         del sys.argv[idx]
 
+    # Handle '--reference' option. It can be used multiple times.
+    for argv in list(sys.argv):
+        if argv.startswith('--reference='):
+            reference_roots.append(os.path.abspath(os.path.expanduser(argv.split('=', 1)[1])))
+            sys.argv.remove(argv)
+
+    # Handle '--reference-index-path' option.
+    for argv in sys.argv:
+        if argv.startswith('--reference-index-path'):
+            global reference_index_path
+            reference_index_path = os.path.abspath(os.path.expanduser(argv.split('=')[1]))
+            sys.argv.remove(argv)
+            break
+
+    # Handle '--no-reference-walk' option.
+    if '--no-reference-walk' in sys.argv:
+        sys.argv.remove('--no-reference-walk')
+        global do_walk_reference
+        do_walk_reference = False
+
+    if reference_roots and (do_metadata_checksum_first or do_byte_compare):
+        utils.exit_with_error_msg(
+            'Option --reference cannot be used with --metadata-checksum-first nor with --byte-compare')
+    if tree_hash_chunk_size and (do_byte_compare or reference_roots):
+        utils.exit_with_error_msg('Option --tree-hash cannot be used with --byte-compare nor with --reference')
+
+    # Handle '--similar-photos' option.
+    for argv in sys.argv:
+        if argv == '--similar-photos' or argv.startswith('--similar-photos='):
+            global similar_max_distance
+            similar_max_distance = SIMILAR_PHOTOS_MAX_DISTANCE
+            if '=' in argv:
+                try:
+                    similar_max_distance = int(argv.split('=')[1])
+                except ValueError:
+                    similar_max_distance = -1
+                if not 0 <= similar_max_distance < 64:
+                    utils.exit_with_error_msg('Invalid value for --similar-photos: {}'.format(argv.split('=')[1]))
+            sys.argv.remove(argv)
+            break
+
+    # Handle '--image-hash-backend' option.
+    for argv in sys.argv:
+        if argv.startswith('--image-hash-backend'):
+            global image_hash_backend
+            image_hash_backend = argv.split('=')[1]
+            sys.argv.remove(argv)
+            break
+    if image_hash_backend not in utils.IMAGE_HASH_BACKENDS:
+        utils.exit_with_error_msg('Invalid value for --image-hash-backend: {}, valid values: {}'.format(
+            image_hash_backend, ', '.join(utils.IMAGE_HASH_BACKENDS)))
+    if not utils.is_image_hash_backend_available(image_hash_backend):
+        utils.exit_with_error_msg('Image hash backend not available (Pillow is not installed): {}'.format(
+            image_hash_backend))
+
+    if similar_max_distance is not None and (reference_roots or apply_action or do_metadata_checksum_first or
+                                             do_byte_compare):
+        utils.exit_with_error_msg('Option --similar-photos cannot be used with --reference, --apply, --link-dupes, '
+                                  '--metadata-checksum-first nor --byte-compare')
+
+    # Handle '--journal' and '--resume' options.
+    global journal_path, do_resume
+    for argv in sys.argv:
+        if argv == '--journal' or argv.startswith('--journal='):
+            journal_path = os.path.abspath(os.path.expanduser(argv.split('=', 1)[1])) if '=' in argv else ''
+            sys.argv.remove(argv)
+            break
+    if '--resume' in sys.argv:
+        sys.argv.remove('--resume')
+        do_resume = True
+        if journal_path is None:
+            journal_path = ''
+
     global root
     try:
         root = os.path.abspath(sys.argv[1])
@@ -80,54 +466,230 @@ def parse_args():
     # Ensure the dir is valid.
     if not os.path.isdir(root):
         utils.exit_with_error_msg('Please provide a valid dir')
+    for reference_root in reference_roots:
+        if not os.path.isdir(reference_root):
+            utils.exit_with_error_msg('Please provide a valid reference dir: {}'.format(reference_root))
+        # Else files would be compared with themselves.
+        if _is_same_or_subdir(root, reference_root) or _is_same_or_subdir(reference_root, root):
+            utils.exit_with_error_msg('The root and a reference dir cannot contain each other: {}'.format(
+                reference_root))
+    if journal_path == '':  # The default: one journal for each root.
+        journal_path = os.path.join(utils.DEFAULT_JOURNALS_DIR, 'dedupe_files_{}.ndjson'.format(
+            hashlib.md5(root.encode('utf-8', 'surrogateescape') if sys.version_info[0] >= 3 else root).hexdigest()))
 
     return root
 
 
 def find_dupes():
-    sizes_and_paths = _list_all_sizes_and_paths()
-    dupes_map = _create_groups_by_size(sizes_and_paths)
-    _remove_non_dupes(dupes_map, '\n> Removing files with unique size...')
-    _group_by_size_and_checksum(dupes_map)
-    _remove_non_dupes(dupes_map, '\n> Removing files with the same size but different checksum...')
-    _print_dupes(dupes_map)
-    if do_write_rm_script:
-        _write_rm_script(dupes_map)
+    phase = utils.phase_stats.phase
+    with phase('open cache'):
+        _open_hash_cache()
+    if journal_path:
+        with phase('open journal'):
+            _open_journal()
+    if reference_roots:
+        with phase('reference index'):
+            _open_reference_index()
+    with phase('list files'):
+        file_index = _build_file_index(_list_all_sizes_and_paths())
+    with phase('group by size'):
+        dupes_map = _create_groups_by_size(file_index)
+        del file_index
+    with phase('hardlinks'):
+        _collapse_hardlinks(dupes_map)
+        # A single candidate file can be in a reference dir, a photo can be similar to one with another size.
+        if not reference_roots and similar_max_distance is None:
+            _remove_non_dupes(dupes_map, '\n> Removing files whose only potential dupes are hardlinks...')
+    _open_dupes_writer()
+    _open_plan_executor()
+    n_groups = n_dupes = 0
+    if reference_roots:
+        batches = _group_by_reference_checksum(dupes_map)
+    elif similar_max_distance is not None:
+        batches = _group_by_perceptual_hash(dupes_map)
+    else:
+        batches = _group_by_size_and_checksum(dupes_map)
+    # Each batch of dupes is reported (and deleted, moved or linked) as soon as it is confirmed.
+    for batch_dupes_map in batches:
+        n_groups += len(batch_dupes_map)
+        n_dupes += sum(len(paths) - 1 for paths in batch_dupes_map.values())
+        with phase('report'):
+            _collect_extensions(batch_dupes_map)
+            _print_dupes(batch_dupes_map)
+            _write_dupes(batch_dupes_map)
+            if do_write_rm_script:
+                _write_rm_script(batch_dupes_map)
+        if apply_action:
+            with phase('apply'):
+                _apply_dupes(batch_dupes_map)
+    with phase('report'):
+        _close_dupes_writer()
+        _close_rm_script()
+    if reference_roots:
+        utils.print_msg('\n> Found {} files already in the reference dirs'.format(n_dupes))
+    elif similar_max_distance is not None:
+        utils.print_msg('\n> Found {} photos similar to a larger one'.format(n_dupes))
+    if not n_groups:
+        utils.print_msg('\nNo dupes')
+    else:
+        utils.print_msg('\n>>>>> Extensions found in dupes: {}'.format(' '.join(sorted(extensions))))
+    _close_plan_executor()
+    _close_reference_index()
+    _close_hash_cache()
+    _remove_journal()
 
 
-def _list_all_sizes_and_paths():
-    exclude_pathnames_option = ''
-    for pathname in exclude_pathnames:
-        exclude_pathnames_option += '! -path "{}" '.format(pathname)
-    utils.print_msg('\n> Building size and path list...')
-    # Eg.: $ gfind root -type f ! -path "*@eaDir*" ! -name ".DS_Store" ! -path excludepathname -printf "%s\t%P\n"
-    cmd = '{} "{}" -type f ! -path "*@eaDir*" ! -name ".DS_Store" {} -printf "%s\\t%P\\n"'.format(
-        FIND_CMD, root, exclude_pathnames_option)
-    output = subprocess.check_output(cmd, shell=True).rstrip()
-    output = output.decode('utf-8')
-    if not output:
-        utils.print_msg('No files in root')
-    output = output.splitlines()
-    utils.print_msg('> Found {} files'.format(len(output)))
+def _open_hash_cache():
+    global hash_cache
+    if not do_use_hash_cache:
+        return
+    hash_cache = utils.HashCache(hash_cache_path).open(do_rebuild=do_rebuild_hash_cache)
+    if do_vacuum_hash_cache:
+        utils.print_msg('\n> Vacuuming the hash cache...')
+        utils.print_msg('> Evicted {} entries'.format(hash_cache.vacuum()))
+
+
+def _close_hash_cache():
+    if not hash_cache:
+        return
+    hash_cache.close()
+    utils.print_msg('\n> Hash cache: {} hits, {} misses\n> Hash cache path: {}'.format(
+        hash_cache.hits, hash_cache.misses, hash_cache.path))
 
-    sizes_and_paths = []
-    for line in output:
-        if not line:
+
+def _open_journal():
+    global journal
+    journal = utils.ScanJournal(journal_path)
+    options = _get_journal_options()
+    if do_resume:
+        if not journal.load():
+            utils.print_wrn('WARNING: no journal to resume, starting from scratch: {}'.format(journal_path))
+        elif journal.options != options:
+            utils.exit_with_error_msg('The journal was written by a scan with different options: {}'.format(
+                journal_path))
+        else:
+            utils.print_msg('\n> Resuming from the journal: {}\n> {} files already walked{}, {} batches done'.format(
+                journal_path, journal.n_walked_files, ' (walk complete)' if journal.is_walk_done else '',
+                journal.n_batches))
+            journal.reopen()
+            return
+        journal = utils.ScanJournal(journal_path)
+    utils.print_msg('\n> Writing the journal: {}'.format(journal_path))
+    journal.start(options)
+
+
+def _get_journal_options():
+    # The options that change the files walked or the groups found: a scan can be resumed only with the same ones.
+    return {
+        'root': root,
+        'exclude_pathnames': exclude_pathnames,
+        'metadata_checksum_first': do_metadata_checksum_first,
+        'hash_algorithm': hash_algorithm,
+        'checksum_cmd': do_use_checksum_cmd,
+        'partial_hash_size': partial_hash_size,
+        'tree_hash_chunk_size': tree_hash_chunk_size,
+        'byte_compare': do_byte_compare,
+        'reference_roots': reference_roots,
+        'similar_max_distance': similar_max_distance,
+        'image_hash_backend': image_hash_backend,
+    }
+
+
+def _remove_journal():
+    if not journal:
+        return
+    journal.remove()
+    utils.print_msg('\n> Scan complete, journal removed: {}'.format(journal_path))
+
+
+def _open_reference_index():
+    global reference_index
+    reference_index = utils.ReferenceIndex(reference_roots, reference_index_path).open()
+    utils.print_msg('\n> Reference index path: {}'.format(reference_index.path))
+    for reference_root in reference_roots:
+        if not do_walk_reference and reference_index.is_indexed(reference_root):
             continue
-        size, path = line.split('\t')
-        if sys.version_info[0] < 3:  # For Python 2.
-            size = size.encode('utf-8')
-            path = path.encode('utf-8')
-        sizes_and_paths.append((size, path))
+        utils.print_msg('\n> Updating the reference index for: {}...'.format(reference_root))
+        n_files, n_changed, n_removed = reference_index.update(
+            reference_root, utils.NAS_EXCLUDE_PATHNAMES + tuple(exclude_pathnames), utils.NAS_EXCLUDE_NAMES,
+            on_file=lambda: utils.phase_stats.count('files_stated'))
+        utils.print_msg('> Found {} files: {} new or changed, {} removed'.format(n_files, n_changed, n_removed))
+
+
+def _close_reference_index():
+    if not reference_index:
+        return
+    reference_index.close()
 
-    return sizes_and_paths
 
+def _is_same_or_subdir(path, dirpath):
+    return os.path.join(path, '').startswith(os.path.join(dirpath, ''))
 
-def _create_groups_by_size(sizes_and_paths):
-    utils.print_msg('\n> Grouping all found files by size...')
-    dupes_map = defaultdict(list)
+
+def _list_all_sizes_and_paths():
+    """
+    Yield (size, path) for each file in root, while walking it.
+    With a journal, the files already walked in an interrupted scan are read from the journal first, and the walk
+    resumes after the last one. The files found are written to the journal.
+    """
+    start_after = None
+    if journal:
+        for path, size in journal.iter_walked_files():
+            utils.phase_stats.count('files')
+            yield size, path
+        if journal.is_walk_done:
+            return
+        start_after = journal.last_walked_path
+    for path, st in utils.iter_files(root, utils.NAS_EXCLUDE_PATHNAMES + tuple(exclude_pathnames),
+                                     utils.NAS_EXCLUDE_NAMES, start_after=start_after):
+        utils.phase_stats.count('files')
+        utils.phase_stats.count('files_stated')
+        if journal:
+            journal.add_walked_file(path, st.st_size)
+        yield st.st_size, path
+    if journal:
+        journal.end_walk()
+
+
+def _build_file_index(sizes_and_paths):
+    utils.print_msg('\n> Building size and path index of all found files...')
+    file_index = utils.FileIndex()
     for size, path in sizes_and_paths:
-        dupes_map[size].append(path)
+        file_index.add(path, size)
+    if not len(file_index):
+        utils.print_msg('No files in root')
+    utils.print_msg('> Found {} files'.format(len(file_index)))
+    return file_index
+
+
+def _create_groups_by_size(file_index):
+    """
+    Group the files in the index by size, dropping the files with a unique size. Only the paths of the files left
+    are built, the index can be freed afterwards.
+    """
+    utils.phase_stats.count('files', len(file_index))
+    dupes_map = OrderedDict()
+    if reference_roots:
+        utils.print_msg('\n> Grouping all found files by size, and removing files with a size not in the reference '
+                        'dirs...')
+        for size, indexes in file_index.iter_groups_by_size(min_count=1):
+            if reference_index.has_size(size):
+                dupes_map[size] = [file_index.get_path(i) for i in indexes]
+        utils.print_msg('> Kept {} files'.format(sum(len(paths) for paths in dupes_map.values())))
+        return dupes_map
+    if similar_max_distance is not None:
+        utils.print_msg('\n> Grouping all found photos by size...')
+        extensions = utils.get_image_extensions(image_hash_backend)
+        for size, indexes in file_index.iter_groups_by_size(min_count=1):
+            paths = [file_index.get_path(i) for i in indexes]
+            paths = [path for path in paths if os.path.splitext(path)[1].lower() in extensions]
+            if paths:
+                dupes_map[size] = paths
+        utils.print_msg('> Found {} photos'.format(sum(len(paths) for paths in dupes_map.values())))
+        return dupes_map
+    utils.print_msg('\n> Grouping all found files by size, and removing files with unique size...')
+    for size, indexes in file_index.iter_groups_by_size():
+        dupes_map[size] = [file_index.get_path(i) for i in indexes]
     return dupes_map
 
 
@@ -139,120 +701,722 @@ def _remove_non_dupes(data, msg=None):
         del data[key]
 
 
+def _collapse_hardlinks(dupes_map):
+    """
+    Stat the files with potential dupes and keep only one path for each inode. The other paths (hardlinks) are the
+    same file: there is nothing to hash, nor space to reclaim. They are stored in `hardlinks_map`.
+    """
+    utils.print_msg('\n> Looking for hardlinks (paths to the same inode)...')
+    n_hardlinks = 0
+    for size, paths in dupes_map.items():
+        paths_by_inode = OrderedDict()
+        for path in paths:
+            utils.phase_stats.count('files')
+            utils.phase_stats.count('files_stated')
+            try:
+                st = os.lstat(os.path.join(root, path))
+            except OSError as ex:  # Eg. deleted in the meanwhile.
+                utils.print_wrn('WARNING: {}'.format(ex))
+                continue
+            if st.st_size != size:
+                utils.print_wrn('WARNING: changed since it was listed, skipping: {}'.format(path))
+                continue
+            stats_map[path] = st
+            inode = (st.st_dev, st.st_ino)
+            if inode in paths_by_inode:
+                hardlinks_map.setdefault(paths_by_inode[inode], []).append(path)
+                n_hardlinks += 1
+            else:
+                paths_by_inode[inode] = path
+        dupes_map[size] = list(paths_by_inode.values())
+    utils.print_msg('> Found {} hardlinks'.format(n_hardlinks))
+
+
 def _group_by_size_and_checksum(dupes_map):
-    total_num = 0
-    for dupes in dupes_map.values():
-        total_num += len(dupes)
-    i = 1
-    for size, dupes in dupes_map.items():
-        utils.print_msg('\n> [{}/{}] Comparing checksums for files with the same size:\n{}'.format(i, total_num,'\n'.join(dupes)))
-        i += len(dupes)
-        actual_dupes = _select_dupes_with_same_checksum(dupes, total_num)
-        dupes_map[size] = actual_dupes
-
-
-def _select_dupes_with_same_checksum(dupes, total_num):
+    """
+    Run the groups of files with the same size through a pipeline of stages. Each stage regroups the files by a
+    checksum and drops the files left alone, so the next (more expensive) stage has less to read:
+     - checksum of the first KiBs;
+     - checksum of the last KiBs;
+     - checksum of the full content (or of the metadata, with `--metadata-checksum-first`).
+    The groups go through the pipeline in batches of about `BATCH_NUM_FILES` files, by increasing size. Yield a new
+    dupes map for each batch, sorted by size, with keys: (size, checksum).
+    With a journal, each batch done is written to it, and the batches done in an interrupted scan are yielded first.
+    """
+    if journal and journal.n_batches:
+        resumed_dupes_map = _get_resumed_dupes(dupes_map)
+        if resumed_dupes_map:
+            yield resumed_dupes_map
+    groups = sorted(((size,), paths) for size, paths in dupes_map.items())
+    batches = _split_in_batches(groups)
+    for i, batch in enumerate(batches):
+        _print_batch(i, batches)
+        sizes = [[key[0], [[path, utils.get_mtime_ns(stats_map[path])] for path in paths]] for key, paths in batch]
+        for stage in _get_stages():
+            with utils.phase_stats.phase('stage "{}"'.format(stage)):
+                batch = _run_stage(stage, batch)
+        new_dupes_map = OrderedDict()
+        for key, paths in sorted(batch):
+            new_dupes_map[(key[0], key[-1])] = paths
+        if journal:
+            journal.add_batch(sizes, [[size, checksum, paths] for (size, checksum), paths in new_dupes_map.items()])
+        yield new_dupes_map
+
+
+def _get_resumed_dupes(dupes_map):
+    """
+    Return a dupes map with the dupes found in the batches done in an interrupted scan, and remove their sizes from
+    `dupes_map`. A size is done only if its files are the same as then, unchanged: same paths and mtime (the size is
+    checked when the files are stat'ed).
+    """
+    utils.print_msg('\n> Resuming the batches done from the journal...')
+    resumed_dupes_map = OrderedDict()
+    n_done = n_changed = 0
+    for sizes, dupes in journal.iter_batches():
+        done_sizes = set()
+        for size, files in sizes:
+            paths = dupes_map.get(size)
+            if paths == [path for path, _ in files] and all(
+                    utils.get_mtime_ns(stats_map[path]) == mtime_ns for path, mtime_ns in files):
+                done_sizes.add(size)
+            else:
+                n_changed += 1
+        for size, checksum, paths in dupes:
+            if size in done_sizes:
+                resumed_dupes_map[(size, checksum)] = paths
+        for size in done_sizes:
+            del dupes_map[size]
+        n_done += len(done_sizes)
+    utils.print_msg('> Skipped {} groups of files with the same size, done in the interrupted scan; {} changed since'
+                    .format(n_done, n_changed))
+    return OrderedDict(sorted(resumed_dupes_map.items()))
+
+
+def _group_by_reference_checksum(dupes_map):
+    """
+    With `--reference`: compare the checksum of the full content of the candidate files with the checksums of the
+    files with the same size in the reference dirs (computed only if missing from the reference index).
+    Yield a dupes map for each batch, like `_group_by_size_and_checksum`: the first path of each group is the reference
+    copy (a full path), followed by the candidate files with the same content.
+    """
+    groups = sorted(((size,), paths) for size, paths in dupes_map.items())
+    batches = _split_in_batches(groups)
+    for i, batch in enumerate(batches):
+        _print_batch(i, batches)
+        with utils.phase_stats.phase('stage "{}"'.format(STAGE_CONTENT)):
+            total_num = sum(len(paths) for _, paths in batch)
+            utils.print_msg('\n> Stage "{}": hashing {} candidate files in {} groups...'.format(
+                STAGE_CONTENT, total_num, len(batch)))
+            checksums_by_group, bytes_read = _compute_checksums(STAGE_CONTENT, batch)
+            utils.phase_stats.count('files', total_num)
+            utils.phase_stats.count('bytes_read', bytes_read)
+            utils.print_msg('> Stage "{}": read {:,} bytes'.format(STAGE_CONTENT, bytes_read))
+        with utils.phase_stats.phase('stage "{}"'.format(STAGE_REFERENCE)):
+            reference_paths_by_size = _get_reference_paths_by_checksum([key[0] for key, _ in batch])
+        new_dupes_map = OrderedDict()
+        for (key, paths), checksums in zip(batch, checksums_by_group):
+            candidates_by_checksum = defaultdict(list)
+            for path, checksum in zip(paths, checksums):
+                candidates_by_checksum[checksum].append(path)
+            for checksum, candidates in sorted(candidates_by_checksum.items()):
+                reference_path = reference_paths_by_size[key[0]].get(checksum)
+                if reference_path:
+                    new_dupes_map[(key[0], checksum)] = [reference_path] + candidates
+        yield new_dupes_map
+
+
+def _get_reference_paths_by_checksum(sizes):
+    """
+    Return a dict: size -> {checksum: full path of the first reference file with that checksum}.
+    The reference files are stat'ed first: the ones that changed since they were indexed are hashed again, and the
+    checksums computed are stored in the reference index.
+    """
+    utils.print_msg('\n> Stage "{}": looking up the checksums of the reference files with the same size...'.format(
+        STAGE_REFERENCE))
+    kind = 'content:cmd' if do_use_checksum_cmd else 'content:{}'.format(hash_algorithm)
+    files_by_size = {}  # Size -> list of [full path, checksum].
+    tasks = []
+    task_files = []
+    bytes_read = 0
+    for size in sizes:
+        files = files_by_size[size] = []
+        for path, checksum in reference_index.get_files(size, kind):
+            utils.phase_stats.count('files')
+            utils.phase_stats.count('files_stated')
+            try:
+                st = os.lstat(path)
+            except OSError:  # Deleted since it was indexed.
+                reference_index.remove_file(path)
+                continue
+            if not reference_index.is_unchanged(path, st):
+                reference_index.set_file(path, st)
+                checksum = None
+                if st.st_size != size:
+                    continue
+            stats_map[path] = st
+            files.append([path, checksum])
+            if checksum is not None:
+                utils.phase_stats.count('cache_hits')
+                continue
+            utils.phase_stats.count('cache_misses')
+            utils.print_msg('> Hashing reference file: {}'.format(path))
+            func, args, n_bytes = _make_content_task(size, path)
+            tasks.append((st.st_dev, func, args))
+            task_files.append(files[-1])
+            bytes_read += n_bytes
+    results = utils.run_per_device(tasks, jobs, do_use_processes, jobs_per_device)
+    for reference_file, checksum in zip(task_files, results):
+        reference_file[1] = checksum
+        reference_index.set_file(reference_file[0], stats_map[reference_file[0]], kind, checksum)
+    reference_index.commit()
+    utils.phase_stats.count('bytes_read', bytes_read)
+    utils.print_msg('> Stage "{}": read {:,} bytes, hashed {} reference files'.format(
+        STAGE_REFERENCE, bytes_read, len(tasks)))
+
+    reference_paths_by_size = {}
+    for size, files in files_by_size.items():
+        paths_by_checksum = reference_paths_by_size[size] = {}
+        for path, checksum in files:  # Sorted by path.
+            paths_by_checksum.setdefault(checksum, path)
+    return reference_paths_by_size
+
+
+def _group_by_perceptual_hash(dupes_map):
+    """
+    With `--similar-photos`: compute the perceptual hash of all the photos and group the photos with hashes within
+    the max distance, looking up the near hashes of each one in a `HammingIndex`. Groups are linked: if A is near B
+    and B is near C, then A, B and C are in the same group.
+    Yield a single dupes map, with keys: (size, perceptual hash) of the photo to keep, the largest one, first in its
+    group.
+    """
+    items = []  # A flat list of (size, path, st).
+    for size, paths in dupes_map.items():
+        for path in paths:
+            items.append((size, path, stats_map[path]))
+    with utils.phase_stats.phase('stage "{}"'.format(STAGE_PERCEPTUAL)):
+        utils.print_msg('\n> Stage "{}": hashing {} photos with the {} backend...'.format(
+            STAGE_PERCEPTUAL, len(items), image_hash_backend))
+        checksums, _ = _get_checksums(
+            [(size, os.path.join(root, path), st) for size, path, st in items], 'dhash:{}'.format(image_hash_backend),
+            _make_perceptual_task, use_processes=do_use_processes, msg='> Hashing image for: {}')
+        utils.phase_stats.count('files', len(items))
+    n_failed = 0
+    sizes_and_paths_by_hash = defaultdict(list)
+    for (size, path, _), checksum in zip(items, checksums):
+        if not checksum:
+            n_failed += 1
+            continue
+        perceptual_hashes[path] = int(checksum, 16)
+        sizes_and_paths_by_hash[perceptual_hashes[path]].append((size, path))
+    if n_failed:
+        utils.print_msg('> Could not decode {} photos (eg. progressive JPEGs with the pure backend)'.format(n_failed))
+
+    with utils.phase_stats.phase('group similar'):
+        utils.print_msg('\n> Grouping {} distinct perceptual hashes within a distance of {}...'.format(
+            len(sizes_and_paths_by_hash), similar_max_distance))
+        parents = {}  # Union-find of the hashes.
+
+        def find_root(hashval):
+            while parents[hashval] != hashval:
+                parents[hashval] = parents[parents[hashval]]
+                hashval = parents[hashval]
+            return hashval
+
+        hamming_index = utils.HammingIndex(list(sizes_and_paths_by_hash), similar_max_distance)
+        for hashval in sorted(sizes_and_paths_by_hash):
+            parents.setdefault(hashval, hashval)
+            for _, near_hashval in hamming_index.find(hashval):
+                parents.setdefault(near_hashval, near_hashval)
+                parents[find_root(near_hashval)] = find_root(hashval)
+        groups = defaultdict(list)
+        for hashval, sizes_and_paths in sizes_and_paths_by_hash.items():
+            groups[find_root(hashval)].extend(sizes_and_paths)
+
+        new_dupes_map = OrderedDict()
+        for sizes_and_paths in groups.values():
+            if len(sizes_and_paths) < 2:
+                continue
+            sizes_and_paths.sort(key=lambda size_and_path: (-size_and_path[0], size_and_path[1]))
+            size, to_keep = sizes_and_paths[0]
+            new_dupes_map[(size, '{:016x}'.format(perceptual_hashes[to_keep]))] = [path for _, path in sizes_and_paths]
+    yield OrderedDict(sorted(new_dupes_map.items()))
+
+
+def _print_batch(i, batches):
+    if len(batches) > 1:
+        batch = batches[i]
+        utils.print_msg('\n> Batch {}/{}: {} files in {} groups, size bytes {} to {}'.format(
+            i + 1, len(batches), sum(len(paths) for _, paths in batch), len(batch), batch[0][0][0], batch[-1][0][0]))
+
+
+def _split_in_batches(groups):
+    batches = [[]]
+    n_files = 0
+    for group in groups:
+        if n_files >= BATCH_NUM_FILES:
+            batches.append([])
+            n_files = 0
+        batches[-1].append(group)
+        n_files += len(group[1])
+    return batches if groups else []
+
+
+BATCH_NUM_FILES = 10000
+
+STAGE_HEAD = 'head'
+STAGE_TAIL = 'tail'
+STAGE_CONTENT = 'content'
+STAGE_METADATA = 'metadata'
+STAGE_BYTES = 'bytes'
+STAGE_REFERENCE = 'reference'
+STAGE_PERCEPTUAL = 'perceptual'
+
+SIMILAR_PHOTOS_MAX_DISTANCE = 8
+
+
+def _get_stages():
+    if do_metadata_checksum_first:
+        return [STAGE_METADATA, STAGE_BYTES] if do_byte_compare else [STAGE_METADATA]
+    stages = [STAGE_HEAD, STAGE_TAIL] if partial_hash_size else []
+    return stages + [STAGE_BYTES if do_byte_compare else STAGE_CONTENT]
+
+
+def _is_stage_needed(stage, size):
+    # A partial checksum covering (almost) the whole file is not worth it: the full checksum is computed instead.
+    if stage == STAGE_HEAD:
+        return size > partial_hash_size
+    if stage == STAGE_TAIL:
+        return size > 2 * partial_hash_size
+    return True
+
+
+def _run_stage(stage, groups):
+    new_groups = [(key, paths) for key, paths in groups if not _is_stage_needed(stage, key[0])]
+    groups = [(key, paths) for key, paths in groups if _is_stage_needed(stage, key[0])]
+    if not groups:
+        return new_groups
+    total_num = sum(len(paths) for _, paths in groups)
+    utils.print_msg('\n> Stage "{}": comparing {} of {} files in {} groups...'.format(
+        stage, 'bytes' if stage == STAGE_BYTES else 'checksums', total_num, len(groups)))
+    if stage in (STAGE_CONTENT, STAGE_METADATA, STAGE_BYTES):
+        i = 1
+        for key, dupes in groups:
+            utils.print_msg('\n> [{}/{}] Comparing {} for files with the same size:\n{}'.format(
+                i, total_num, 'bytes' if stage == STAGE_BYTES else 'checksums', '\n'.join(dupes)))
+            i += len(dupes)
+    if stage == STAGE_BYTES:
+        checksums_and_dupes_by_group, bytes_read = _compare_bytes(groups)
+    elif stage == STAGE_CONTENT and tree_hash_chunk_size:
+        checksums_and_dupes_by_group, bytes_read = _compare_tree_hashes(groups)
+    else:
+        checksums, bytes_read = _compute_checksums(stage, groups)
+        checksums_and_dupes_by_group = [
+            _select_dupes_with_same_checksum(dupes, dupes_checksums)
+            for (_, dupes), dupes_checksums in zip(groups, checksums)]
+    bytes_saved = n_discarded = 0
+    for (key, dupes), checksums_and_dupes in zip(groups, checksums_and_dupes_by_group):
+        size = key[0]
+        n_kept = 0
+        for checksum, actual_dupes in checksums_and_dupes:
+            new_groups.append((key + (checksum,), actual_dupes))
+            n_kept += len(actual_dupes)
+        n_discarded += len(dupes) - n_kept
+        if stage == STAGE_HEAD:
+            bytes_saved += (len(dupes) - n_kept) * (size - partial_hash_size)
+        elif stage == STAGE_TAIL:
+            bytes_saved += (len(dupes) - n_kept) * (size - 2 * partial_hash_size)
+    utils.phase_stats.count('files', total_num)
+    utils.phase_stats.count('bytes_read', bytes_read)
+    msg = '> Stage "{}": read {:,} bytes, discarded {} files'.format(stage, bytes_read, n_discarded)
+    if stage in (STAGE_HEAD, STAGE_TAIL):
+        msg += ', saved {:,} bytes of full content reading'.format(bytes_saved)
+    utils.print_msg(msg)
+    return new_groups
+
+
+def _select_dupes_with_same_checksum(dupes, checksums):
+    """
+    Return a list of (checksum, dupes), sorted by checksum, without the files left alone.
+    """
     checksums_map = defaultdict(list)
-    for dupe in dupes:
-        full_path = os.path.join(root, dupe)
-        try:
-            hashval = _hash_metadata(full_path)
-        except (MetadataReadingError, SkipMetadataReadingOption) as ex:
-            if isinstance(ex, MetadataReadingError):
-                utils.print_msg('> Metadata reading failed for: {}\nHashing its content instead...'.format(dupe))
-            hashval = _hash_content(full_path)
-        checksums_map[hashval].append(dupe)
+    for dupe, checksum in zip(dupes, checksums):
+        checksums_map[checksum].append(dupe)
     _remove_non_dupes(checksums_map)
-    dupes = checksums_map.values()  # A list of lists.
-    if not dupes:
-        return []
-    if len(dupes) > 1:
-        utils.exit_with_error_msg('Found a group of files with the same size and subgroups of checksums, too weird!!')
-    return dupes[0]
+    return sorted(checksums_map.items())
 
 
-class MetadataReadingError(Exception):
-    pass
+def _compare_bytes(groups):
+    """
+    Compare the content of the files in each group in lockstep, chunk by chunk (exact, no checksum collisions).
+    Return a list of (label, dupes) for each group, and the number of bytes read. The label is the checksum of the
+    previous stage (or the size), followed by the index of the subgroup.
+    """
+    tasks = []
+    for key, dupes in groups:
+        full_paths = [os.path.join(root, dupe) for dupe in dupes]
+        tasks.append((stats_map[dupes[0]].st_dev, utils.group_identical_files, (full_paths,)))
+    results = utils.run_per_device(tasks, jobs, False, jobs_per_device)
+    labels_and_dupes_by_group = []
+    bytes_read = 0
+    for (key, dupes), (identical_groups, n_bytes) in zip(groups, results):
+        bytes_read += n_bytes
+        relative_paths = dict((os.path.join(root, dupe), dupe) for dupe in dupes)
+        labels_and_dupes_by_group.append([
+            ('{}#{}'.format(key[-1], i), [relative_paths[path] for path in identical_group])
+            for i, identical_group in enumerate(identical_groups)])
+    return labels_and_dupes_by_group, bytes_read
 
 
-class SkipMetadataReadingOption(Exception):
-    pass
+def _compare_tree_hashes(groups):
+    """
+    With `--tree-hash`: compare the files of each group by the tree hash of their full content.
+    The files up to 1 chunk are hashed as a whole, as without the option. The bigger ones are compared chunk by chunk,
+    see `_compare_tree_hashes_of_group`.
+    Return a list of (checksum, dupes) for each group, and the number of bytes read.
+    """
+    small_groups = [(key, dupes) for key, dupes in groups if key[0] <= tree_hash_chunk_size]
+    small_checksums_and_dupes = iter([])
+    bytes_read = 0
+    if small_groups:
+        checksums_by_group, bytes_read = _compute_checksums(STAGE_CONTENT, small_groups)
+        small_checksums_and_dupes = iter([_select_dupes_with_same_checksum(dupes, dupes_checksums)
+                                          for (_, dupes), dupes_checksums in zip(small_groups, checksums_by_group)])
+    checksums_and_dupes_by_group = []
+    for key, dupes in groups:
+        if key[0] <= tree_hash_chunk_size:
+            checksums_and_dupes_by_group.append(next(small_checksums_and_dupes))
+        else:
+            checksums_and_dupes, n_bytes = _compare_tree_hashes_of_group(key[0], dupes)
+            checksums_and_dupes_by_group.append(checksums_and_dupes)
+            bytes_read += n_bytes
+    return checksums_and_dupes_by_group, bytes_read
 
 
-def _hash_metadata(path):
-    if not do_metadata_checksum_first:
-        raise SkipMetadataReadingOption
-    utils.print_msg('> Reading and hashing metadata for: {}'.format(path))
-    # Eg.: $ sips -g all file.jpg | tail -n +2
-    cmd = '{} -g all "{}" | {} -n +2'.format(
-        SIPS_CMD, path, TAIL_CMD)
-    output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT).rstrip()
-    if 'error' in output.lower():
-        raise MetadataReadingError
-    # Eg.: $ md5 -q "string"
-    cmd = '{} "{}"'.format(CHECKSUMSTRING_CMD, output)
-    hashval = subprocess.check_output(cmd, shell=True).rstrip()
-    return hashval
+def _compare_tree_hashes_of_group(size, dupes):
+    """
+    Compare the files of a group (with the same size), in rounds of chunks: in each round the next chunks of all the
+    files still with a match are hashed in parallel, at least one chunk per file and as many as needed to keep all the
+    `--jobs` busy, and the files are split by the digests of their chunks. A file is not read any further as soon as it
+    differs from all the others.
+    The digests of the chunks are stored in the cache (also for the files discarded halfway: a prefix), and only the
+    missing ones are computed.
+    Return a list of (checksum, dupes), sorted by checksum, where the checksum is the root digest of the tree hash;
+    and the number of bytes read.
+    """
+    kind = 'chunks:{}:{}'.format(tree_hash_chunk_size, hash_algorithm)
+    n_chunks = utils.get_num_chunks(size, tree_hash_chunk_size)
+    chunk_digests = {}  # Path -> digests of its first chunks.
+    n_cached_chunks = {}
+    for dupe in dupes:
+        cached = hash_cache.get(stats_map[dupe], kind) if hash_cache else None
+        if hash_cache:
+            utils.phase_stats.count('cache_hits' if cached else 'cache_misses')
+        chunk_digests[dupe] = cached.split() if cached else []
+        n_cached_chunks[dupe] = len(chunk_digests[dupe])
+        if n_cached_chunks[dupe] < n_chunks:
+            utils.print_msg('> Tree hashing content for: {}'.format(os.path.join(root, dupe)))
 
+    bytes_read = 0
+    subgroups = [dupes]
+    chunk_idx = 0
+    while subgroups and chunk_idx < n_chunks:
+        n_files = sum(len(subgroup) for subgroup in subgroups)
+        end_idx = min(n_chunks, chunk_idx + max(1, -(-jobs // n_files)))
+        tasks = []
+        task_dupes = []
+        for subgroup in subgroups:
+            for dupe in subgroup:
+                # The chunks are hashed in order, so the missing ones come after the cached ones.
+                for i in range(len(chunk_digests[dupe]), end_idx):
+                    tasks.append((stats_map[dupe].st_dev, utils.hash_chunk,
+                                  (os.path.join(root, dupe), hash_algorithm, i, tree_hash_chunk_size)))
+                    task_dupes.append(dupe)
+                    bytes_read += utils.get_chunk_length(size, i, tree_hash_chunk_size)
+        results = utils.run_per_device(tasks, jobs, do_use_processes, jobs_per_device)
+        for dupe, chunk_digest in zip(task_dupes, results):
+            chunk_digests[dupe].append(chunk_digest)
+        new_subgroups = []
+        for subgroup in subgroups:
+            subgroups_map = defaultdict(list)
+            for dupe in subgroup:
+                subgroups_map[tuple(chunk_digests[dupe][chunk_idx:end_idx])].append(dupe)
+            new_subgroups.extend(new_subgroup for new_subgroup in subgroups_map.values() if len(new_subgroup) > 1)
+        subgroups = new_subgroups
+        chunk_idx = end_idx
 
-def _hash_content(path):
-    utils.print_msg('> Hashing content for: {}'.format(path))
-    # Eg.: $ md5 -q "file.mov"
-    cmd = '{} "{}"'.format(CHECKSUMFILE_CMD, path)
-    hashval = subprocess.check_output(cmd, shell=True).rstrip()
-    return hashval
+    if hash_cache:
+        for dupe in dupes:
+            if len(chunk_digests[dupe]) > n_cached_chunks[dupe]:
+                hash_cache.set(stats_map[dupe], kind, ' '.join(chunk_digests[dupe]), os.path.join(root, dupe))
+    checksums_and_dupes = [(utils.get_tree_digest(chunk_digests[subgroup[0]][:n_chunks], hash_algorithm), subgroup)
+                           for subgroup in subgroups]
+    return sorted(checksums_and_dupes), bytes_read
 
 
-def _print_dupes(dupes_map):
-    global extensions
-    if not dupes_map:
-        utils.print_msg('No dupes')
-        return
-    for size, paths in dupes_map.items():
-        utils.print_msg('> Dupes found, size bytes {} and same metadata or content:\n{}\n'.format(size, '\n'.join(paths)))
+def _compute_checksums(stage, groups):
+    """
+    Return the checksums of the files in `groups` (a list of checksums for each group) and the number of bytes read.
+    """
+    items = []  # A flat list of (size, path, st).
+    for key, dupes in groups:
+        for dupe in dupes:
+            items.append((key[0], os.path.join(root, dupe), stats_map[dupe]))
+
+    if stage == STAGE_HEAD:
+        checksums, bytes_read = _get_checksums(
+            items, 'head:{}:{}'.format(partial_hash_size, hash_algorithm), _make_head_task)
+    elif stage == STAGE_TAIL:
+        checksums, bytes_read = _get_checksums(
+            items, 'tail:{}:{}'.format(partial_hash_size, hash_algorithm), _make_tail_task)
+    else:
+        checksums = [None] * len(items)
+        if stage == STAGE_METADATA:
+            checksums, _ = _get_checksums(
+                items, 'metadata:v2', _make_metadata_task, msg='> Reading and hashing metadata for: {}')
+        failed_idxs = [i for i, checksum in enumerate(checksums) if not checksum]
+        if stage == STAGE_METADATA:
+            for i in failed_idxs:
+                utils.print_msg('> Metadata reading failed for: {}\nHashing its content instead...'.format(
+                    items[i][1]))
+        kind = 'content:cmd' if do_use_checksum_cmd else 'content:{}'.format(hash_algorithm)
+        content_checksums, bytes_read = _get_checksums(
+            [items[i] for i in failed_idxs], kind, _make_content_task, use_processes=do_use_processes,
+            msg='> Hashing content for: {}')
+        for i, checksum in zip(failed_idxs, content_checksums):
+            checksums[i] = checksum
+
+    # Split the flat list in a list for each group.
+    checksums_by_group = []
+    start = 0
+    for key, dupes in groups:
+        checksums_by_group.append(checksums[start:start + len(dupes)])
+        start += len(dupes)
+    return checksums_by_group, bytes_read
+
+
+def _get_checksums(items, kind, make_task, use_processes=False, msg=None):
+    """
+    Return the checksums of `items`, a list of (size, path, st), and the number of bytes read.
+    The cache is consulted before reading any file. The other checksums are computed by the tasks returned by
+    `make_task(size, path)`, in a pool of `--jobs` workers.
+    """
+    checksums = [None] * len(items)
+    tasks = []
+    task_idxs = []
+    bytes_read = 0
+    for i, (size, path, st) in enumerate(items):
+        if hash_cache:
+            checksums[i] = hash_cache.get(st, kind)
+            utils.phase_stats.count('cache_misses' if checksums[i] is None else 'cache_hits')
+        if checksums[i] is None:
+            if msg:
+                utils.print_msg(msg.format(path))
+            func, args, n_bytes = make_task(size, path)
+            tasks.append((st.st_dev, func, args))
+            task_idxs.append(i)
+            bytes_read += n_bytes
+    results = utils.run_per_device(tasks, jobs, use_processes, jobs_per_device)
+    for i, checksum in zip(task_idxs, results):
+        checksums[i] = checksum
+        if hash_cache:
+            _, path, st = items[i]
+            hash_cache.set(st, kind, checksum, path)
+    return checksums, bytes_read
+
+
+def _make_head_task(size, path):
+    return utils.hash_file, (path, hash_algorithm, 0, partial_hash_size), partial_hash_size
+
+
+def _make_tail_task(size, path):
+    return utils.hash_file, (path, hash_algorithm, size - partial_hash_size, partial_hash_size), partial_hash_size
+
+
+def _make_content_task(size, path):
+    if do_use_checksum_cmd:
+        utils.phase_stats.count('subprocesses')
+        return utils.hash_file_with_cmd, (path, CHECKSUMFILE_CMD), size
+    return utils.hash_file, (path, hash_algorithm), size
+
+
+def _make_metadata_task(size, path):
+    return _hash_metadata_or_empty, (path,), 0
+
+
+def _hash_metadata_or_empty(path):
+    # An empty checksum marks a failure, so it can be cached as well.
+    try:
+        return utils.hash_media_metadata(path)
+    except utils.MetadataReadingError:
+        return ''
+
+
+def _make_perceptual_task(size, path):
+    return _dhash_or_empty, (path, image_hash_backend), 0
+
+
+def _dhash_or_empty(path, backend):
+    # An empty checksum marks a failure, so it can be cached as well.
+    try:
+        return utils.dhash_image(path, backend)
+    except utils.ImageHashError:
+        return ''
+
+
+def _collect_extensions(dupes_map):
+    for paths in dupes_map.values():
         for path in paths:
             ext = path[path.rfind('.'):]
             extensions.add(ext)
-    utils.print_msg('>>>>> Extensions found in dupes: {}'.format(' '.join(extensions)))
+
+
+def _print_dupes(dupes_map):
+    if output_format != 'text':
+        return
+    for (size, checksum), paths in dupes_map.items():
+        lines = []
+        for path in paths:
+            lines.append(path)
+            for hardlink in hardlinks_map.get(path, []):
+                lines.append('{} (hardlink of: {})'.format(hardlink, path))
+        if reference_roots:
+            lines[0] += ' (reference)'
+            utils.print_msg('\n> Already in the reference dirs, size bytes {}:\n{}'.format(size, '\n'.join(lines)))
+            continue
+        if similar_max_distance is not None:
+            for path in paths[1:]:
+                distance = utils.hamming_distance(perceptual_hashes[paths[0]], perceptual_hashes[path])
+                lines[lines.index(path)] += ' (distance: {})'.format(distance)
+            utils.print_msg('\n> Similar photos found, the first one is the largest:\n{}'.format('\n'.join(lines)))
+            continue
+        utils.print_msg('\n> Dupes found, size bytes {} and same metadata or content:\n{}'.format(size, '\n'.join(lines)))
+
+
+def _open_dupes_writer():
+    global dupes_writer
+    if output_format == 'text':
+        return
+    dupes_writer = utils.DupesWriter(output_format, output_path).open()
+
+
+def _write_dupes(dupes_map):
+    if not dupes_writer:
+        return
+    for (size, checksum), paths in dupes_map.items():
+        files = []
+        for path in paths:
+            for to_write in [path] + hardlinks_map.get(path, []):
+                files.append((os.path.join(root, to_write), stats_map[to_write]))
+        dupes_writer.write_group(size, checksum, files)
+    # Flushed at every batch, so the groups can be consumed while the scan is still running.
+    dupes_writer.flush()
+
+
+def _close_dupes_writer():
+    if not dupes_writer:
+        return
+    dupes_writer.close()
+    if output_path not in (None, '-'):
+        utils.print_msg('\n> Wrote {} groups of dupes to: {}'.format(dupes_writer.n_groups, output_path))
 
 
 def _write_rm_script(dupes_map):
     """
-    Format:
+    Append the dupes to the rm script, created at the first call. Format:
     ```
     #! /bin/bash
 
-    # Keep: "/home/me/dupes/dir1/4.jpg"
-    rm "/home/me/dupes/dir2/4.jpg"
-    rm "/home/me/dupes/dir3/4.jpg"
+    # Keep: '/home/me/dupes/dir1/4.jpg'
+    rm '/home/me/dupes/dir2/4.jpg'
+    rm '/home/me/dupes/dir3/4.jpg'
+
+    # Keep: '/home/me/dupes/dir1/2.jpg'
+    rm '/home/me/dupes/dir2/2.jpg'
 
-    # Keep: "/home/me/dupes/dir1/2.jpg"
-    rm "/home/me/dupes/dir2/2.jpg"
+    # >>>>> Extensions found in dupes: .jpg
     ```
     """
-    utils.print_msg('\n> Writing rm script...')
+    global rm_script
     if not dupes_map:
-        utils.print_msg('No dupes')
         return
-    now = datetime.datetime.now()
-    path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'rm_dupes_{}.sh'.format(now.strftime("%Y-%m-%d-%Hh%Mm")))
-    with open(path, 'w') as fout:
-        fout.write('#! /bin/bash\n')
-        fout.write('# >>>>> Extensions found in dupes: {}\n'.format(' '.join(extensions)))
-        for check, paths in dupes_map.items():
-            to_keep = paths[0]
-            del paths[0]
-            fout.write('\n# Keep: "{}"\n'.format(os.path.join(root, to_keep)))
-            for to_remove in paths:
-                fout.write('rm "{}"\n'.format(os.path.join(root, to_remove)))
+    if rm_script is None:
+        now = datetime.datetime.now()
+        path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'rm_dupes_{}.sh'.format(now.strftime("%Y-%m-%d-%Hh%Mm")))
+        utils.print_msg('\n> Writing rm script: {}'.format(path))
+        rm_script = utils.open_bash_script(path)
+        if similar_max_distance is not None:
+            rm_script.write('\n# Similar photos, not identical: check them before running this script.\n')
+    for check, paths in dupes_map.items():
+        to_keep = paths[0]
+        rm_script.write('\n# Keep: {}\n'.format(utils.quote_for_bash(os.path.join(root, to_keep))))
+        for hardlink in hardlinks_map.get(to_keep, []):
+            rm_script.write('# Keep hardlink: {}\n'.format(utils.quote_for_bash(os.path.join(root, hardlink))))
+        for path in paths[1:]:
+            # All the paths to the inode must be removed to reclaim its space.
+            for to_remove in [path] + hardlinks_map.get(path, []):
+                rm_script.write('rm {}\n'.format(utils.quote_for_bash(os.path.join(root, to_remove))))
+    rm_script.flush()
+
+
+def _close_rm_script():
+    global rm_script
+    if rm_script is None:
+        return
+    # The extensions are known only at the end.
+    # An extension with a line end would end the comment: quoted like a path.
+    rm_script.write('\n# >>>>> Extensions found in dupes: {}\n'.format(' '.join(
+        utils.quote_for_bash(ext) if '\n' in ext or '\r' in ext else ext for ext in sorted(extensions))))
+    rm_script.close()
+    rm_script = None
+
+
+def _open_plan_executor():
+    global plan_executor
+    if not apply_action:
+        return
+    plan_executor = utils.PlanExecutor(apply_action, quarantine_dir, do_dry_run, undo_log_path).open()
+    if do_dry_run:
+        utils.print_msg('\n> Dry run of "{}": the dupes are only checked, nothing is changed'.format(apply_action))
+    else:
+        utils.print_msg('\n> Applying "{}" to the dupes, writing the undo log: {}'.format(apply_action, undo_log_path))
+
+
+def _apply_dupes(dupes_map):
+    """
+    Act on the dupes of a batch: the first path of each group is kept.
+    """
+    for (size, checksum), paths in dupes_map.items():
+        keep_files = [_get_plan_file(path) for path in [paths[0]] + hardlinks_map.get(paths[0], [])]
+        # All the paths to the inode must be acted on to reclaim its space.
+        remove_files = [_get_plan_file(to_remove)
+                        for path in paths[1:] for to_remove in [path] + hardlinks_map.get(path, [])]
+        utils.phase_stats.count('files_stated', len(remove_files))
+        plan_executor.add_group(size, keep_files, remove_files)
+    plan_executor.flush()
+
+
+def _get_plan_file(path):
+    st = stats_map[path]
+    return {'path': os.path.join(root, path), 'dev': st.st_dev, 'inode': st.st_ino, 'mtime_ns': utils.get_mtime_ns(st)}
+
+
+def _close_plan_executor():
+    if not plan_executor:
+        return
+    plan_executor.close()
+    utils.print_msg('> {} "{}" to {} files, skipped {} changed since the scan, failed {}'.format(
+        'Would apply' if do_dry_run else 'Applied', apply_action, plan_executor.n_done, plan_executor.n_skipped,
+        plan_executor.n_failed))
+    utils.print_msg('> Bytes {}reclaimed: {:,}'.format('that would be ' if do_dry_run else '',
+                                                       plan_executor.bytes_reclaimed))
 
 
 if __name__ == '__main__':
+    parse_args()
     utils.print_msg('DEDUPE FILES')
     utils.print_msg('============')
 
-    parse_args()
-    find_dupes()
+    utils.run_with_stats(find_dupes)
 
     utils.print_msg('\nNo errors - DONE')
     sys.exit(0)
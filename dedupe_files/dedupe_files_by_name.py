@@ -5,59 +5,161 @@ checksum of the content is compared.
 
 The root dir can contain many files and subdirs.
 The duplicated files are printed in output.
-It is a wrapper around the commands:
-$ find root -type f ! -path "*@eaDir*" ! -name '.DS_Store' -printf "%f\t%s\n" | sort | uniq -d
-$ md5 -q myfile.jpg
+The root is walked once, to index all files by (name, size): only the names and sizes shared by 2 or more files are
+kept. Then the files in those groups are hashed in-process, in batches of many groups, in parallel with `--jobs` (with
+a limit of concurrent reads for each disk). Checksums are looked up in the persistent cache of `dedupe_files.py` first.
 
 Usage:
-    $ ./dedupe_files_by_name.py [--write-rm-script] [--exclude-pathname="*.iso"] root
+    $ ./dedupe_files_by_name.py [--write-rm-script] [--exclude-pathname="*.iso"] [--hash-algorithm=md5]
+                                [--checksum-cmd] [--no-cache] [--cache-path=~/.cache/nasutils/hashes.sqlite]
+                                [--jobs=1] [--jobs-per-device=N] [--output-format=ndjson] [--output=dupes.ndjson]
+                                [--stats] [--stats-json=stats.json] [--profile=dedupe_files_by_name.pstats] root
 Options:
     --write-rm-script       Write a Bash script for the actual deletion of duplicated files
     --exclude-pathname      Exclude files with this name in their path.
                             Eg. to exclude a subdir: -exclude-pathname="*/my subdir/*"
                             Eg. to exclude all *.iso files: -exclude-pathname="*.iso"
                             This option can be used multiple times.
+    --hash-algorithm        The algorithm used to hash the content: md5 (default), sha1, sha256, blake2b.
+    --checksum-cmd          Hash the content with the external command `checksumfile-cmd` in config.ini
+                            (eg. `md5 -q`), a process per file, instead of in-process.
+    --no-cache              Do not read nor write the persistent cache of checksums.
+    --cache-path            The path of the persistent cache of checksums (a SQLite db).
+                            Default: ~/.cache/nasutils/hashes.sqlite
+    --jobs                  The number of files hashed in parallel. Default: 1.
+    --jobs-per-device       The max number of files hashed in parallel on the same device (st_dev).
+                            Default: 1 for spinning disks (detected on Linux only), --jobs otherwise.
+    --output-format         The format of the dupes found: text (default), ndjson (one JSON object per group, with
+                            size, hash, and path, dev and inode of each file) or csv (one row per file).
+                            Each group is written as soon as it is confirmed. With ndjson or csv written to stdout,
+                            all the other messages are printed to stderr.
+    --output                The file where the dupes are written with --output-format=ndjson or csv.
+                            Default: stdout.
+    --stats                 Print a table with the cost of each phase at exit: wall and CPU time, files, bytes
+                            read, subprocesses spawned, MB/s and files/s.
+    --stats-json            Write the stats of each phase to this JSON file.
+    --profile               Run under cProfile and write the stats to this .pstats file.
+                            Default: dedupe_files_by_name.pstats
 
 Note: the format for the Bash script created with the option `--write-rm-script` is:
 ```
 #! /bin/bash
 
-# Keep: "/home/me/dupes/dir1/4.jpg"
-rm "/home/me/dupes/dir2/4.jpg"
-rm "/home/me/dupes/dir3/4.jpg"
+# Keep: '/home/me/dupes/dir1/4.jpg'
+rm '/home/me/dupes/dir2/4.jpg'
+rm '/home/me/dupes/dir3/4.jpg'
 
-# Keep: "/home/me/dupes/dir1/2.jpg"
-rm "/home/me/dupes/dir2/2.jpg"
+# Keep: '/home/me/dupes/dir1/2.jpg'
+rm '/home/me/dupes/dir2/2.jpg'
 ```
 """
 import datetime
 import os
-import subprocess
 import sys
-from collections import defaultdict
+from collections import OrderedDict
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 import utils
 
 
-FIND_CMD = utils.config.get('main', 'find-cmd')
-WC_CMD = utils.config.get('main', 'wc-cmd')
-SORT_CMD = utils.config.get('main', 'sort-cmd')
-UNIQ_CMD = utils.config.get('main', 'uniq-cmd')
 CHECKSUMFILE_CMD = utils.config.get('main', 'checksumfile-cmd')
+BATCH_NUM_FILES = 1000  # Files hashed in the same batch, from many groups.
 
 
 do_write_rm_script = False
 exclude_pathnames = []
+output_format = 'text'
+output_path = None
+hash_algorithm = utils.DEFAULT_HASH_ALGORITHM
+do_use_checksum_cmd = False
+do_use_hash_cache = True
+hash_cache_path = None
+jobs = 1
+jobs_per_device = None
 
 
 def parse_args():
+    # Handle '--stats', '--stats-json' and '--profile' options.
+    utils.parse_stats_options(sys.argv)
+
     # Handle '--write-rm-script' option.
     if '--write-rm-script' in sys.argv:
         sys.argv.remove('--write-rm-script')
         global do_write_rm_script
         do_write_rm_script = True
 
+    # Handle '--output-format' and '--output' options.
+    for argv in sys.argv:
+        if argv.startswith('--output-format'):
+            global output_format
+            output_format = argv.split('=')[1]
+            sys.argv.remove(argv)
+            break
+    if output_format not in utils.OUTPUT_FORMATS:
+        utils.exit_with_error_msg('Invalid value for --output-format: {}, valid values: {}'.format(
+            output_format, ', '.join(utils.OUTPUT_FORMATS)))
+    for argv in sys.argv:
+        if argv.startswith('--output='):
+            global output_path
+            output_path = argv.split('=', 1)[1]
+            sys.argv.remove(argv)
+            break
+    if output_path and output_format == 'text':
+        utils.exit_with_error_msg('Option --output requires --output-format=ndjson or --output-format=csv')
+    if output_format != 'text' and output_path in (None, '-'):
+        # Stdout is for the dupes only.
+        utils.print_msgs_to_stderr()
+
+    # Handle '--checksum-cmd' option.
+    if '--checksum-cmd' in sys.argv:
+        sys.argv.remove('--checksum-cmd')
+        global do_use_checksum_cmd
+        do_use_checksum_cmd = True
+
+    # Handle '--hash-algorithm' option.
+    for argv in sys.argv:
+        if argv.startswith('--hash-algorithm'):
+            global hash_algorithm
+            hash_algorithm = argv.split('=')[1]
+            sys.argv.remove(argv)
+            break
+    if hash_algorithm not in utils.HASH_ALGORITHMS:
+        utils.exit_with_error_msg('Invalid hash algorithm: {}, valid values: {}'.format(
+            hash_algorithm, ', '.join(utils.HASH_ALGORITHMS)))
+    if not utils.is_hash_algorithm_available(hash_algorithm):
+        utils.exit_with_error_msg('Hash algorithm not available in this Python: {}'.format(hash_algorithm))
+    if do_use_checksum_cmd and hash_algorithm != utils.DEFAULT_HASH_ALGORITHM:
+        utils.exit_with_error_msg('Options --checksum-cmd and --hash-algorithm cannot be used together')
+
+    # Handle '--no-cache' and '--cache-path' options.
+    if '--no-cache' in sys.argv:
+        sys.argv.remove('--no-cache')
+        global do_use_hash_cache
+        do_use_hash_cache = False
+    for argv in sys.argv:
+        if argv.startswith('--cache-path'):
+            global hash_cache_path
+            hash_cache_path = os.path.abspath(os.path.expanduser(argv.split('=')[1]))
+            sys.argv.remove(argv)
+            break
+
+    # Handle '--jobs' and '--jobs-per-device' options.
+    global jobs, jobs_per_device
+    for argv in list(sys.argv):
+        for option in ('--jobs-per-device', '--jobs'):
+            if argv.startswith(option + '='):
+                try:
+                    value = int(argv.split('=')[1])
+                except ValueError:
+                    value = 0
+                if value < 1:
+                    utils.exit_with_error_msg('Invalid value for {}: {}'.format(option, argv.split('=')[1]))
+                if option == '--jobs':
+                    jobs = value
+                else:
+                    jobs_per_device = value
+                sys.argv.remove(argv)
+
     # Handle '--exclude-pathname' option. It can be used multiple times.
     idx_to_delete = []
     for i, argv in enumerate(sys.argv):
@@ -85,95 +187,191 @@ def parse_args():
 class Deduper(object):
     def __init__(self, root):
         self.root = root
-        self.checksums_dupes_map = defaultdict(list)
+        self.hash_cache = None
+        self.dupes_writer = None
+        self.rm_script = None
 
     def find_dupes(self):
-        exclude_pathnames_option = ''
-        for pathname in exclude_pathnames:
-            exclude_pathnames_option += '! -path "{}" '.format(pathname)
-        # Eg.: $ gfind root -type f ! -path "*@eaDir*" ! -name ".DS_Store" ! -path excludepathname -printf "%f\t%s\n" | sort | uniq -d
-        cmd = '{} "{}" -type f ! -path "*@eaDir*" ! -name ".DS_Store" {} -printf "%f\\t%s\\n" | {} | {} -d'.format(
-            FIND_CMD, self.root, exclude_pathnames_option, SORT_CMD, UNIQ_CMD)
-        output = subprocess.check_output(cmd, shell=True).rstrip()
-        if not output:
+        with utils.phase_stats.phase('walk'):
+            buckets = self._build_name_and_size_index()
+        n_files = sum(len(paths) for paths in buckets.values())
+        if not buckets:
             utils.print_msg('No dupes\n')
-        utils.print_msg('> Found {} files with one ore more potential duplicate (files with the same name and size)'.format(
-            output.count('\n')))
+        utils.print_msg('> Found {} files with one or more potential duplicate (files with the same name and size), '
+                        'in {} groups'.format(n_files, len(buckets)))
         utils.print_msg('\n> Comparing checksums...')
-        for line in output.splitlines():
-            if not line:
-                continue
-            filename, size = line.split('\t')
-            paths = self._find_all_duplicates_full_path(filename)
-            dupes = self._compare_checksums(paths)
-            self._print_dupes(dupes)
-        if do_write_rm_script:
-            self._write_rm_script()
-
-    def _find_all_duplicates_full_path(self, filename):
-        # Eg.: $ find root -type f ! -path "*@eaDir*" ! -name ".DS_Store" -name myfile.jpg
-        cmd = '{} "{}" -type f ! -path "*@eaDir*" ! -name ".DS_Store" -name "{}"'.format(
-            FIND_CMD, self.root, filename)
-        output = subprocess.check_output(cmd, shell=True).rstrip()
-        if not output:
-            utils.exit_with_error_msg('Couldn\'t find the actual duplicates for: {}'.format(filename))
-        paths = []
-        for line in output.splitlines():
-            paths.append(line.strip())
-        return paths
-
-    def _compare_checksums(self, paths):
-        checksum_dupes_map = defaultdict(list)
-        for path in paths:
-            # Eg.: $ md5 -q "myfile.jpg"
-            cmd = '{} "{}"'.format(CHECKSUMFILE_CMD, path)
-            output = subprocess.check_output(cmd, shell=True).rstrip()
-            if not output:
-                utils.exit_with_error_msg('Couldn\'t compute the checksum for: {}'.format(path))
-            checksum_dupes_map[output.strip()].append(path)
-        self.checksums_dupes_map.update(checksum_dupes_map)
-        return checksum_dupes_map
+        if do_use_hash_cache:
+            self.hash_cache = utils.HashCache(hash_cache_path).open()
+        if output_format != 'text':
+            self.dupes_writer = utils.DupesWriter(output_format, output_path).open()
+        # The groups are hashed in batches, so the workers are kept busy also when most groups have 2 files, and each
+        # group of dupes is reported as soon as its batch is done: nothing is kept in memory until the end.
+        batch = []
+        n_batch_files = 0
+        for key in sorted(buckets):
+            batch.append((key[1], buckets.pop(key)))
+            n_batch_files += len(batch[-1][1])
+            if n_batch_files >= BATCH_NUM_FILES:
+                self._process_batch(batch)
+                batch = []
+                n_batch_files = 0
+        self._process_batch(batch)
+        if self.dupes_writer:
+            self.dupes_writer.close()
+            if output_path not in (None, '-'):
+                utils.print_msg('> Wrote {} groups of dupes to: {}'.format(self.dupes_writer.n_groups, output_path))
+        if self.rm_script:
+            self.rm_script.close()
+        if self.hash_cache:
+            self.hash_cache.close()
+            utils.print_msg('\n> Hash cache: {} hits, {} misses'.format(self.hash_cache.hits, self.hash_cache.misses))
+
+    def _build_name_and_size_index(self):
+        """
+        Walk the root once, and return a dict: (name, size) -> relative paths, for the names and sizes shared by 2 or
+        more files. The files with a unique name and size are dropped while walking: only their first path is kept.
+        """
+        utils.print_msg('\n> Indexing all files by name and size...')
+        first_paths = {}  # (name, size) -> relative path of the first file found.
+        buckets = {}  # (name, size) -> relative paths, when shared by 2 or more files.
+        n_files = 0
+        for path, st in utils.iter_files(self.root, utils.NAS_EXCLUDE_PATHNAMES + tuple(exclude_pathnames),
+                                         utils.NAS_EXCLUDE_NAMES):
+            n_files += 1
+            key = (os.path.basename(path), st.st_size)
+            paths = buckets.get(key)
+            if paths is not None:
+                paths.append(path)
+            elif key in first_paths:
+                buckets[key] = [first_paths.pop(key), path]
+            else:
+                first_paths[key] = path
+        utils.phase_stats.count('files', n_files)
+        utils.phase_stats.count('files_stated', n_files)
+        utils.print_msg('> Found {} files'.format(n_files))
+        return buckets
+
+    def _process_batch(self, batch):
+        """
+        Compare the checksums of the files in each group of `batch`, a list of (size, relative paths), and report the
+        dupes found.
+        """
+        if not batch:
+            return
+        with utils.phase_stats.phase('checksums'):
+            checksums_by_group = self._compute_checksums(batch)
+        with utils.phase_stats.phase('report'):
+            for (size, _), checksums in zip(batch, checksums_by_group):
+                dupes = OrderedDict()  # Checksum -> list of (path, stat result).
+                for checksum, path, st in checksums:
+                    dupes.setdefault(checksum, []).append((path, st))
+                self._print_dupes(dupes)
+                self._write_dupes(size, dupes)
+                if do_write_rm_script:
+                    self._write_rm_script(dupes)
+
+    def _compute_checksums(self, batch):
+        """
+        Return a list for each group in `batch`, of (checksum, path, stat result) for each file. The files are stat'ed
+        again: the ones gone or with a different size since the walk are dropped. Hardlinks are hashed once.
+        The cache is consulted first, the other files are hashed in parallel, with a limit of concurrent reads for
+        each disk.
+        """
+        kind = 'content:cmd' if do_use_checksum_cmd else 'content:{}'.format(hash_algorithm)
+        groups = []
+        checksums_by_inode = {}
+        tasks = []
+        task_keys = []
+        for size, relative_paths in batch:
+            group = []
+            for relative_path in relative_paths:
+                path = os.path.join(self.root, relative_path)
+                utils.phase_stats.count('files_stated')
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    st = None
+                if st is None or st.st_size != size:
+                    utils.print_wrn('WARNING: changed since the walk, skipping: {}'.format(path))
+                    continue
+                group.append((path, st))
+                key = (st.st_dev, st.st_ino)
+                if key in checksums_by_inode:
+                    continue
+                checksums_by_inode[key] = self.hash_cache.get(st, kind) if self.hash_cache else None
+                if self.hash_cache:
+                    utils.phase_stats.count('cache_misses' if checksums_by_inode[key] is None else 'cache_hits')
+                if checksums_by_inode[key] is None:
+                    if do_use_checksum_cmd:
+                        tasks.append((st.st_dev, utils.hash_file_with_cmd, (path, CHECKSUMFILE_CMD)))
+                        utils.phase_stats.count('subprocesses')
+                    else:
+                        tasks.append((st.st_dev, utils.hash_file, (path, hash_algorithm)))
+                    task_keys.append((key, path, st))
+                    utils.phase_stats.count('files')
+                    utils.phase_stats.count('bytes_read', size)
+            groups.append(group)
+        results = utils.run_per_device(tasks, jobs, False, jobs_per_device)
+        for (key, path, st), checksum in zip(task_keys, results):
+            checksums_by_inode[key] = checksum
+            if self.hash_cache:
+                self.hash_cache.set(st, kind, checksum, path)
+        return [[(checksums_by_inode[(st.st_dev, st.st_ino)], path, st) for path, st in group] for group in groups]
 
     def _print_dupes(self, checksum_and_dupes):
-        for check, paths in checksum_and_dupes.items():
-            utils.print_msg('> Checksum {}:\n{}\n'.format(check, '\n'.join(paths)))
+        if output_format != 'text':
+            return
+        for check, files in checksum_and_dupes.items():
+            if len(files) < 2:
+                continue
+            utils.print_msg('> Checksum {}:\n{}\n'.format(check, '\n'.join(path for path, _ in files)))
 
-    def _write_rm_script(self):
+    def _write_dupes(self, size, checksum_and_dupes):
+        if not self.dupes_writer:
+            return
+        for check, files in checksum_and_dupes.items():
+            if len(files) < 2:
+                continue
+            self.dupes_writer.write_group(size, check, files)
+        self.dupes_writer.flush()
+
+    def _write_rm_script(self, checksum_and_dupes):
         """
-        Format:
+        Append the dupes to the rm script, created at the first call. Format:
         ```
         #! /bin/bash
 
-        # Keep: "/home/me/dupes/dir1/4.jpg"
-        rm "/home/me/dupes/dir2/4.jpg"
-        rm "/home/me/dupes/dir3/4.jpg"
+        # Keep: '/home/me/dupes/dir1/4.jpg'
+        rm '/home/me/dupes/dir2/4.jpg'
+        rm '/home/me/dupes/dir3/4.jpg'
 
-        # Keep: "/home/me/dupes/dir1/2.jpg"
-        rm "/home/me/dupes/dir2/2.jpg"
+        # Keep: '/home/me/dupes/dir1/2.jpg'
+        rm '/home/me/dupes/dir2/2.jpg'
         ```
         """
-        if not self.checksums_dupes_map:
-            return
-        now = datetime.datetime.now()
-        path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'rm_dupes_{}.sh'.format(now.strftime("%Y-%m-%d-%Hh%Mm")))
-        utils.print_msg('> Writing rm script...')
-        with open(path, 'w') as fout:
-            fout.write('#! /bin/bash\n')
-            for check, paths in self.sizes_dupes_map.items():
-                to_keep = paths[0]
-                del paths[0]
-                fout.write('\n# Keep: "{}"\n'.format(os.path.join(self.root, to_keep)))
-                for to_remove in paths:
-                    fout.write('rm "{}"\n'.format(os.path.join(self.root, to_remove)))
+        for check, files in checksum_and_dupes.items():
+            if len(files) < 2:
+                continue
+            if self.rm_script is None:
+                now = datetime.datetime.now()
+                path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'rm_dupes_{}.sh'.format(now.strftime("%Y-%m-%d-%Hh%Mm")))
+                utils.print_msg('> Writing rm script: {}'.format(path))
+                self.rm_script = utils.open_bash_script(path)
+            to_keep = files[0][0]
+            self.rm_script.write('\n# Keep: {}\n'.format(utils.quote_for_bash(to_keep)))
+            for to_remove, _ in files[1:]:
+                self.rm_script.write('rm {}\n'.format(utils.quote_for_bash(to_remove)))
+        if self.rm_script:
+            self.rm_script.flush()
 
 
 if __name__ == '__main__':
+    root = parse_args()
     utils.print_msg('DEDUPE FILES BY NAME')
     utils.print_msg('====================')
 
-    root = parse_args()
     deduper = Deduper(root)
-    deduper.find_dupes()
+    utils.run_with_stats(deduper.find_dupes)
 
     utils.print_msg('\nNo errors - DONE')
     sys.exit(0)
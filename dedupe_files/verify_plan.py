@@ -0,0 +1,266 @@
+#! /usr/bin/python
+"""
+Verify a dedupe plan before applying it: re-confirm that each file to remove is still identical to the file kept, by
+size and by checksum of the content. The plan is the NDJSON output of `dedupe_files.py` or `dedupe_files_by_name.py`
+(`--output-format=ndjson`), or an rm script written with `--write-rm-script`.
+
+The plan is read as a stream, in batches of pairs (kept file, file to remove). In each batch every file is stat'ed
+once, and the files with the same size as their kept file are hashed in parallel, with a limit of concurrent reads for
+each disk. Checksums are looked up in the same persistent cache of `dedupe_files.py` first: right after a scan,
+verifying a plan reads almost nothing.
+The pairs no longer identical are reported, one line each, and optionally written to an NDJSON report.
+
+Usage:
+    $ ./verify_plan.py [--hash-algorithm=md5] [--no-cache] [--cache-path=~/.cache/nasutils/hashes.sqlite] [--jobs=1]
+                       [--jobs-per-device=N] [--report=report.ndjson] [--stats] [--stats-json=stats.json]
+                       [--profile=verify_plan.pstats] plan.ndjson|rm_dupes.sh
+Options:
+    --hash-algorithm        The algorithm used to hash the content: md5 (default), sha1, sha256, blake2b.
+    --no-cache              Do not read nor write the persistent cache of checksums.
+    --cache-path            The path of the persistent cache of checksums (a SQLite db).
+                            Default: ~/.cache/nasutils/hashes.sqlite
+    --jobs                  The number of files hashed in parallel. Default: 1.
+    --jobs-per-device       The max number of files hashed in parallel on the same device (st_dev).
+                            Default: 1 for spinning disks (detected on Linux only), --jobs otherwise.
+    --report                Write the pairs no longer identical to this file, one JSON object per line:
+                            {"reason": "content differs", "keep": path, "remove": path}
+    --stats                 Print a table with the cost of each phase at exit: wall and CPU time, files listed
+                            and stat'ed, bytes read, subprocesses spawned, cache hits, MB/s and files/s.
+    --stats-json            Write the stats of each phase to this JSON file.
+    --profile               Run under cProfile and write the stats to this .pstats file.
+                            Default: verify_plan.pstats
+"""
+import io
+import json
+import os
+import sys
+from collections import OrderedDict
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import utils
+
+
+BATCH_NUM_PAIRS = 10000
+
+REASON_KEEP_MISSING = 'keep missing'
+REASON_MISSING = 'missing'
+REASON_SIZE = 'size differs'
+REASON_CONTENT = 'content differs'
+REASON_UNREADABLE = 'cannot be read'
+
+plan_path = None
+hash_algorithm = utils.DEFAULT_HASH_ALGORITHM
+do_use_hash_cache = True
+hash_cache_path = None
+hash_cache = None
+jobs = 1
+jobs_per_device = None
+report_path = None
+report = None
+n_failures_by_reason = OrderedDict((reason, 0) for reason in (
+    REASON_KEEP_MISSING, REASON_MISSING, REASON_SIZE, REASON_CONTENT, REASON_UNREADABLE))
+
+
+def parse_args():
+    # Handle '--stats', '--stats-json' and '--profile' options.
+    utils.parse_stats_options(sys.argv)
+
+    # Handle '--hash-algorithm' option.
+    for argv in sys.argv:
+        if argv.startswith('--hash-algorithm'):
+            global hash_algorithm
+            hash_algorithm = argv.split('=')[1]
+            sys.argv.remove(argv)
+            break
+    if hash_algorithm not in utils.HASH_ALGORITHMS:
+        utils.exit_with_error_msg('Invalid hash algorithm: {}, valid values: {}'.format(
+            hash_algorithm, ', '.join(utils.HASH_ALGORITHMS)))
+    if not utils.is_hash_algorithm_available(hash_algorithm):
+        utils.exit_with_error_msg('Hash algorithm not available in this Python: {}'.format(hash_algorithm))
+
+    # Handle '--no-cache' and '--cache-path' options.
+    if '--no-cache' in sys.argv:
+        sys.argv.remove('--no-cache')
+        global do_use_hash_cache
+        do_use_hash_cache = False
+    for argv in sys.argv:
+        if argv.startswith('--cache-path'):
+            global hash_cache_path
+            hash_cache_path = os.path.abspath(os.path.expanduser(argv.split('=')[1]))
+            sys.argv.remove(argv)
+            break
+
+    # Handle '--jobs' and '--jobs-per-device' options.
+    global jobs, jobs_per_device
+    for argv in list(sys.argv):
+        for option in ('--jobs-per-device', '--jobs'):
+            if argv.startswith(option + '='):
+                try:
+                    value = int(argv.split('=')[1])
+                except ValueError:
+                    value = 0
+                if value < 1:
+                    utils.exit_with_error_msg('Invalid value for {}: {}'.format(option, argv.split('=')[1]))
+                if option == '--jobs':
+                    jobs = value
+                else:
+                    jobs_per_device = value
+                sys.argv.remove(argv)
+
+    # Handle '--report' option.
+    for argv in sys.argv:
+        if argv.startswith('--report'):
+            global report_path
+            report_path = os.path.abspath(os.path.expanduser(argv.split('=', 1)[1]))
+            sys.argv.remove(argv)
+            break
+
+    global plan_path
+    try:
+        plan_path = os.path.abspath(sys.argv[1])
+    except IndexError:
+        utils.exit_with_error_msg('Please provide a plan or an rm script as argument')
+    if not os.path.isfile(plan_path):
+        utils.exit_with_error_msg('Please provide a valid plan or rm script')
+
+
+def verify_plan():
+    global hash_cache, report
+    if do_use_hash_cache:
+        hash_cache = utils.HashCache(hash_cache_path).open()
+    if report_path:
+        report = io.open(report_path, 'wb')
+    utils.print_msg('\n> Verifying: {}'.format(plan_path))
+    n_pairs = 0
+    pairs = []  # A batch of (kept path, path to remove).
+    for pair in _iter_pairs():
+        pairs.append(pair)
+        if len(pairs) >= BATCH_NUM_PAIRS:
+            _verify_pairs(pairs)
+            n_pairs += len(pairs)
+            utils.print_msg('> Verified {} pairs...'.format(n_pairs))
+            pairs = []
+    _verify_pairs(pairs)
+    n_pairs += len(pairs)
+
+    if report:
+        report.close()
+    if hash_cache:
+        hash_cache.close()
+    n_failures = sum(n_failures_by_reason.values())
+    utils.print_msg('\n> Verified {} pairs: {} identical, {} not'.format(n_pairs, n_pairs - n_failures, n_failures))
+    for reason, n in n_failures_by_reason.items():
+        if n:
+            utils.print_msg('> {}: {}'.format(reason, n))
+    if report_path:
+        utils.print_msg('> Report written to: {}'.format(report_path))
+    if hash_cache:
+        utils.print_msg('> Hash cache: {} hits, {} misses'.format(hash_cache.hits, hash_cache.misses))
+
+
+def _iter_pairs():
+    """
+    Yield (kept path, path to remove) for each file to remove in the plan or rm script.
+    """
+    with open(plan_path, 'rb') as fin:
+        is_rm_script = fin.read(2) == b'#!'
+    if is_rm_script:
+        for keep_path, remove_paths in utils.iter_rm_script(plan_path):
+            for remove_path in remove_paths:
+                yield keep_path, remove_path
+        return
+    for _, _, keep_files, remove_files in utils.iter_plan(plan_path):
+        for remove_file in remove_files:
+            yield keep_files[0]['path'], remove_file['path']
+
+
+def _verify_pairs(pairs):
+    if not pairs:
+        return
+    with utils.phase_stats.phase('stat'):
+        stats_map = {}  # Path -> stat result, or None if missing.
+        for keep_path, remove_path in pairs:
+            for path in (keep_path, remove_path):
+                if path not in stats_map:
+                    utils.phase_stats.count('files_stated')
+                    try:
+                        stats_map[path] = os.lstat(path)
+                    except OSError:
+                        stats_map[path] = None
+
+    to_hash = []  # Pairs with the same size, to be compared by content.
+    for keep_path, remove_path in pairs:
+        keep_st, remove_st = stats_map[keep_path], stats_map[remove_path]
+        if keep_st is None:
+            _report(REASON_KEEP_MISSING, keep_path, remove_path)
+        elif remove_st is None:
+            _report(REASON_MISSING, keep_path, remove_path)
+        elif keep_st.st_size != remove_st.st_size:
+            _report(REASON_SIZE, keep_path, remove_path)
+        elif (keep_st.st_dev, keep_st.st_ino) != (remove_st.st_dev, remove_st.st_ino):  # Else: a hardlink.
+            to_hash.append((keep_path, remove_path))
+
+    with utils.phase_stats.phase('hash'):
+        checksums = _get_checksums(set(path for pair in to_hash for path in pair), stats_map)
+    for keep_path, remove_path in to_hash:
+        if checksums[keep_path] is None or checksums[remove_path] is None:
+            _report(REASON_UNREADABLE, keep_path, remove_path)
+        elif checksums[keep_path] != checksums[remove_path]:
+            _report(REASON_CONTENT, keep_path, remove_path)
+
+
+def _get_checksums(paths, stats_map):
+    """
+    Return a dict: path -> checksum of its content, or None if it cannot be read. Paths to the same inode are hashed
+    once. The cache is consulted first, the other files are hashed in parallel.
+    """
+    kind = 'content:{}'.format(hash_algorithm)
+    checksums_by_inode = {}
+    tasks = []
+    task_keys = []
+    for path in sorted(paths):
+        st = stats_map[path]
+        key = (st.st_dev, st.st_ino)
+        if key in checksums_by_inode:
+            continue
+        checksums_by_inode[key] = hash_cache.get(st, kind) if hash_cache else None
+        if hash_cache:
+            utils.phase_stats.count('cache_misses' if checksums_by_inode[key] is None else 'cache_hits')
+        if checksums_by_inode[key] is None:
+            tasks.append((st.st_dev, _hash_file_or_none, (path, hash_algorithm)))
+            task_keys.append((key, path))
+            utils.phase_stats.count('files')
+            utils.phase_stats.count('bytes_read', st.st_size)
+    results = utils.run_per_device(tasks, jobs, False, jobs_per_device)
+    for (key, path), checksum in zip(task_keys, results):
+        checksums_by_inode[key] = checksum
+        if hash_cache and checksum is not None:
+            hash_cache.set(stats_map[path], kind, checksum, path)
+    return dict((path, checksums_by_inode[(stats_map[path].st_dev, stats_map[path].st_ino)]) for path in paths)
+
+
+def _hash_file_or_none(path, algorithm):
+    try:
+        return utils.hash_file(path, algorithm)
+    except (IOError, OSError) as ex:  # Eg. deleted or unreadable since it was stat'ed.
+        utils.print_wrn('WARNING: cannot hash {}: {}'.format(path, ex))
+        return None
+
+
+def _report(reason, keep_path, remove_path):
+    n_failures_by_reason[reason] += 1
+    utils.print_msg('> {}: {} (keep: {})'.format(reason.capitalize(), remove_path, keep_path))
+    if report:
+        line = json.dumps(OrderedDict([('reason', reason), ('keep', keep_path), ('remove', remove_path)])) + '\n'
+        report.write(line.encode('utf-8'))  # ASCII only: JSON escapes the rest.
+
+
+if __name__ == '__main__':
+    parse_args()
+    utils.print_msg('VERIFY PLAN')
+    utils.print_msg('===========')
+
+    utils.run_with_stats(verify_plan)
+
+    utils.print_msg('\nNo errors - DONE')
+    sys.exit(0)
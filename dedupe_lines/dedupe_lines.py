@@ -1,48 +1,176 @@
 #! /usr/bin/python
 """
-Deduplicate lines in a text file.
+Deduplicate lines in text files.
 
-Lines' order is preserved. Unique lines are printed in stdout.
+Lines' order is preserved. Unique lines are printed in stdout, or written back to the file with --in-place.
+The lines of several files (or of stdin, with `-`) are deduplicated together, in one pass, in the order given.
+Lines are handled as bytes, as they are: any encoding, and CRLF line ends, are kept.
 A possible use case: deduplicate ~/.bash_history if you do not use HISTCONTROL=erasedups
 
 Usage:
-    $ ./dedupe_lines.py myfile.txt
+    $ ./dedupe_lines.py [--in-place] [--max-memory=256] [--tmp-dir=/volume1/tmp] [--stats] [--stats-json=stats.json]
+                        [--profile=dedupe_lines.pstats] myfile.txt [myfile2.txt ...|-]
+Options:
+    --in-place      Write the unique lines to a temporary file next to the file, then rename it over the file. Only
+                    with a single file.
+    --max-memory    Keep a 16-byte digest of each line instead of the line, in at most about this memory in MiB.
+                    Past it, the lines left are spilled to disk and deduplicated in a second pass. The output is
+                    the same. Default: no limit, the lines are kept in memory.
+    --tmp-dir       The dir of the spill files with --max-memory. Default: the dir of the first file (/tmp is often
+                    in RAM on a NAS), or the system one for stdin.
+    --stats         Print a table with the cost of each phase at exit (in stderr): wall and CPU time, bytes read...
+    --stats-json    Write the stats of each phase to this JSON file.
+    --profile       Run under cProfile and write the stats to this .pstats file. Default: dedupe_lines.pstats
 """
-from __future__ import print_function
-
+import io
 import os
+import shutil
 import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 import utils
 
 
-filein = None
+READ_BLOCK_SIZE = 1024 * 1024  # 1 MiB of lines read at once.
+WRITE_BATCH_NUM_LINES = 10000  # Unique lines written at once, with --max-memory.
+
+fileins = []
+do_in_place = False
+max_memory = None
+tmp_dir = None
 
 
 def parse_args():
-    global filein
-    try:
-        filein = os.path.abspath(os.path.expanduser(sys.argv[1]))
-    except IndexError:
-        utils.exit_with_error_msg('Please provide a file as argument')
+    # Stdout is for the unique lines only.
+    utils.print_msgs_to_stderr()
+    # Handle '--stats', '--stats-json' and '--profile' options.
+    utils.parse_stats_options(sys.argv)
 
-    # Ensure the file is valid.
-    if not os.path.isfile(filein):
-        utils.exit_with_error_msg('Please provide a valid file')
+    # Handle '--in-place' option.
+    if '--in-place' in sys.argv:
+        sys.argv.remove('--in-place')
+        global do_in_place
+        do_in_place = True
 
-    return filein
+    # Handle '--max-memory' option.
+    global max_memory
+    for argv in sys.argv:
+        if argv.startswith('--max-memory'):
+            try:
+                max_memory = int(argv.split('=')[1]) * 1024 * 1024
+            except (IndexError, ValueError):
+                max_memory = 0
+            if max_memory < 1:
+                utils.exit_with_error_msg('Invalid value for --max-memory: {}'.format(argv))
+            sys.argv.remove(argv)
+            break
+
+    # Handle '--tmp-dir' option.
+    global tmp_dir
+    for argv in sys.argv:
+        if argv.startswith('--tmp-dir'):
+            tmp_dir = os.path.abspath(os.path.expanduser(argv.split('=', 1)[1]))
+            sys.argv.remove(argv)
+            break
+    if tmp_dir is not None and not os.path.isdir(tmp_dir):
+        utils.exit_with_error_msg('Please provide a valid dir for --tmp-dir')
+
+    if len(sys.argv) < 2:
+        utils.exit_with_error_msg('Please provide a file as argument')
+    for argv in sys.argv[1:]:
+        if argv == '-':
+            fileins.append(argv)
+            continue
+        filein = os.path.abspath(os.path.expanduser(argv))
+        # Ensure the file is valid.
+        if not os.path.isfile(filein):
+            utils.exit_with_error_msg('Please provide a valid file: {}'.format(argv))
+        fileins.append(filein)
+    if sys.argv.count('-') > 1:
+        utils.exit_with_error_msg('Stdin can be read only once')
+    if do_in_place and (len(fileins) != 1 or fileins[0] == '-'):
+        utils.exit_with_error_msg('Option --in-place requires a single file')
+    if tmp_dir is None and fileins[0] != '-':
+        tmp_dir = os.path.dirname(fileins[0])
+    return fileins
 
 
 def dedupe_lines():
+    with utils.phase_stats.phase('dedupe'):
+        if do_in_place:
+            tmp_path = utils.get_tmp_path(fileins[0])
+            fout = io.open(tmp_path, 'wb', buffering=utils.WRITE_BUFFER_SIZE)
+        else:
+            sys.stdout.flush()
+            fout = io.open(sys.stdout.fileno(), 'wb', buffering=utils.WRITE_BUFFER_SIZE, closefd=False)
+        try:
+            if max_memory:
+                _dedupe_with_max_memory(fout)
+            else:
+                _dedupe_in_memory(fout)
+            fout.close()
+            if do_in_place:
+                shutil.copymode(fileins[0], tmp_path)  # Keep the permissions of the file.
+        except BaseException:
+            fout.close()
+            if do_in_place:
+                os.remove(tmp_path)
+            raise
+        if do_in_place:
+            utils.replace_with_tmp_file(tmp_path, fileins[0])
+
+
+def _dedupe_in_memory(fout):
     unique_lines = set()
-    for line in open(filein, 'r'):
-        if line not in unique_lines:
-            print(line, end='')
-            unique_lines.add(line)
+    for lines in _iter_line_blocks():
+        new_lines = []
+        for line in lines:
+            if line not in unique_lines:
+                unique_lines.add(line)
+                new_lines.append(line)
+        fout.writelines(new_lines)
+
+
+def _dedupe_with_max_memory(fout):
+    deduper = utils.LineDeduper(max_memory, tmp_dir)
+    new_lines = []
+    for line in deduper.iter_unique_lines(line for lines in _iter_line_blocks() for line in lines):
+        new_lines.append(line)
+        if len(new_lines) >= WRITE_BATCH_NUM_LINES:
+            fout.writelines(new_lines)
+            new_lines = []
+    fout.writelines(new_lines)
+    if deduper.n_spilled_lines:
+        utils.print_msg('> Over --max-memory: spilled {} of {} lines to {} partitions'.format(
+            deduper.n_spilled_lines, deduper.n_lines, deduper.n_partitions))
+
+
+def _iter_line_blocks():
+    """
+    Yield lists of lines (bytes, with their line end) of about READ_BLOCK_SIZE bytes, from all the files in order.
+    The last line of a file gets a line end if it has none and another file follows, to not be joined with the
+    first line of the next file.
+    """
+    for i, filein in enumerate(fileins):
+        utils.phase_stats.count('files')
+        if filein == '-':
+            fin = io.open(sys.stdin.fileno(), 'rb', buffering=READ_BLOCK_SIZE, closefd=False)
+        else:
+            fin = io.open(filein, 'rb', buffering=READ_BLOCK_SIZE)
+        try:
+            while True:
+                lines = fin.readlines(READ_BLOCK_SIZE)
+                if not lines:
+                    break
+                utils.phase_stats.count('bytes_read', sum(len(line) for line in lines))
+                if not lines[-1].endswith(b'\n') and i < len(fileins) - 1:
+                    lines[-1] += b'\n'
+                yield lines
+        finally:
+            fin.close()
 
 
 if __name__ == '__main__':
     parse_args()
-    dedupe_lines()
+    utils.run_with_stats(dedupe_lines)
     sys.exit(0)
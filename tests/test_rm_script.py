@@ -0,0 +1,83 @@
+"""
+Regression tests for the rm scripts written with `--write-rm-script`: any path, also not valid UTF-8 or with quotes,
+`$` or newlines in it, is written so that Bash removes exactly that file, and read back as it was by
+`iter_rm_script`.
+
+Run with: python -m unittest discover tests
+"""
+import glob
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(REPO_DIR)
+import utils
+
+
+NON_UTF8_NAME = b'caf\xe9.bin'
+NAMES = [NON_UTF8_NAME, b'q\'"$(echo BAD)`echo BAD`\\z', b'x\ntouch INJECTED #', b'tab\there\r']
+
+
+def _decode_name(name):
+    # Like the names yielded by `os.scandir` for a str path.
+    return name.decode('utf-8', 'surrogateescape') if sys.version_info[0] >= 3 else name
+
+
+class RmScriptTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_paths_round_trip(self):
+        script_path = os.path.join(self.tmp_dir, 'rm_dupes.sh')
+        keep_path = os.path.join(self.tmp_dir, _decode_name(NON_UTF8_NAME))
+        remove_paths = [os.path.join(self.tmp_dir, 'dupes', _decode_name(name)) for name in NAMES]
+        script = utils.open_bash_script(script_path)
+        script.write('\n# Keep: {}\n'.format(utils.quote_for_bash(keep_path)))
+        for path in remove_paths:
+            script.write('rm {}\n'.format(utils.quote_for_bash(path)))
+        script.close()
+
+        self.assertEqual(list(utils.iter_rm_script(script_path)), [(keep_path, remove_paths)])
+        with io.open(script_path, 'rb') as fin:
+            self.assertIn(NON_UTF8_NAME, fin.read())  # As it is on disk.
+        self.assertEqual(subprocess.call(['bash', '-n', script_path]), 0)
+
+    @unittest.skipUnless(os.path.isfile(os.path.join(REPO_DIR, 'config.ini')), 'config.ini is needed by the tools')
+    def test_tools_with_non_utf8_name(self):
+        tree_dir = os.path.join(self.tmp_dir, 'tree').encode('utf-8')
+        for dirname in (b'a', b'b'):
+            os.makedirs(os.path.join(tree_dir, dirname))
+            with io.open(os.path.join(tree_dir, dirname, NON_UTF8_NAME), 'wb') as fout:
+                fout.write(b'same content')
+        scripts_pattern = os.path.join(REPO_DIR, 'dedupe_files', 'rm_dupes_*.sh')
+        for tool in ('dedupe_files.py', 'dedupe_files_by_name.py'):
+            scripts_before = set(glob.glob(scripts_pattern))
+            with open(os.devnull, 'w') as devnull:
+                returncode = subprocess.call(
+                    [sys.executable, os.path.join(REPO_DIR, 'dedupe_files', tool), '--no-cache',
+                     '--write-rm-script', tree_dir.decode('utf-8')], stdout=devnull, stderr=devnull)
+            new_scripts = set(glob.glob(scripts_pattern)) - scripts_before
+            try:
+                self.assertEqual(returncode, 0, tool)
+                self.assertEqual(len(new_scripts), 1, tool)
+                groups = list(utils.iter_rm_script(list(new_scripts)[0]))
+                self.assertEqual(len(groups), 1, tool)
+                keep_path, remove_paths = groups[0]
+                self.assertEqual(sorted([keep_path] + remove_paths), [
+                    os.path.join(_decode_name(tree_dir), _decode_name(dirname), _decode_name(NON_UTF8_NAME))
+                    for dirname in (b'a', b'b')])
+            finally:
+                for path in new_scripts:
+                    os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,3 +4,21 @@ import sys
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 from msg import *
 from config import *
+from hashing import *
+from hashcache import *
+from workers import *
+from walker import *
+from media_metadata import *
+from fileops import *
+from bytecmp import *
+from fileindex import *
+from output import *
+from phasestats import *
+from refindex import *
+from imagehash import *
+from hammingindex import *
+from journal import *
+from planapply import *
+from treediff import *
+from manifest import *
+from linededupe import *
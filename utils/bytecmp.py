@@ -0,0 +1,104 @@
+"""
+Compare the content of many files in lockstep, chunk by chunk: exact (no checksum collisions) and usually cheaper than
+hashing, as a file is not read any further as soon as it differs from all the others.
+The files are compared many at once (`group_identical_files`), or 2 at once with each read by its own thread pool
+(`compare_files`).
+"""
+import io
+from collections import OrderedDict
+
+
+MIN_CHUNK_SIZE = 4 * 1024  # 4 KiB.
+MAX_CHUNK_SIZE = 1024 * 1024  # 1 MiB.
+MAX_BUFFERED_SIZE = 64 * 1024 * 1024  # The max size of the chunks held in memory at the same time.
+MAX_OPEN_FILES = 256
+
+
+def group_identical_files(paths):
+    """
+    Compare the content of the files at `paths` and return the groups (lists of 2+ paths) of files with the same
+    content, and the number of bytes read.
+    Chunks start small and double at every read, so files that differ near the start are read very little.
+    When a group diverges, it is split and each subgroup is compared on its own; single files are dropped.
+    """
+    readers = OrderedDict((path, _Reader(path, keep_open=len(paths) <= MAX_OPEN_FILES)) for path in paths)
+    groups = []
+    bytes_read = 0
+    pending = [(list(paths), MIN_CHUNK_SIZE)]
+    try:
+        while pending:
+            group, chunk_size = pending.pop()
+            chunk_size = max(MIN_CHUNK_SIZE, min(chunk_size, MAX_CHUNK_SIZE, MAX_BUFFERED_SIZE // len(group)))
+            paths_by_chunk = OrderedDict()
+            for path in group:
+                chunk = readers[path].read(chunk_size)
+                bytes_read += len(chunk)
+                paths_by_chunk.setdefault(chunk, []).append(path)
+            for chunk, subgroup in paths_by_chunk.items():
+                if len(subgroup) < 2:
+                    readers[subgroup[0]].close()
+                elif not chunk:  # End of file: identical.
+                    groups.append(subgroup)
+                    for path in subgroup:
+                        readers[path].close()
+                else:
+                    pending.append((subgroup, chunk_size * 2))
+    finally:
+        for reader in readers.values():
+            reader.close()
+    positions = dict((path, i) for i, path in enumerate(paths))
+    groups.sort(key=lambda g: positions[g[0]])
+    return groups, bytes_read
+
+
+def compare_files(path1, path2, pool1=None, pool2=None):
+    """
+    Compare the content of 2 files of the same size in lockstep, and return True if it is the same, and the number of
+    bytes read. The reading stops at the first chunk that differs; chunks start small and double at every read.
+    With `pool1` and `pool2` (thread pools) each file is read by its own pool, so the 2 files are read at the same
+    time, eg. from 2 different disks.
+    """
+    bytes_read = 0
+    chunk_size = MIN_CHUNK_SIZE
+    with io.open(path1, 'rb') as fin1:
+        with io.open(path2, 'rb') as fin2:
+            while True:
+                if pool1 is not None and pool2 is not None:
+                    result1 = pool1.apply_async(fin1.read, (chunk_size,))
+                    result2 = pool2.apply_async(fin2.read, (chunk_size,))
+                    chunk1, chunk2 = result1.get(), result2.get()
+                else:
+                    chunk1, chunk2 = fin1.read(chunk_size), fin2.read(chunk_size)
+                bytes_read += len(chunk1) + len(chunk2)
+                if chunk1 != chunk2:
+                    return False, bytes_read
+                if not chunk1:
+                    return True, bytes_read
+                chunk_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+
+
+class _Reader(object):
+    """
+    Read a file sequentially. With `keep_open=False` the file is re-opened at every read, to not run out of file
+    descriptors when comparing many files.
+    """
+    def __init__(self, path, keep_open=True):
+        self.path = path
+        self.keep_open = keep_open
+        self.offset = 0
+        self._file = None
+
+    def read(self, size):
+        if self._file is None:
+            self._file = io.open(self.path, 'rb')
+            self._file.seek(self.offset)
+        data = self._file.read(size)
+        self.offset += len(data)
+        if not self.keep_open:
+            self.close()
+        return data
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,84 @@
+"""
+Compact index of the files found in a walk, for roots with millions of files: sizes in a typed array, dir paths
+interned (stored once for all the files in a dir) and base names packed in a single byte buffer. About 20 bytes per
+file plus the name, instead of a str path and a tuple (~150 bytes) for each file.
+"""
+import heapq
+import itertools
+import os
+import sys
+from array import array
+from operator import itemgetter
+
+
+SORT_CHUNK_SIZE = 128 * 1024  # Number of files sorted at once, when grouping by size.
+
+try:
+    array('q')
+    INT64_TYPECODE = 'q'
+except ValueError:  # Python 2: 'l' is 64-bit on Linux and macOS.
+    INT64_TYPECODE = 'l'
+
+
+class FileIndex(object):
+    """
+    Append-only index of (relative path, size). Files are identified by their position in the index.
+    """
+    def __init__(self):
+        self.sizes = array(INT64_TYPECODE)
+        self._dir_ids = array('i')
+        self._name_ends = array(INT64_TYPECODE)  # Offset in `_names` where the name of each file ends.
+        self._names = bytearray()
+        self._dirpaths = []
+        self._dir_ids_by_dirpath = {}
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add(self, path, size):
+        dirpath, name = os.path.split(path)
+        dir_id = self._dir_ids_by_dirpath.get(dirpath)
+        if dir_id is None:
+            dir_id = self._dir_ids_by_dirpath[dirpath] = len(self._dirpaths)
+            self._dirpaths.append(dirpath)
+        self.sizes.append(size)
+        self._dir_ids.append(dir_id)
+        self._names += _encode(name)
+        self._name_ends.append(len(self._names))
+
+    def get_path(self, i):
+        start = self._name_ends[i - 1] if i else 0
+        name = _decode(bytes(self._names[start:self._name_ends[i]]))
+        dirpath = self._dirpaths[self._dir_ids[i]]
+        return os.path.join(dirpath, name) if dirpath else name
+
+    def iter_groups_by_size(self, min_count=2):
+        """
+        Yield (size, indexes) for each size shared by at least `min_count` files, sorted by size. The indexes of each
+        group are in the order the files were added.
+        The files are argsorted by size in chunks, merged lazily: no list of all sizes is built.
+        """
+        sizes = self.sizes
+        chunks = []
+        for start in range(0, len(sizes), SORT_CHUNK_SIZE):
+            end = min(start + SORT_CHUNK_SIZE, len(sizes))
+            chunks.append(array('i', sorted(range(start, end), key=sizes.__getitem__)))
+        merged = heapq.merge(*[((sizes[i], i) for i in chunk) for chunk in chunks])
+        for size, group in itertools.groupby(merged, key=itemgetter(0)):
+            indexes = [i for _, i in group]
+            if len(indexes) >= min_count:
+                yield size, indexes
+
+
+if sys.version_info[0] >= 3:
+    def _encode(name):
+        return name.encode('utf-8', 'surrogateescape')
+
+    def _decode(data):
+        return data.decode('utf-8', 'surrogateescape')
+else:
+    def _encode(name):
+        return name.encode('utf-8') if isinstance(name, unicode) else name  # noqa: F821
+
+    def _decode(data):
+        return data
@@ -0,0 +1,112 @@
+"""
+Replace files with links to other files with the same content, to reclaim space while keeping every path valid.
+
+The replacement is atomic: the link is created with a temporary name in the same dir, and then renamed over the
+file, so the path always exists.
+"""
+import errno
+import io
+import os
+import re
+import shutil
+import sys
+try:
+    import fcntl
+except ImportError:  # Windows.
+    fcntl = None
+
+
+FICLONE = 0x40049409  # Linux ioctl to share the extents of a file (Btrfs, XFS, ...). From linux/fs.h.
+_CONTROL_CHARS_RE = re.compile('[\x00-\x1f\x7f]')
+
+
+def replace_with_hardlink(src, dst):
+    """
+    Replace `dst` with a hardlink to `src`. Both must be in the same filesystem.
+    """
+    tmp_path = get_tmp_path(dst)
+    os.link(src, tmp_path)
+    replace_with_tmp_file(tmp_path, dst)
+
+
+def replace_with_reflink(src, dst):
+    """
+    Replace `dst` with a reflink (copy-on-write clone) of `src`: a separate file sharing the same data blocks.
+    The permissions, times and owner of `dst` are kept.
+    Raise OSError (eg. EOPNOTSUPP, EXDEV, EINVAL) if the filesystem does not support it.
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are supported only on Linux')
+    tmp_path = get_tmp_path(dst)
+    with open(src, 'rb') as fin:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            fcntl.ioctl(fd, FICLONE, fin.fileno())
+        except (IOError, OSError):
+            os.close(fd)
+            os.remove(tmp_path)
+            raise
+        os.close(fd)
+    try:
+        st = os.stat(dst)
+        shutil.copystat(dst, tmp_path)
+        try:
+            os.chown(tmp_path, st.st_uid, st.st_gid)
+        except OSError:  # Not root.
+            pass
+    except (IOError, OSError):
+        os.remove(tmp_path)
+        raise
+    replace_with_tmp_file(tmp_path, dst)
+
+
+def quote_for_bash(path):
+    """
+    Quote a path for a Bash script, on a single line: also in a comment, a path cannot end the line and inject a
+    command. In single quotes `"`, `$`, backticks and backslashes are literal; a single quote is closed, escaped and
+    reopened. A path with a newline or another control char is written in ANSI-C quotes instead: $'...', with the
+    control chars as \\xHH.
+    """
+    if _CONTROL_CHARS_RE.search(path) is None:
+        return "'{}'".format(path.replace("'", "'\\''"))
+    escaped = path.replace('\\', '\\\\').replace("'", "\\'")
+    return "$'{}'".format(_CONTROL_CHARS_RE.sub(lambda match: '\\x{:02x}'.format(ord(match.group(0))), escaped))
+
+
+def open_bash_script(path):
+    """
+    Create a Bash script at `path`, with its shebang line, and return it open to write. The paths are written as
+    they are on disk, also if they are not valid UTF-8: the undecodable bytes of a name (escaped as surrogates by
+    `os.scandir` in Python 3) are written back as they were. Quote them with `quote_for_bash`.
+    """
+    if sys.version_info[0] >= 3:
+        script = io.open(path, 'w', encoding='utf-8', errors='surrogateescape')
+    else:
+        script = open(path, 'w')  # Paths are bytes already.
+    script.write('#! /bin/bash\n')
+    return script
+
+
+def get_tmp_path(path):
+    """
+    Return a temporary path in the dir of `path`: .<name>.nasutils-tmp, to write a new version of the file and then
+    rename it over the file with `replace_with_tmp_file`. The name is reserved to these tools: a file left there by an
+    interrupted run is removed.
+    """
+    dirpath, name = os.path.split(path)
+    tmp_path = os.path.join(dirpath, '.{}.nasutils-tmp'.format(name))
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    return tmp_path
+
+
+def replace_with_tmp_file(tmp_path, path):
+    """
+    Rename `tmp_path` over `path` atomically: `path` is never missing nor half-written. `tmp_path` is removed on
+    failure.
+    """
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        os.remove(tmp_path)
+        raise
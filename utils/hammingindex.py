@@ -0,0 +1,63 @@
+"""
+Index of hashes (eg. perceptual hashes of photos) to find all the hashes within a max Hamming distance from a given
+one, without comparing it with every hash: multi-index hashing.
+
+The hashes are split in m chunks of bits: if 2 hashes differ in at most d bits, then at least one of their chunks
+differs in at most d // m bits (pigeonhole principle). Each chunk is indexed in a dict and a query looks up, in each
+dict, the chunk of the hash with up to d // m bits flipped: only the hashes found there are compared in full.
+With m about 64 / log2(number of hashes), each dict has about one hash per key, and the cost of a query grows much
+slower than the number of hashes.
+"""
+import itertools
+import math
+from collections import defaultdict
+
+
+class HammingIndex(object):
+    def __init__(self, hashes, max_distance, n_bits=64):
+        """
+        Index `hashes`, ints of `n_bits` bits, to find the ones within `max_distance`.
+        """
+        self.max_distance = max_distance
+        n_chunks = int(n_bits / math.log(max(len(hashes), 2), 2))
+        n_chunks = max(1, min(n_bits, n_chunks))
+        radius = max_distance // n_chunks
+        self._chunks = []  # (shift, mask, flips) for each chunk.
+        start = 0
+        for i in range(n_chunks):
+            n_chunk_bits = n_bits // n_chunks + (1 if i < n_bits % n_chunks else 0)
+            flips = [0]
+            for n_flipped in range(1, radius + 1):
+                for bits in itertools.combinations(range(n_chunk_bits), n_flipped):
+                    flips.append(sum(1 << bit for bit in bits))
+            self._chunks.append((start, (1 << n_chunk_bits) - 1, flips))
+            start += n_chunk_bits
+        self._tables = [defaultdict(list) for _ in self._chunks]
+        for hashval in set(hashes):
+            for (shift, mask, _), table in zip(self._chunks, self._tables):
+                table[(hashval >> shift) & mask].append(hashval)
+
+    def find(self, hashval):
+        """
+        Return a list of (distance, hash) for the indexed hashes within the max distance from `hashval`.
+        """
+        candidates = set()
+        for (shift, mask, flips), table in zip(self._chunks, self._tables):
+            key = (hashval >> shift) & mask
+            for flip in flips:
+                found = table.get(key ^ flip)
+                if found:
+                    candidates.update(found)
+        found = []
+        for candidate in candidates:
+            distance = hamming_distance(hashval, candidate)
+            if distance <= self.max_distance:
+                found.append((distance, candidate))
+        return found
+
+
+def hamming_distance(hash1, hash2):
+    """
+    The number of different bits between 2 hashes, as ints.
+    """
+    return bin(hash1 ^ hash2).count('1')
@@ -0,0 +1,132 @@
+"""
+Persistent on-disk cache of hashes, stored in a SQLite db.
+
+Entries are keyed by (device, inode, size, mtime_ns): a file that is renamed or moved within the same filesystem
+still hits the cache, while any change to its content (thus to its size or mtime) misses it.
+Each entry has a kind, like "content:md5" or "metadata", so different hashes of the same file can be stored.
+"""
+import os
+import sqlite3
+import sys
+
+from msg import exit_with_error_msg
+
+
+DEFAULT_HASH_CACHE_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache')), 'nasutils', 'hashes.sqlite')
+_COMMIT_EVERY = 1000
+
+
+def get_mtime_ns(st):
+    try:
+        return st.st_mtime_ns
+    except AttributeError:  # Python 2.
+        return int(st.st_mtime * 1000000000)
+
+
+class HashCache(object):
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_HASH_CACHE_PATH
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._n_uncommitted = 0
+
+    def open(self, do_rebuild=False):
+        dirpath = os.path.dirname(self.path)
+        if dirpath and not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        try:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            if sys.version_info[0] < 3:  # Python 2: allow 8-bit bytestrings.
+                self._db.text_factory = str
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            if do_rebuild:
+                self._db.execute('DROP TABLE IF EXISTS hashes')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS hashes ('
+                'dev INTEGER NOT NULL, ino INTEGER NOT NULL, kind TEXT NOT NULL, size INTEGER NOT NULL, '
+                'mtime_ns INTEGER NOT NULL, hashval TEXT NOT NULL, path BLOB NOT NULL, '
+                'PRIMARY KEY (dev, ino, kind))')
+            self._db.commit()
+        except sqlite3.DatabaseError as ex:
+            exit_with_error_msg('Cannot open the hash cache {}: {}'.format(self.path, ex))
+        return self
+
+    def get(self, st, kind):
+        """
+        Return the cached hash for the file with the given stat result, or None.
+        """
+        row = self._db.execute(
+            'SELECT hashval FROM hashes WHERE dev=? AND ino=? AND kind=? AND size=? AND mtime_ns=?',
+            _make_key(st) + (kind, st.st_size, get_mtime_ns(st))).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def set(self, st, kind, hashval, path):
+        # Replacing by (dev, ino, kind) evicts the entry for an old version of the same file.
+        self._db.execute(
+            'INSERT OR REPLACE INTO hashes (dev, ino, kind, size, mtime_ns, hashval, path) VALUES (?,?,?,?,?,?,?)',
+            _make_key(st) + (kind, st.st_size, get_mtime_ns(st), hashval, encode_path(path)))
+        self._n_uncommitted += 1
+        if self._n_uncommitted >= _COMMIT_EVERY:
+            self.commit()
+
+    def vacuum(self):
+        """
+        Evict entries for files that do not exist anymore or that have changed since they were hashed.
+        Return the number of evicted entries.
+        """
+        to_evict = []
+        rows = self._db.execute('SELECT dev, ino, kind, size, mtime_ns, path FROM hashes').fetchall()
+        for dev, ino, kind, size, mtime_ns, path in rows:
+            try:
+                st = os.stat(decode_path(path))
+            except OSError:
+                to_evict.append((dev, ino, kind))
+                continue
+            if _make_key(st) != (dev, ino) or st.st_size != size or get_mtime_ns(st) != mtime_ns:
+                to_evict.append((dev, ino, kind))
+        self._db.executemany('DELETE FROM hashes WHERE dev=? AND ino=? AND kind=?', to_evict)
+        self._db.commit()
+        self._db.execute('VACUUM')
+        return len(to_evict)
+
+    def commit(self):
+        self._db.commit()
+        self._n_uncommitted = 0
+
+    def close(self):
+        if self._db is not None:
+            self.commit()
+            self._db.close()
+            self._db = None
+
+
+def _make_key(st):
+    ino = st.st_ino
+    if ino >= 2 ** 63:  # SQLite integers are signed 64 bit.
+        ino -= 2 ** 64
+    return st.st_dev, ino
+
+
+def encode_path(path):
+    """
+    Encode a path to be stored in a SQLite db: as bytes, as it may not be valid UTF-8.
+    """
+    if sys.version_info[0] < 3:
+        return sqlite3.Binary(path)
+    return path.encode('utf-8', 'surrogateescape')
+
+
+def decode_path(path):
+    """
+    Decode a path stored with `encode_path`.
+    """
+    if sys.version_info[0] < 3:
+        return str(path)
+    return bytes(path).decode('utf-8', 'surrogateescape')
@@ -0,0 +1,160 @@
+"""
+In-process hashing of file content, built on `hashlib`.
+
+Files are read with `readinto` in a large buffer that is allocated once per thread and reused for every file.
+Big files are memory-mapped instead, so that the kernel can read ahead and no copy is done in user space.
+An external command (like `md5 -q`) can still be used as a fallback.
+
+A tree hash splits a file in fixed-size chunks, hashed on their own (so in parallel, on many cores), and the root digest
+is the hash of the digests of the chunks: it is not the same as the checksum of the whole content. The digests of the
+chunks can be kept, to compare 2 files chunk by chunk and stop at the first differing one.
+"""
+import binascii
+import hashlib
+import io
+import mmap
+import os
+import subprocess
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+HASH_ALGORITHMS = ('md5', 'sha1', 'sha256', 'blake2b')
+DEFAULT_HASH_ALGORITHM = 'md5'
+BUFFER_SIZE = 1024 * 1024  # 1 MiB.
+MMAP_MIN_SIZE = 64 * 1024 * 1024  # 64 MiB.
+_MMAP_UPDATE_SIZE = 8 * 1024 * 1024  # 8 MiB.
+TREE_HASH_CHUNK_SIZE = 64 * 1024 * 1024  # 64 MiB.
+
+_thread_local = threading.local()
+
+
+def is_hash_algorithm_available(algorithm):
+    try:
+        hashlib.new(algorithm)
+    except ValueError:
+        return False
+    return True
+
+
+def hash_file(path, algorithm=DEFAULT_HASH_ALGORITHM, offset=0, length=None):
+    """
+    Return the hex digest of the content of the file at `path`.
+    The digest for 'md5' is the same as the output of `md5 -q` or `md5sum`.
+    With `offset` and `length` only a block of the file is hashed, eg. its first or last KiBs.
+    """
+    hasher = hashlib.new(algorithm)
+    with io.open(path, 'rb', buffering=0) as fin:
+        if offset or length is not None:
+            fin.seek(offset)
+            _update_with_readinto(hasher, fin, length)
+        else:
+            size = os.fstat(fin.fileno()).st_size
+            if size < MMAP_MIN_SIZE or not _update_with_mmap(hasher, fin, size):
+                _update_with_readinto(hasher, fin)
+    return hasher.hexdigest()
+
+
+def hash_file_with_cmd(path, cmd):
+    """
+    Return the checksum of the file at `path` computed with an external command, eg. `md5 -q`.
+    Slow, as it spawns a shell for every file: use only as a fallback.
+    """
+    # Eg.: $ md5 -q "file.mov"
+    output = subprocess.check_output('{} "{}"'.format(cmd, path), shell=True).strip()
+    if sys.version_info[0] >= 3:
+        output = output.decode('utf-8')
+    return output
+
+
+def get_num_chunks(size, chunk_size=TREE_HASH_CHUNK_SIZE):
+    # An empty file has 1 empty chunk.
+    return max(1, (size + chunk_size - 1) // chunk_size)
+
+
+def get_chunk_length(size, chunk_idx, chunk_size=TREE_HASH_CHUNK_SIZE):
+    return max(0, min(chunk_size, size - chunk_idx * chunk_size))
+
+
+def hash_chunk(path, algorithm, chunk_idx, chunk_size=TREE_HASH_CHUNK_SIZE):
+    """
+    Return the hex digest of the chunk `chunk_idx` of the file at `path`.
+    """
+    return hash_file(path, algorithm, chunk_idx * chunk_size, chunk_size)
+
+
+def get_tree_digest(chunk_digests, algorithm=DEFAULT_HASH_ALGORITHM):
+    """
+    Return the root digest of a tree hash, given the hex digests of all the chunks of the file.
+    """
+    hasher = hashlib.new(algorithm)
+    for chunk_digest in chunk_digests:
+        hasher.update(binascii.unhexlify(chunk_digest))
+    return hasher.hexdigest()
+
+
+def tree_hash_file(path, algorithm=DEFAULT_HASH_ALGORITHM, chunk_size=TREE_HASH_CHUNK_SIZE, jobs=1):
+    """
+    Return the root digest of the tree hash of the file at `path`, and the list of the digests of its chunks.
+    The chunks are hashed in parallel in `jobs` threads: hashing and reading release the GIL.
+    """
+    n_chunks = get_num_chunks(os.path.getsize(path), chunk_size)
+    if jobs <= 1 or n_chunks == 1:
+        chunk_digests = [hash_chunk(path, algorithm, i, chunk_size) for i in range(n_chunks)]
+    else:
+        pool = ThreadPool(min(jobs, n_chunks))
+        try:
+            chunk_digests = pool.map(lambda i: hash_chunk(path, algorithm, i, chunk_size), range(n_chunks))
+        finally:
+            pool.close()
+            pool.join()
+    return get_tree_digest(chunk_digests, algorithm), chunk_digests
+
+
+def _get_buffer():
+    # One buffer per thread, allocated only once and reused for all files.
+    buf = getattr(_thread_local, 'buffer', None)
+    if buf is None:
+        buf = _thread_local.buffer = bytearray(BUFFER_SIZE)
+    return buf
+
+
+def _update_with_readinto(hasher, fin, length=None):
+    buf = _get_buffer()
+    view = memoryview(buf)
+    while length is None or length > 0:
+        if length is None or length >= len(buf):
+            n = fin.readinto(buf)
+        else:
+            n = fin.readinto(view[:length])
+        if not n:
+            break
+        hasher.update(view[:n])
+        if length is not None:
+            length -= n
+
+
+def _update_with_mmap(hasher, fin, size):
+    """
+    Return False if the file could not be memory-mapped (eg. address space exhausted on 32 bit NAS), so the
+    caller can fall back to `readinto`.
+    """
+    try:
+        mapped = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    except (mmap.error, OverflowError, ValueError):
+        return False
+    try:
+        view = memoryview(mapped)  # No copy.
+    except TypeError:  # Python 2: mmap does not support memoryview, slicing copies.
+        view = mapped
+    try:
+        if hasattr(mapped, 'madvise'):  # Python 3.8+.
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        for start in range(0, size, _MMAP_UPDATE_SIZE):
+            hasher.update(view[start:start + _MMAP_UPDATE_SIZE])
+    finally:
+        if view is not mapped:
+            view.release()
+        mapped.close()
+    return True
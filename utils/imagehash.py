@@ -0,0 +1,398 @@
+"""
+Perceptual hashes of photos, to find near-duplicates: resized, re-encoded or re-compressed copies, which have a
+different content but look the same.
+
+The hash is a dHash: the image is reduced to 9x8 grayscale pixels, and each of the 64 bits tells whether a pixel is
+brighter than its right neighbour. Similar images have hashes with a small Hamming distance (the number of different
+bits).
+
+The pure-Python backend decodes only baseline JPEGs, and only the DC coefficient of each 8x8 block of the luminance
+(the average brightness of the block): that is the image at 1/8 scale, with no inverse DCT. When the photo has an
+EXIF thumbnail (typically 160x120) it is decoded instead of the full image, so only the first KiBs are read.
+With Pillow installed, the 'pil' backend can be used: it decodes any format Pillow supports, JPEGs at a reduced scale.
+The EXIF orientation is applied, so a rotated copy matches the original.
+"""
+import io
+import math
+import re
+import struct
+
+from media_metadata import parse_ifd
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional.
+    Image = None
+
+
+IMAGE_HASH_BACKENDS = ('pure', 'pil')
+JPEG_EXTENSIONS = ('.jpg', '.jpeg', '.jpe', '.jfif')
+PIL_EXTENSIONS = JPEG_EXTENSIONS + ('.png', '.tif', '.tiff', '.bmp', '.gif', '.webp')
+_HEAD_SIZE = 128 * 1024  # Enough for the EXIF segment (at most 64 KiB) and the other segments before it.
+_HASH_WIDTH = 9
+_HASH_HEIGHT = 8
+_MAX_THUMBNAIL_ASPECT_DIFF = 0.05
+
+# JPEG markers.
+_SOF_BASELINE_MARKERS = (0xC0, 0xC1)
+_SOF_OTHER_MARKERS = (0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF)
+_DHT = 0xC4
+_SOS = 0xDA
+_DRI = 0xDD
+_APP1 = 0xE1
+_EOI = 0xD9
+
+# EXIF tags.
+_TAG_ORIENTATION = 0x0112
+_TAG_THUMBNAIL_OFFSET = 0x0201
+_TAG_THUMBNAIL_LENGTH = 0x0202
+
+
+class ImageHashError(Exception):
+    pass
+
+
+def get_default_image_hash_backend():
+    return 'pil' if Image is not None else 'pure'
+
+
+def is_image_hash_backend_available(backend):
+    return backend == 'pure' or (backend == 'pil' and Image is not None)
+
+
+def get_image_extensions(backend):
+    return PIL_EXTENSIONS if backend == 'pil' else JPEG_EXTENSIONS
+
+
+def dhash_image(path, backend='pure'):
+    """
+    Return the dHash of the image at `path`, as 16 hex digits.
+    Raise ImageHashError if the image cannot be decoded (eg. progressive JPEGs with the pure backend).
+    """
+    try:
+        if backend == 'pil':
+            pixels = _read_gray_pixels_with_pil(path)
+        else:
+            pixels = _read_gray_pixels_from_jpeg(path)
+    except (IOError, OSError, struct.error, ValueError, IndexError, KeyError) as ex:
+        raise ImageHashError('Cannot decode the image: {} ({})'.format(path, ex))
+    value = 0
+    for y in range(_HASH_HEIGHT):
+        row = pixels[y * _HASH_WIDTH:(y + 1) * _HASH_WIDTH]
+        for x in range(_HASH_WIDTH - 1):
+            value = (value << 1) | int(row[x] < row[x + 1])
+    return '{:016x}'.format(value)
+
+
+def _read_gray_pixels_with_pil(path):
+    image = Image.open(path)
+    image.draft('L', (_HASH_WIDTH * 8, _HASH_HEIGHT * 8))  # JPEG: decoded at 1/2, 1/4 or 1/8 scale.
+    image = ImageOps.exif_transpose(image)
+    image = image.convert('L').resize((_HASH_WIDTH, _HASH_HEIGHT), Image.BOX)
+    return list(image.getdata())
+
+
+def _read_gray_pixels_from_jpeg(path):
+    """
+    Return the 9x8 grayscale pixels (a flat list) of the JPEG at `path`, decoded from its EXIF thumbnail if any.
+    """
+    with io.open(path, 'rb') as fin:
+        head = bytearray(fin.read(_HEAD_SIZE))
+        if head[:2] != b'\xff\xd8':
+            raise ImageHashError('Not a JPEG: {}'.format(path))
+        thumbnail, orientation, aspect = _read_exif_thumbnail(head)
+        grid = None
+        if thumbnail:
+            try:
+                grid = _decode_jpeg_dc(thumbnail)
+            except (ImageHashError, struct.error, ValueError, IndexError, KeyError):
+                pass  # Eg. a progressive thumbnail: the full image is decoded instead.
+            else:
+                grid = _crop_to_aspect(grid, aspect)
+        if grid is None:
+            grid = _decode_jpeg_dc(head + bytearray(fin.read()))
+    return _resize(_apply_orientation(grid, orientation), _HASH_WIDTH, _HASH_HEIGHT)
+
+
+def _iter_segments(data):
+    """
+    Yield (marker, payload start, payload end) for the segments of the JPEG in `data`, up to the first SOS included.
+    """
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise ImageHashError('Invalid JPEG marker at {}'.format(pos))
+        marker = data[pos + 1]
+        if marker == 0xFF:  # Fill byte.
+            pos += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:  # No length.
+            pos += 2
+            continue
+        if marker == _EOI:
+            return
+        length = struct.unpack('>H', bytes(data[pos + 2:pos + 4]))[0]
+        yield marker, pos + 4, pos + 2 + length
+        if marker == _SOS:
+            return
+        pos += 2 + length
+
+
+def _read_exif_thumbnail(head):
+    """
+    Return the EXIF thumbnail (a JPEG, or None), the EXIF orientation and the aspect ratio of the main image (or None)
+    from the first bytes of a JPEG.
+    """
+    thumbnail = aspect = None
+    orientation = 1
+    for marker, start, end in _iter_segments(head):
+        if end > len(head):
+            break
+        if marker == _APP1 and head[start:start + 6] == b'Exif\x00\x00' and thumbnail is None:
+            tiff = bytes(head[start + 6:end])
+            endian = '<' if tiff[:2] == b'II' else '>'
+            ifd0_offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+            ifd0 = parse_ifd(tiff, endian, ifd0_offset)
+            orientation = ifd0.get(_TAG_ORIENTATION) or 1
+            n_entries = struct.unpack(endian + 'H', tiff[ifd0_offset:ifd0_offset + 2])[0]
+            next_offset = ifd0_offset + 2 + n_entries * 12
+            ifd1_offset = struct.unpack(endian + 'I', tiff[next_offset:next_offset + 4])[0]
+            if ifd1_offset:
+                ifd1 = parse_ifd(tiff, endian, ifd1_offset)
+                offset = ifd1.get(_TAG_THUMBNAIL_OFFSET)
+                length = ifd1.get(_TAG_THUMBNAIL_LENGTH)
+                if offset and length and tiff[offset:offset + 2] == b'\xff\xd8':
+                    thumbnail = bytearray(tiff[offset:offset + length])
+        elif marker in _SOF_BASELINE_MARKERS + _SOF_OTHER_MARKERS:
+            height, width = struct.unpack('>HH', bytes(head[start + 1:start + 5]))
+            if width and height:
+                aspect = float(width) / height
+    return thumbnail, orientation, aspect
+
+
+def _decode_jpeg_dc(data):
+    """
+    Decode the DC coefficients of the luminance of the baseline JPEG in `data` (a bytearray).
+    Return (width, height, values): the image at 1/8 scale, as a flat list of values.
+    """
+    tables = {}  # (class, id) -> (symbols, lengths), indexed by the next 16 bits.
+    frame = None
+    restart_interval = 0
+    for marker, start, end in _iter_segments(data):
+        if marker == _DHT:
+            pos = start
+            while pos < end:
+                table_class, table_id = data[pos] >> 4, data[pos] & 15
+                counts = data[pos + 1:pos + 17]
+                symbols = data[pos + 17:pos + 17 + sum(counts)]
+                tables[(table_class, table_id)] = _build_huffman_lookup(counts, symbols)
+                pos += 17 + sum(counts)
+        elif marker in _SOF_BASELINE_MARKERS:
+            height, width = struct.unpack('>HH', bytes(data[start + 1:start + 5]))
+            components = []
+            for i in range(data[start + 5]):
+                offset = start + 6 + i * 3
+                components.append((data[offset], data[offset + 1] >> 4, data[offset + 1] & 15))
+            frame = (width, height, components)
+        elif marker in _SOF_OTHER_MARKERS:
+            raise ImageHashError('Unsupported JPEG: progressive, lossless or arithmetic-coded')
+        elif marker == _DRI:
+            restart_interval = struct.unpack('>H', bytes(data[start:start + 2]))[0]
+        elif marker == _SOS:
+            if frame is None:
+                raise ImageHashError('No frame header before the scan')
+            return _decode_scan_dc(data, start, end, frame, tables, restart_interval)
+    raise ImageHashError('No scan in the JPEG')
+
+
+def _build_huffman_lookup(counts, symbols):
+    # Canonical Huffman codes: a lookup on the next 16 bits gives the symbol and the length of its code.
+    lookup_symbols = [0] * 65536
+    lookup_lengths = [0] * 65536
+    code = 0
+    k = 0
+    for length in range(1, 17):
+        for _ in range(counts[length - 1]):
+            n = 1 << (16 - length)
+            start = code << (16 - length)
+            lookup_symbols[start:start + n] = [symbols[k]] * n
+            lookup_lengths[start:start + n] = [length] * n
+            code += 1
+            k += 1
+        code <<= 1
+    return lookup_symbols, lookup_lengths
+
+
+def _decode_scan_dc(data, start, end, frame, tables, restart_interval):
+    width, height, components = frame
+    n_scan_components = data[start]
+    scan_components = []  # (index in the frame, DC table, AC table).
+    component_ids = [c[0] for c in components]
+    for i in range(n_scan_components):
+        component_id, table_ids = data[start + 1 + i * 2], data[start + 2 + i * 2]
+        scan_components.append((component_ids.index(component_id), tables[(0, table_ids >> 4)],
+                                tables[(1, table_ids & 15)]))
+    if scan_components[0][0] != 0:
+        raise ImageHashError('The first scan is not of the luminance')
+    max_h = max(c[1] for c in components)
+    max_v = max(c[2] for c in components)
+    _, luma_h, luma_v = components[0]
+    if n_scan_components == 1:  # Non-interleaved: one block per MCU, in raster order.
+        layouts = [(1, 1)]
+        mcus_x = _ceil_div(_ceil_div(width * luma_h, max_h), 8)
+        mcus_y = _ceil_div(_ceil_div(height * luma_v, max_v), 8)
+        grid_width, grid_height = mcus_x, mcus_y
+    else:
+        layouts = [(components[i][1], components[i][2]) for i, _, _ in scan_components]
+        mcus_x = _ceil_div(width, 8 * max_h)
+        mcus_y = _ceil_div(height, 8 * max_v)
+        grid_width, grid_height = mcus_x * luma_h, mcus_y * luma_v
+    grid = [0] * (grid_width * grid_height)
+
+    # The entropy-coded data ends at the first marker that is not a restart marker.
+    entropy = bytes(data[end:])
+    match = re.search(b'\xff[^\x00\xd0-\xd7]', entropy)
+    if match:
+        entropy = entropy[:match.start()]
+    if restart_interval:
+        intervals = re.split(b'\xff[\xd0-\xd7]', entropy)
+    else:
+        intervals = [entropy]
+    mcus_per_interval = restart_interval or mcus_x * mcus_y
+
+    mcu = 0
+    for interval in intervals:
+        bits = bytearray(interval.replace(b'\xff\x00', b'\xff')) + bytearray(4)
+        pos = 0
+        predictions = [0] * len(scan_components)
+        for _ in range(mcus_per_interval):
+            if mcu >= mcus_x * mcus_y:
+                break
+            mcu_x, mcu_y = mcu % mcus_x, mcu // mcus_x
+            for c, (component, (dc_symbols, dc_lengths), (ac_symbols, ac_lengths)) in enumerate(scan_components):
+                blocks_h, blocks_v = layouts[c]
+                for block_y in range(blocks_v):
+                    for block_x in range(blocks_h):
+                        # DC: the difference from the previous block, as a category and extra bits.
+                        b = pos >> 3
+                        peek = ((bits[b] << 16 | bits[b + 1] << 8 | bits[b + 2]) >> (8 - (pos & 7))) & 0xFFFF
+                        length = dc_lengths[peek]
+                        if not length:
+                            raise ImageHashError('Invalid Huffman code')
+                        category = dc_symbols[peek]
+                        pos += length
+                        diff = 0
+                        if category:
+                            b = pos >> 3
+                            peek = ((bits[b] << 16 | bits[b + 1] << 8 | bits[b + 2]) >> (8 - (pos & 7))) & 0xFFFF
+                            diff = peek >> (16 - category)
+                            if diff < 1 << (category - 1):
+                                diff -= (1 << category) - 1
+                            pos += category
+                        predictions[c] += diff
+                        # AC: skipped, decoding only the length of each code.
+                        k = 1
+                        while k < 64:
+                            b = pos >> 3
+                            peek = ((bits[b] << 16 | bits[b + 1] << 8 | bits[b + 2]) >> (8 - (pos & 7))) & 0xFFFF
+                            length = ac_lengths[peek]
+                            if not length:
+                                raise ImageHashError('Invalid Huffman code')
+                            run_size = ac_symbols[peek]
+                            pos += length + (run_size & 15)
+                            if run_size & 15:
+                                k += (run_size >> 4) + 1
+                            elif run_size == 0xF0:  # 16 zeros.
+                                k += 16
+                            else:  # End of block.
+                                break
+                        if component == 0:
+                            x = mcu_x * blocks_h + block_x
+                            y = mcu_y * blocks_v + block_y
+                            grid[y * grid_width + x] = predictions[c]
+            mcu += 1
+
+    # Blocks beyond the image (padding of the MCUs) are dropped.
+    luma_width = _ceil_div(_ceil_div(width * luma_h, max_h), 8)
+    luma_height = _ceil_div(_ceil_div(height * luma_v, max_v), 8)
+    values = []
+    for y in range(luma_height):
+        values.extend(grid[y * grid_width:y * grid_width + luma_width])
+    return luma_width, luma_height, values
+
+
+def _ceil_div(a, b):
+    return -(-a // b)
+
+
+def _crop_to_aspect(grid, aspect):
+    """
+    Crop the black bands of a thumbnail with an aspect ratio different from the main image (eg. a 160x120 thumbnail
+    of a 16:9 photo).
+    """
+    width, height, values = grid
+    if not aspect or abs(float(width) / height - aspect) / aspect <= _MAX_THUMBNAIL_ASPECT_DIFF:
+        return grid
+    if float(width) / height > aspect:
+        new_width, new_height = max(1, int(round(height * aspect))), height
+    else:
+        new_width, new_height = width, max(1, int(round(width / aspect)))
+    x0, y0 = (width - new_width) // 2, (height - new_height) // 2
+    new_values = []
+    for y in range(y0, y0 + new_height):
+        new_values.extend(values[y * width + x0:y * width + x0 + new_width])
+    return new_width, new_height, new_values
+
+
+def _apply_orientation(grid, orientation):
+    """
+    Transform the grid as the EXIF orientation says, so it looks upright.
+    """
+    width, height, values = grid
+    if orientation not in (2, 3, 4, 5, 6, 7, 8):
+        return grid
+    rows = [values[y * width:(y + 1) * width] for y in range(height)]
+    if orientation in (5, 6, 7, 8):  # Transpose first.
+        rows = [list(column) for column in zip(*rows)]
+    if orientation in (2, 3, 6, 7):  # Mirror horizontally.
+        rows = [row[::-1] for row in rows]
+    if orientation in (3, 4, 7, 8):  # Mirror vertically.
+        rows = rows[::-1]
+    # 5: transpose, 6: rotate 90 CW, 7: transverse, 8: rotate 90 CCW.
+    return len(rows[0]), len(rows), [value for row in rows for value in row]
+
+
+def _resize(grid, new_width, new_height):
+    """
+    Resize the grid averaging the values in each box, weighted by the area of each value in the box, so small grids
+    (eg. 20x15 from a thumbnail) are resized without aliasing.
+    """
+    width, height, values = grid
+    x_weights = _get_resize_weights(width, new_width)
+    y_weights = _get_resize_weights(height, new_height)
+    pixels = []
+    for y_sources in y_weights:
+        for x_sources in x_weights:
+            total = 0.0
+            for y, y_weight in y_sources:
+                row = y * width
+                for x, x_weight in x_sources:
+                    total += values[row + x] * x_weight * y_weight
+            pixels.append(total)
+    return pixels
+
+
+def _get_resize_weights(size, new_size):
+    """
+    Return, for each new index, a list of (old index, weight): the fraction of the new box covered by the old value.
+    """
+    weights = []
+    scale = float(size) / new_size
+    for i in range(new_size):
+        start, end = i * scale, (i + 1) * scale
+        sources = []
+        for j in range(int(start), min(size, int(math.ceil(end)))):
+            overlap = min(end, j + 1) - max(start, j)
+            if overlap > 0:
+                sources.append((j, overlap / scale))
+        weights.append(sources)
+    return weights
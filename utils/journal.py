@@ -0,0 +1,146 @@
+"""
+Append-only journal of the progress of a long scan, to resume it after an interruption (SSH drop, NAS sleep...).
+
+The journal is an NDJSON file, with one record per line:
+ - {"type": "start", "options": {...}}: the options of the scan, that must match to resume it;
+ - {"type": "files", "entries": [[path, size], ...]}: a checkpoint of the walk, with the files found since the
+   previous one, in the order of the walk;
+ - {"type": "walk_done"}: the walk is complete;
+ - {"type": "batch", "sizes": [[size, [[path, mtime_ns], ...]], ...], "dupes": [[size, checksum, [path, ...]], ...]}:
+   a batch of groups of files with the same size went through all the stages: the files of each size, and the dupes
+   found among them.
+Records are written at checkpoints, flushed and synced to disk. A record truncated by a crash is ignored.
+"""
+import json
+import os
+import time
+
+
+DEFAULT_JOURNALS_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache')), 'nasutils', 'journals')
+CHECKPOINT_FILES = 10000  # Files found in the walk between 2 checkpoints...
+CHECKPOINT_SECONDS = 60  # ...or seconds, whichever comes first.
+
+
+class ScanJournal(object):
+    def __init__(self, path):
+        self.path = path
+        self.options = None
+        self.n_walked_files = 0
+        self.last_walked_path = None
+        self.is_walk_done = False
+        self.n_batches = 0
+        self._file = None
+        self._valid_size = 0  # The size of the records read, without a truncated one.
+        self._pending_entries = []
+        self._last_checkpoint_time = None
+
+    def load(self):
+        """
+        Read the journal of a previous scan. Return False if there is none.
+        The files walked and the batches are not kept in memory: they are read again by `iter_walked_files` and
+        `iter_batches`.
+        """
+        if not os.path.isfile(self.path):
+            return False
+        for record in self._iter_records():
+            if record['type'] == 'start':
+                self.options = record['options']
+            elif record['type'] == 'files' and record['entries']:
+                self.n_walked_files += len(record['entries'])
+                self.last_walked_path = record['entries'][-1][0]
+            elif record['type'] == 'walk_done':
+                self.is_walk_done = True
+            elif record['type'] == 'batch':
+                self.n_batches += 1
+        return self.options is not None
+
+    def iter_walked_files(self):
+        """
+        Yield (path, size) for the files walked, in the order of the walk.
+        """
+        for record in self._iter_records():
+            if record['type'] == 'files':
+                for path, size in record['entries']:
+                    yield path, size
+
+    def iter_batches(self):
+        """
+        Yield (sizes, dupes) for the batches done. See `add_batch`.
+        """
+        for record in self._iter_records():
+            if record['type'] == 'batch':
+                yield record['sizes'], record['dupes']
+
+    def start(self, options):
+        """
+        Start a new journal, replacing any previous one.
+        """
+        dirpath = os.path.dirname(self.path)
+        if dirpath and not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        self._file = open(self.path, 'wb')
+        self._write({'type': 'start', 'options': options})
+        self._last_checkpoint_time = time.time()
+
+    def reopen(self):
+        """
+        Append to the journal of a previous scan, after `load`, dropping a truncated record.
+        """
+        self._file = open(self.path, 'r+b')
+        self._file.truncate(self._valid_size)
+        self._file.seek(self._valid_size)
+        self._last_checkpoint_time = time.time()
+
+    def add_walked_file(self, path, size):
+        self._pending_entries.append((path, size))
+        if (len(self._pending_entries) >= CHECKPOINT_FILES or
+                time.time() - self._last_checkpoint_time >= CHECKPOINT_SECONDS):
+            self.checkpoint_walk()
+
+    def checkpoint_walk(self):
+        if self._pending_entries:
+            self._write({'type': 'files', 'entries': self._pending_entries})
+            self._pending_entries = []
+        self._last_checkpoint_time = time.time()
+
+    def end_walk(self):
+        self.checkpoint_walk()
+        self._write({'type': 'walk_done'})
+
+    def add_batch(self, sizes, dupes):
+        """
+        `sizes` is a list of [size, [[path, mtime_ns], ...]], `dupes` a list of [size, checksum, [path, ...]].
+        """
+        self._write({'type': 'batch', 'sizes': sizes, 'dupes': dupes})
+
+    def remove(self):
+        """
+        Close and delete the journal: the scan is complete.
+        """
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _iter_records(self):
+        self._valid_size = 0
+        with open(self.path, 'rb') as fin:
+            for line in fin:
+                if not line.endswith(b'\n'):  # Truncated by a crash: the last line.
+                    break
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                self._valid_size += len(line)
+                yield record
+
+    def _write(self, record):
+        self._file.write(json.dumps(record).encode('utf-8') + b'\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
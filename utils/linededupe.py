@@ -0,0 +1,158 @@
+"""
+Deduplicate the lines of a stream with bounded memory: a 16-byte digest of each line is kept instead of the line.
+
+While the digests fit in the memory budget, the first occurrence of each line is yielded right away. Past the budget,
+the lines left are spilled to disk: each line not seen yet is appended to a tail file, and its position and digest to
+one of `SPILL_PARTITIONS` partition files, chosen by the digest. All the occurrences of a line end up in the same
+partition, in the order of the input: each partition is read back alone, and the first occurrence of each digest is
+marked in a bitmap of the positions (1 bit per line). A partition still too big for the budget is split again, by
+the next byte of the digest. Finally the tail file is read in order, and the marked lines are yielded.
+So the order of the input is kept, and the output is the same as with a set of all the lines.
+"""
+import hashlib
+import io
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+
+DIGEST_SIZE = 16
+DIGEST_ENTRY_SIZE = 100  # Approx bytes of memory for each digest in a set: the bytes object and its slot.
+SPILL_PARTITIONS = 64
+SPILL_BUFFER_SIZE = 64 * 1024  # For each partition file.
+_RECORD = struct.Struct('>Q{}s'.format(DIGEST_SIZE))  # Position of the line in the tail file, digest.
+_RECORDS_PER_READ = 4096
+
+
+def digest_line(line):
+    """
+    Return the 16-byte digest of a line (bytes).
+    """
+    return hashlib.md5(line).digest()
+
+
+class LineDeduper(object):
+    """
+    Yield the first occurrence of each line (bytes) with `iter_unique_lines`, keeping the digests of the lines in at
+    most about `max_memory` bytes. The spill files are written in a temporary dir in `tmp_dir` (default: the system
+    one), removed at the end.
+    """
+    def __init__(self, max_memory, tmp_dir=None):
+        self.max_memory = max_memory
+        self.tmp_dir = tmp_dir
+        self.n_lines = 0
+        self.n_spilled_lines = 0
+        self.n_partitions = 0
+        self._spill_dir = None
+        self._keep = None  # Bitmap of the lines to yield from the tail file.
+
+    def iter_unique_lines(self, lines):
+        max_digests = max(1, self.max_memory // DIGEST_ENTRY_SIZE)
+        seen = set()
+        lines = iter(lines)
+        for line in lines:
+            self.n_lines += 1
+            digest = digest_line(line)
+            if digest not in seen:
+                seen.add(digest)
+                yield line
+                if len(seen) >= max_digests:
+                    break
+        else:
+            return
+        self._spill_dir = tempfile.mkdtemp(prefix='nasutils-dedupe-lines-', dir=self.tmp_dir)
+        try:
+            tail_path = self._spill(lines, seen)
+            seen = None  # The lines spilled are not in it: free it for the partitions.
+            self._keep = bytearray(self.n_spilled_lines // 8 + 1)
+            for partition_path in self._list_partitions(''):
+                self._mark_first_occurrences(partition_path, 0)
+            with io.open(tail_path, 'rb') as fin:
+                for i, line in enumerate(fin):
+                    if self._keep[i >> 3] & (1 << (i & 7)):
+                        yield line
+        finally:
+            self._keep = None
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+    def _spill(self, lines, seen):
+        """
+        Write the lines not in `seen` to the tail file and their records to the partitions. Return the tail path.
+        """
+        tail_path = os.path.join(self._spill_dir, 'tail')
+        partitions = [io.open(path, 'wb', SPILL_BUFFER_SIZE) for path in self._list_partitions('')]
+        try:
+            with io.open(tail_path, 'wb') as tail:
+                i = 0
+                for line in lines:
+                    self.n_lines += 1
+                    digest = digest_line(line)
+                    if digest in seen:
+                        continue
+                    tail.write(line)
+                    partitions[_byte_at(digest, 0) % SPILL_PARTITIONS].write(_RECORD.pack(i, digest))
+                    i += 1
+                self.n_spilled_lines = i
+        finally:
+            for partition in partitions:
+                partition.close()
+        self.n_partitions += SPILL_PARTITIONS
+        return tail_path
+
+    def _mark_first_occurrences(self, partition_path, depth):
+        n_records = os.path.getsize(partition_path) // _RECORD.size
+        if n_records * DIGEST_ENTRY_SIZE > self.max_memory and depth + 1 < DIGEST_SIZE:
+            for sub_partition_path in self._split(partition_path, depth + 1):
+                self._mark_first_occurrences(sub_partition_path, depth + 1)
+            return
+        seen = set()
+        keep = self._keep
+        for i, digest in _iter_records(partition_path):
+            if digest not in seen:
+                seen.add(digest)
+                keep[i >> 3] |= 1 << (i & 7)
+        os.remove(partition_path)
+
+    def _split(self, partition_path, depth):
+        """
+        Split a partition by the byte `depth` of the digests, keeping the order of the records. Return the paths of
+        the sub-partitions.
+        """
+        sub_partition_paths = self._list_partitions(os.path.basename(partition_path) + '-')
+        sub_partitions = [io.open(path, 'wb', SPILL_BUFFER_SIZE) for path in sub_partition_paths]
+        try:
+            for i, digest in _iter_records(partition_path):
+                sub_partitions[_byte_at(digest, depth) % SPILL_PARTITIONS].write(_RECORD.pack(i, digest))
+        finally:
+            for sub_partition in sub_partitions:
+                sub_partition.close()
+        os.remove(partition_path)
+        self.n_partitions += SPILL_PARTITIONS
+        return sub_partition_paths
+
+    def _list_partitions(self, prefix):
+        return [os.path.join(self._spill_dir, '{}{}'.format(prefix, i)) for i in range(SPILL_PARTITIONS)]
+
+
+def _iter_records(partition_path):
+    """
+    Yield (position, digest) for each record in a partition file.
+    """
+    with io.open(partition_path, 'rb') as fin:
+        while True:
+            data = fin.read(_RECORD.size * _RECORDS_PER_READ)
+            if not data:
+                return
+            for offset in range(0, len(data) - _RECORD.size + 1, _RECORD.size):
+                yield _RECORD.unpack_from(data, offset)
+
+
+if sys.version_info[0] >= 3:
+    def _byte_at(data, i):
+        return data[i]
+else:
+    def _byte_at(data, i):
+        return ord(data[i])
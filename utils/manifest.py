@@ -0,0 +1,217 @@
+"""
+Manifest of a dir tree: a snapshot of the names, sizes, mtimes and optionally checksums of all its files, to compare
+a tree with one that is not mounted anymore (eg. an offsite backup disk), without walking it again.
+
+A manifest is a gzip-compressed NDJSON file. The first line is a header:
+{"type": "manifest", "version": 1, "root": path, "created": date, "hash_algorithm": "md5" or null}
+Then there is a line for each dir, with its entries sorted by name:
+{"dir": relative path, "entries": [[name, is_dir, size, mtime_ns, hash or null], ...]} ("entries" is null if the dir
+could not be read).
+Names are any bytes, decoded from UTF-8, and the bytes not valid UTF-8 as the surrogates U+DC80-U+DCFF (like Python 3
+`surrogateescape`): JSON escapes them as "\\udcXX", and they are encoded back to the same bytes when read.
+The dirs are in the order of a depth-first walk with the subdirs of each dir sorted by name: the order in which
+`iter_tree_diff` merges 2 trees. So a manifest is written in one streaming pass, and read as one side of a diff in
+one streaming pass too, skipping the dirs that are not walked into: only a dir at a time is kept in memory.
+"""
+import codecs
+import datetime
+import gzip
+import json
+import os
+import re
+import sys
+from collections import OrderedDict
+
+from fileops import get_tmp_path, replace_with_tmp_file
+from hashing import hash_file
+from msg import print_wrn
+from treediff import DirLister
+from workers import run_per_device
+
+
+MANIFEST_VERSION = 1
+MANIFEST_COMPRESS_LEVEL = 6  # Faster than the default 9, and nearly as small for NDJSON.
+
+
+class ManifestWriter(object):
+    """
+    Write the manifest of the tree at `root`, with the checksums of the files if `hash_algorithm` is given: they are
+    computed in a pool of `jobs` threads, with at most `jobs_per_device` files read at the same time on the same
+    device (see `run_per_device`).
+    """
+    def __init__(self, path, hash_algorithm=None, jobs=1, jobs_per_device=None):
+        self.path = path
+        self.hash_algorithm = hash_algorithm
+        self.jobs = jobs
+        self.jobs_per_device = jobs_per_device
+        self.n_dirs = 0
+        self.n_entries = 0
+        self.n_hashed = 0
+        self.bytes_hashed = 0
+
+    def write_tree(self, root):
+        tmp_path = get_tmp_path(self.path)
+        tree = DirLister(root).open()
+        try:
+            with gzip.open(tmp_path, 'wb', MANIFEST_COMPRESS_LEVEL) as fout:
+                fout.write(_encode_line(OrderedDict([
+                    ('type', 'manifest'), ('version', MANIFEST_VERSION), ('root', _encode_name(root)),
+                    ('created', datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+                    ('hash_algorithm', self.hash_algorithm)])))
+                stack = ['']
+                while stack:
+                    relative_dirpath = stack.pop()
+                    entries = tree.list_dir(relative_dirpath)
+                    subdirs = []
+                    if entries is not None:
+                        if self.hash_algorithm:
+                            entries = self._add_hashes(root, relative_dirpath, entries)
+                        subdirs = [_join(relative_dirpath, entry[0]) for entry in entries if entry[1]]
+                        tree.prefetch(subdirs)
+                        self.n_dirs += 1
+                        self.n_entries += len(entries)
+                    fout.write(_encode_line(OrderedDict([
+                        ('dir', _encode_name(relative_dirpath)),
+                        ('entries', None if entries is None else [
+                            (_encode_name(entry[0]),) + entry[1:] for entry in entries])])))
+                    stack.extend(reversed(subdirs))
+        finally:
+            tree.close()
+        replace_with_tmp_file(tmp_path, self.path)
+
+    def _add_hashes(self, root, relative_dirpath, entries):
+        tasks = []
+        task_idxs = []
+        for i, (name, is_dir, size, mtime_ns, _) in enumerate(entries):
+            path = os.path.join(root, relative_dirpath, name)
+            if is_dir or os.path.islink(path):
+                continue
+            try:
+                st_dev = os.lstat(path).st_dev
+            except OSError as ex:
+                print_wrn('WARNING: {}'.format(ex))
+                continue
+            tasks.append((st_dev, _hash_file_or_none, (path, self.hash_algorithm)))
+            task_idxs.append(i)
+            self.n_hashed += 1
+            self.bytes_hashed += size
+        entries = list(entries)
+        for i, checksum in zip(task_idxs, run_per_device(tasks, self.jobs, False, self.jobs_per_device)):
+            entries[i] = entries[i][:4] + (checksum,)
+        return entries
+
+
+class ManifestLister(object):
+    """
+    Read the dirs of a manifest as listings, like `DirLister` does for a live tree, in the order of the manifest: a
+    dir not asked for is skipped. `root` and `hash_algorithm` are read from the header.
+    """
+    def __init__(self, path, on_error=None):
+        self.path = path
+        self.on_error = on_error or _print_error
+        self.root = None
+        self.created = None
+        self.hash_algorithm = None
+        self.n_dirs = 0
+        self.n_entries = 0
+        self._file = None
+        self._records = None
+
+    def open(self):
+        self._file = gzip.open(self.path, 'rb')
+        try:
+            header = json.loads(self._file.readline().decode('utf-8'))
+        except (IOError, ValueError):
+            header = None
+        if not isinstance(header, dict) or header.get('type') != 'manifest':
+            self.close()
+            raise ValueError('Not a manifest: {}'.format(self.path))
+        if header['version'] > MANIFEST_VERSION:
+            self.close()
+            raise ValueError('Manifest version {} not supported: {}'.format(header['version'], self.path))
+        self.root = _decode_name(header['root'])
+        self.created = header['created']
+        self.hash_algorithm = header['hash_algorithm']
+        self._records = self._iter_records()
+        return self
+
+    def prefetch(self, relative_dirpaths):
+        pass  # The manifest is read sequentially.
+
+    def list_dir(self, relative_dirpath):
+        for record in self._records:
+            if record['dir'] != relative_dirpath:  # A subtree not walked into.
+                continue
+            if record['entries'] is None:
+                self.on_error(IOError('Could not be read when the manifest was written: {}'.format(
+                    relative_dirpath or '.')))
+                return None
+            entries = [(_decode_name(name), bool(is_dir), size, mtime_ns, checksum)
+                       for name, is_dir, size, mtime_ns, checksum in record['entries']]
+            self.n_dirs += 1
+            self.n_entries += len(entries)
+            return entries
+        self.on_error(ValueError('Not in the manifest (truncated?): {}'.format(relative_dirpath or '.')))
+        return None
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _iter_records(self):
+        try:
+            for line in self._file:
+                record = json.loads(line.decode('utf-8'))
+                record['dir'] = _decode_name(record['dir'])
+                yield record
+        except (EOFError, IOError, ValueError):  # Truncated, eg. by a full disk while writing it.
+            return
+
+
+def _hash_file_or_none(path, algorithm):
+    try:
+        return hash_file(path, algorithm)
+    except (IOError, OSError) as ex:
+        print_wrn('WARNING: cannot hash {}: {}'.format(path, ex))
+        return None
+
+
+def _encode_line(record):
+    line = json.dumps(record) + '\n'  # ASCII only: JSON escapes the rest.
+    return line.encode('ascii') if sys.version_info[0] >= 3 else line
+
+
+if sys.version_info[0] >= 3:
+    # The names in a `DirLister` listing are str, with the bytes not valid UTF-8 as surrogates already.
+    def _encode_name(name):
+        return name
+
+    def _decode_name(name):
+        return name
+else:
+    # The names in a `DirLister` listing are bytes: decoded and encoded like Python 3 does, so a manifest written
+    # with Python 2 is the same as with Python 3.
+    _SURROGATE_ESCAPES_RE = re.compile(u'[\udc80-\udcff]')
+
+    def _surrogate_escape(ex):
+        return u''.join(unichr(0xdc00 + ord(byte)) for byte in ex.object[ex.start:ex.end]), ex.end
+
+    codecs.register_error('nasutils-surrogateescape', _surrogate_escape)
+
+    def _encode_name(name):
+        return name.decode('utf-8', 'nasutils-surrogateescape')
+
+    def _decode_name(name):
+        if _SURROGATE_ESCAPES_RE.search(name) is None:
+            return name.encode('utf-8')
+        return b''.join(chr(ord(char) - 0xdc00) if _SURROGATE_ESCAPES_RE.match(char) else char.encode('utf-8')
+                        for char in name)
+
+
+def _join(relative_dirpath, name):
+    return os.path.join(relative_dirpath, name) if relative_dirpath else name
+
+
+def _print_error(ex):
+    print_wrn('WARNING: {}'.format(ex))
@@ -0,0 +1,443 @@
+"""
+Read the capture metadata (timestamp, camera, dimensions, ...) of photos and videos, in pure Python.
+
+Only the header bytes are read, seeking over the actual image or video data, so a few KiB are read even for
+multi-GB videos. Supported formats:
+ - JPEG: EXIF in the APP1 segment and dimensions in the SOF segment;
+ - TIFF-based raw files (DNG, CR2, NEF, ARW...): EXIF;
+ - PNG: IHDR, eXIf, tIME and text chunks;
+ - HEIC/HEIF (ISO-BMFF): EXIF item and ispe boxes in the meta box;
+ - MP4/MOV (ISO-BMFF): mvhd and tkhd boxes, QuickTime user data and Apple keys/ilst metadata in the moov box.
+"""
+import datetime
+import hashlib
+import io
+import struct
+
+
+class MetadataReadingError(Exception):
+    pass
+
+
+def hash_media_metadata(path):
+    """
+    Return the md5 hex digest of the normalized capture metadata of the photo or video at `path`.
+    Raise MetadataReadingError if the format is not supported or if there is no capture timestamp.
+    """
+    metadata = read_media_metadata(path)
+    if not metadata.get('datetime'):
+        raise MetadataReadingError('No capture timestamp in: {}'.format(path))
+    text = u'\n'.join(u'{}={}'.format(key, metadata[key]) for key in sorted(metadata))
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def read_media_metadata(path):
+    """
+    Return a dict with the capture metadata found, among: format, datetime, subsec, offset, make, model, width,
+    height, exposure, fnumber, iso, unique_id, duration.
+    """
+    try:
+        with io.open(path, 'rb') as fin:
+            header = fin.read(16)
+            fin.seek(0)
+            if header[:2] == b'\xff\xd8':
+                metadata = _read_jpeg(fin)
+            elif header[:4] in (b'II*\x00', b'MM\x00*'):
+                metadata = {'format': 'tiff'}
+                metadata.update(_parse_exif(fin.read(_MAX_TIFF_HEADER_SIZE)))
+            elif header[:8] == b'\x89PNG\r\n\x1a\n':
+                metadata = _read_png(fin)
+            elif header[4:8] == b'ftyp' and header[8:12] in _HEIF_BRANDS:
+                metadata = _read_heif(fin)
+            elif header[4:8] in (b'ftyp', b'moov', b'mdat', b'wide', b'free', b'skip'):
+                metadata = _read_mp4(fin)
+            else:
+                raise MetadataReadingError('Unsupported format: {}'.format(path))
+    except (IOError, OSError, struct.error, ValueError, IndexError) as ex:
+        raise MetadataReadingError('Cannot read metadata in: {} ({})'.format(path, ex))
+    return dict((key, value) for key, value in metadata.items() if value not in (None, ''))
+
+
+_MAX_TIFF_HEADER_SIZE = 256 * 1024
+_HEIF_BRANDS = (b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx', b'mif1', b'msf1', b'avif')
+
+# EXIF tags.
+_TAG_MAKE = 0x010F
+_TAG_MODEL = 0x0110
+_TAG_DATETIME = 0x0132
+_TAG_EXIF_IFD = 0x8769
+_TAG_EXPOSURE = 0x829A
+_TAG_FNUMBER = 0x829D
+_TAG_ISO = 0x8827
+_TAG_DATETIME_ORIGINAL = 0x9003
+_TAG_OFFSET_ORIGINAL = 0x9011
+_TAG_SUBSEC_ORIGINAL = 0x9291
+_TAG_WIDTH = 0xA002
+_TAG_HEIGHT = 0xA003
+_TAG_UNIQUE_ID = 0xA420
+_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+
+def _parse_exif(tiff):
+    """
+    Parse the EXIF data in `tiff`, the bytes starting with the TIFF header ("II*\\0" or "MM\\0*").
+    """
+    endian = '<' if tiff[:2] == b'II' else '>'
+    ifd0 = parse_ifd(tiff, endian, struct.unpack(endian + 'I', tiff[4:8])[0])
+    exif = {}
+    if _TAG_EXIF_IFD in ifd0:
+        exif = parse_ifd(tiff, endian, ifd0[_TAG_EXIF_IFD])
+    return {
+        'datetime': exif.get(_TAG_DATETIME_ORIGINAL) or ifd0.get(_TAG_DATETIME),
+        'subsec': exif.get(_TAG_SUBSEC_ORIGINAL),
+        'offset': exif.get(_TAG_OFFSET_ORIGINAL),
+        'make': ifd0.get(_TAG_MAKE),
+        'model': ifd0.get(_TAG_MODEL),
+        'width': exif.get(_TAG_WIDTH),
+        'height': exif.get(_TAG_HEIGHT),
+        'exposure': exif.get(_TAG_EXPOSURE),
+        'fnumber': exif.get(_TAG_FNUMBER),
+        'iso': exif.get(_TAG_ISO),
+        'unique_id': exif.get(_TAG_UNIQUE_ID),
+    }
+
+
+def parse_ifd(tiff, endian, offset):
+    """
+    Return a dict tag -> value for the entries of the IFD at `offset`. Values are str, int or "num/den" str.
+    """
+    entries = {}
+    n_entries = struct.unpack(endian + 'H', tiff[offset:offset + 2])[0]
+    for i in range(n_entries):
+        entry = tiff[offset + 2 + i * 12:offset + 14 + i * 12]
+        if len(entry) < 12:
+            break
+        tag, typ, count = struct.unpack(endian + 'HHI', entry[:8])
+        size = _TYPE_SIZES.get(typ, 0) * count
+        if not size:
+            continue
+        if size <= 4:
+            data = entry[8:8 + size]
+        else:
+            data_offset = struct.unpack(endian + 'I', entry[8:12])[0]
+            data = tiff[data_offset:data_offset + size]
+            if len(data) < size:
+                continue
+        if typ == 2:  # ASCII.
+            entries[tag] = data.split(b'\x00')[0].strip().decode('utf-8', 'replace')
+        elif typ == 3:  # SHORT.
+            entries[tag] = struct.unpack(endian + 'H', data[:2])[0]
+        elif typ in (4, 9):  # LONG, SLONG.
+            entries[tag] = struct.unpack(endian + ('I' if typ == 4 else 'i'), data[:4])[0]
+        elif typ in (5, 10):  # RATIONAL, SRATIONAL.
+            num, den = struct.unpack(endian + ('II' if typ == 5 else 'ii'), data[:8])
+            entries[tag] = '{}/{}'.format(num, den)
+    return entries
+
+
+def _read_jpeg(fin):
+    metadata = {'format': 'jpeg'}
+    fin.read(2)  # SOI.
+    while True:
+        marker = fin.read(2)
+        if len(marker) < 2 or marker[:1] != b'\xff':
+            break
+        marker_type = struct.unpack('>B', marker[1:2])[0]
+        if marker_type in (0xD8, 0x01) or 0xD0 <= marker_type <= 0xD7:  # No length.
+            continue
+        if marker_type == 0xFF:  # Fill byte.
+            fin.seek(-1, 1)
+            continue
+        if marker_type in (0xD9, 0xDA):  # EOI, SOS: the image data starts, no more metadata.
+            break
+        length = struct.unpack('>H', fin.read(2))[0]
+        if marker_type == 0xE1:
+            payload = fin.read(length - 2)
+            if payload[:6] == b'Exif\x00\x00' and not metadata.get('datetime'):
+                exif = _parse_exif(payload[6:])
+                metadata.update((key, value) for key, value in exif.items() if value not in (None, ''))
+        elif marker_type in _JPEG_SOF_MARKERS:
+            payload = fin.read(length - 2)
+            height, width = struct.unpack('>HH', payload[1:5])
+            metadata.setdefault('width', width)
+            metadata.setdefault('height', height)
+        else:
+            fin.seek(length - 2, 1)
+    return metadata
+
+
+_JPEG_SOF_MARKERS = (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF)
+
+
+def _read_png(fin):
+    metadata = {'format': 'png'}
+    fin.read(8)  # Signature.
+    while True:
+        header = fin.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type == b'IEND':
+            break
+        if chunk_type in (b'IHDR', b'eXIf', b'tIME', b'tEXt', b'iTXt'):
+            data = fin.read(length)
+            fin.seek(4, 1)  # CRC.
+        else:
+            fin.seek(length + 4, 1)  # Skip the image data, without reading it.
+            continue
+        if chunk_type == b'IHDR':
+            metadata['width'], metadata['height'] = struct.unpack('>II', data[:8])
+        elif chunk_type == b'eXIf':
+            exif = _parse_exif(data)
+            metadata.update((key, value) for key, value in exif.items() if value not in (None, ''))
+        elif chunk_type == b'tIME' and not metadata.get('datetime'):
+            metadata['datetime'] = '{:04d}:{:02d}:{:02d} {:02d}:{:02d}:{:02d}'.format(*struct.unpack('>HBBBBB', data))
+        else:
+            keyword, _, text = data.partition(b'\x00')
+            if keyword == b'Creation Time':
+                if chunk_type == b'iTXt':  # Skip compression flag, method, language and translated keyword.
+                    text = text[2:].split(b'\x00', 2)[-1]
+                metadata['datetime'] = text.strip().decode('utf-8', 'replace')
+    return metadata
+
+
+def _iter_boxes(fin, start, end):
+    """
+    Yield (box type, payload start, payload end) for the ISO-BMFF boxes between the file offsets `start` and `end`
+    (None for the end of the file), seeking over the payloads.
+    """
+    offset = start
+    while end is None or offset + 8 <= end:
+        fin.seek(offset)
+        header = fin.read(8)
+        if len(header) < 8:
+            break
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', fin.read(8))[0]
+            header_size = 16
+        elif size == 0:  # Up to the end of the file.
+            fin.seek(0, 2)
+            size = fin.tell() - offset
+        if size < header_size:
+            break
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+
+def _read_box(fin, start, end):
+    fin.seek(start)
+    return fin.read(end - start)
+
+
+def _read_heif(fin):
+    metadata = {'format': 'heif'}
+    for box_type, start, end in _iter_boxes(fin, 0, None):
+        if box_type == b'meta':
+            exif_item_ids = set()
+            locations = {}
+            for child_type, child_start, child_end in _iter_boxes(fin, start + 4, end):  # Full box: skip version.
+                if child_type == b'iinf':
+                    exif_item_ids = _parse_iinf_exif_item_ids(_read_box(fin, child_start, child_end))
+                elif child_type == b'iloc':
+                    locations = _parse_iloc(_read_box(fin, child_start, child_end))
+                elif child_type == b'iprp':
+                    width, height = _parse_iprp_max_dimensions(fin, child_start, child_end)
+                    if width:
+                        metadata['width'], metadata['height'] = width, height
+            for item_id in exif_item_ids:
+                if item_id in locations:
+                    offset, length = locations[item_id]
+                    fin.seek(offset)
+                    data = fin.read(min(length, _MAX_TIFF_HEADER_SIZE))
+                    # The EXIF item starts with the offset to the TIFF header.
+                    tiff_offset = 4 + struct.unpack('>I', data[:4])[0]
+                    exif = _parse_exif(data[tiff_offset:])
+                    metadata.update((key, value) for key, value in exif.items() if value not in (None, ''))
+                    break
+            break
+    return metadata
+
+
+def _parse_iinf_exif_item_ids(data):
+    version = struct.unpack('>B', data[:1])[0]
+    pos = 6 if version == 0 else 8  # Version, flags and entry count.
+    item_ids = set()
+    while pos + 8 <= len(data):
+        size, box_type = struct.unpack('>I4s', data[pos:pos + 8])
+        if size < 8:
+            break
+        if box_type == b'infe':
+            infe_version = struct.unpack('>B', data[pos + 8:pos + 9])[0]
+            if infe_version >= 2:
+                if infe_version == 2:
+                    item_id, item_type = struct.unpack('>H2x4s', data[pos + 12:pos + 20])
+                else:
+                    item_id, item_type = struct.unpack('>I2x4s', data[pos + 12:pos + 22])
+                if item_type == b'Exif':
+                    item_ids.add(item_id)
+        pos += size
+    return item_ids
+
+
+def _parse_iloc(data):
+    """
+    Return a dict item id -> (file offset, length) of the first extent of each item.
+    """
+    version = struct.unpack('>B', data[:1])[0]
+    sizes1, sizes2 = struct.unpack('>BB', data[4:6])
+    offset_size, length_size = sizes1 >> 4, sizes1 & 0x0F
+    base_offset_size, index_size = sizes2 >> 4, (sizes2 & 0x0F if version in (1, 2) else 0)
+    pos = 6
+    if version < 2:
+        item_count = struct.unpack('>H', data[pos:pos + 2])[0]
+        pos += 2
+    else:
+        item_count = struct.unpack('>I', data[pos:pos + 4])[0]
+        pos += 4
+
+    def read_uint(size):
+        value = 0
+        for byte in struct.unpack('>{}B'.format(size), data[pos:pos + size]):
+            value = (value << 8) | byte
+        return value
+
+    locations = {}
+    for _ in range(item_count):
+        if version < 2:
+            item_id = read_uint(2)
+            pos += 2
+        else:
+            item_id = read_uint(4)
+            pos += 4
+        construction_method = 0
+        if version in (1, 2):
+            construction_method = read_uint(2) & 0x0F
+            pos += 2
+        pos += 2  # Data reference index.
+        base_offset = read_uint(base_offset_size)
+        pos += base_offset_size
+        extent_count = read_uint(2)
+        pos += 2
+        for i in range(extent_count):
+            pos += index_size
+            extent_offset = read_uint(offset_size)
+            pos += offset_size
+            extent_length = read_uint(length_size)
+            pos += length_size
+            if i == 0 and construction_method == 0:  # Offsets in the file.
+                locations[item_id] = (base_offset + extent_offset, extent_length)
+    return locations
+
+
+def _parse_iprp_max_dimensions(fin, start, end):
+    # The largest image spatial extent is the full image, the others are tiles or thumbnails.
+    width = height = 0
+    for box_type, box_start, box_end in _iter_boxes(fin, start, end):
+        if box_type == b'ipco':
+            for prop_type, prop_start, prop_end in _iter_boxes(fin, box_start, box_end):
+                if prop_type == b'ispe':
+                    w, h = struct.unpack('>4xII', _read_box(fin, prop_start, prop_start + 12))
+                    if w * h > width * height:
+                        width, height = w, h
+    return width, height
+
+
+def _read_mp4(fin):
+    metadata = {'format': 'mp4'}
+    for box_type, start, end in _iter_boxes(fin, 0, None):
+        if box_type != b'moov':
+            continue  # Skip mdat without reading it.
+        for child_type, child_start, child_end in _iter_boxes(fin, start, end):
+            if child_type == b'mvhd':
+                data = _read_box(fin, child_start, min(child_end, child_start + 32))
+                if struct.unpack('>B', data[:1])[0] == 1:
+                    creation_time, timescale, duration = struct.unpack('>Q8xIQ', data[4:32])
+                else:
+                    creation_time, timescale, duration = struct.unpack('>I4xII', data[4:20])
+                if creation_time:
+                    metadata['datetime'] = _format_mp4_time(creation_time)
+                if timescale:
+                    metadata['duration'] = '{}/{}'.format(duration, timescale)
+            elif child_type == b'trak':
+                width, height = _parse_trak_dimensions(fin, child_start, child_end)
+                if width * height > metadata.get('width', 0) * metadata.get('height', 0):
+                    metadata['width'], metadata['height'] = width, height
+            elif child_type == b'udta':
+                metadata.update(_parse_quicktime_udta(fin, child_start, child_end))
+            elif child_type == b'meta':
+                metadata.update(_parse_apple_keys_metadata(fin, child_start, child_end))
+        break
+    return metadata
+
+
+def _format_mp4_time(seconds_since_1904):
+    try:
+        return (datetime.datetime(1904, 1, 1) + datetime.timedelta(seconds=seconds_since_1904)).strftime(
+            '%Y:%m:%d %H:%M:%S')
+    except OverflowError:
+        return None
+
+
+def _parse_trak_dimensions(fin, start, end):
+    for box_type, box_start, box_end in _iter_boxes(fin, start, end):
+        if box_type == b'tkhd':
+            data = _read_box(fin, box_start, box_end)
+            # Width and height are 16.16 fixed point numbers at the end of the box.
+            width, height = struct.unpack('>II', data[-8:])
+            return width >> 16, height >> 16
+    return 0, 0
+
+
+_QUICKTIME_UDTA_KEYS = {b'\xa9day': 'datetime', b'\xa9mak': 'make', b'\xa9mod': 'model'}
+
+
+def _parse_quicktime_udta(fin, start, end):
+    metadata = {}
+    for box_type, box_start, box_end in _iter_boxes(fin, start, end):
+        if box_type in _QUICKTIME_UDTA_KEYS:
+            data = _read_box(fin, box_start, box_end)
+            # A list of (16 bit length, 16 bit language code, text): the first one is used.
+            length = struct.unpack('>H', data[:2])[0]
+            metadata[_QUICKTIME_UDTA_KEYS[box_type]] = data[4:4 + length].strip().decode('utf-8', 'replace')
+    return metadata
+
+
+_APPLE_KEYS = {
+    b'com.apple.quicktime.creationdate': 'datetime',
+    b'com.apple.quicktime.make': 'make',
+    b'com.apple.quicktime.model': 'model',
+}
+
+
+def _parse_apple_keys_metadata(fin, start, end):
+    """
+    Parse the metadata written by iPhones in moov/meta: a `keys` box with the names and an `ilst` box with the
+    values, indexed by the 1-based position of their key.
+    """
+    keys = {}
+    values = {}
+    for box_type, box_start, box_end in _iter_boxes(fin, start, end):
+        if box_type == b'keys':
+            data = _read_box(fin, box_start, box_end)
+            pos, index = 8, 1  # Version, flags and entry count.
+            while pos + 8 <= len(data):
+                size = struct.unpack('>I', data[pos:pos + 4])[0]
+                if size < 8:
+                    break
+                keys[index] = data[pos + 8:pos + size]
+                pos += size
+                index += 1
+        elif box_type == b'ilst':
+            for item_type, item_start, item_end in _iter_boxes(fin, box_start, box_end):
+                index = struct.unpack('>I', item_type)[0]
+                for data_type, data_start, data_end in _iter_boxes(fin, item_start, item_end):
+                    if data_type == b'data':
+                        values[index] = _read_box(fin, data_start + 8, data_end)  # Skip type and locale.
+                        break
+    metadata = {}
+    for index, key in keys.items():
+        if key in _APPLE_KEYS and index in values:
+            metadata[_APPLE_KEYS[key]] = values[index].strip().decode('utf-8', 'replace')
+    return metadata
@@ -3,6 +3,17 @@ from __future__ import print_function
 import sys
 
 
+msg_file = None  # Where messages are printed, stdout by default.
+
+
+def print_msgs_to_stderr():
+    """
+    Print messages to stderr, to keep stdout for machine-readable output.
+    """
+    global msg_file
+    msg_file = sys.stderr
+
+
 def exit_with_error_msg(msg):
     FAILCOL = "\033[91m"
     ENDCOL = "\033[0m"
@@ -16,12 +27,14 @@ def print_msg(msg):
     ENDCOL = "\033[0m"
     OK = OKCOL + "OK" + ENDCOL
     DONE = OKCOL + "DONE" + ENDCOL
-    print(msg.replace("OK", OK).replace("DONE", DONE))
-    sys.stdout.flush()
+    fout = msg_file or sys.stdout
+    print(msg.replace("OK", OK).replace("DONE", DONE), file=fout)
+    fout.flush()
 
 
 def print_wrn(msg):
     WARNCOL = "\033[93m"
     ENDCOL = "\033[0m"
-    print(WARNCOL + msg + ENDCOL)
-    sys.stdout.flush()
+    fout = msg_file or sys.stdout
+    print(WARNCOL + msg + ENDCOL, file=fout)
+    fout.flush()
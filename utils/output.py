@@ -0,0 +1,83 @@
+"""
+Machine-readable output of groups of dupes, written as soon as each group is confirmed:
+ - NDJSON: one JSON object per line for each group;
+ - CSV: one row for each file, with the id of its group.
+Written to stdout or to a file, through a large buffer, flushed by the caller when a batch of groups is done.
+"""
+import io
+import json
+import sys
+
+from hashcache import get_mtime_ns
+
+
+OUTPUT_FORMATS = ('text', 'ndjson', 'csv')
+WRITE_BUFFER_SIZE = 1024 * 1024  # 1 MiB.
+CSV_COLUMNS = ('group', 'size', 'hash', 'path', 'dev', 'inode')
+
+
+class DupesWriter(object):
+    """
+    Write groups of dupes in `output_format` ('ndjson' or 'csv') to the file at `path`, or to stdout when `path` is
+    None or '-'.
+    An NDJSON line looks like:
+    {"size": 1000, "hash": "d41d8c...", "files": [{"path": "/a/1.jpg", "dev": 2049, "inode": 12, "mtime_ns": ...}, ...]}
+    Paths to the same inode (hardlinks) have the same dev and inode. The mtime lets a plan be checked before being
+    applied (see `planapply`).
+    """
+    def __init__(self, output_format, path=None):
+        self.output_format = output_format
+        self.path = path
+        self.n_groups = 0
+        self._file = None
+
+    def open(self):
+        if self.path in (None, '-'):
+            sys.stdout.flush()
+            self._file = io.open(sys.stdout.fileno(), 'wb', buffering=WRITE_BUFFER_SIZE, closefd=False)
+        else:
+            self._file = io.open(self.path, 'wb', buffering=WRITE_BUFFER_SIZE)
+        if self.output_format == 'csv':
+            self._write(_format_csv_row(CSV_COLUMNS))
+        return self
+
+    def write_group(self, size, hashval, files):
+        """
+        Write a group of dupes. `files` is a list of (path, stat result).
+        """
+        self.n_groups += 1
+        if self.output_format == 'ndjson':
+            group = {
+                'size': size,
+                'hash': hashval,
+                'files': [{'path': path, 'dev': st.st_dev, 'inode': st.st_ino, 'mtime_ns': get_mtime_ns(st)}
+                          for path, st in files],
+            }
+            self._write(json.dumps(group, sort_keys=True) + '\n')
+        else:
+            for path, st in files:
+                self._write(_format_csv_row((self.n_groups, size, hashval, path, st.st_dev, st.st_ino)))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, line):
+        if not isinstance(line, bytes):
+            line = line.encode('utf-8', 'surrogateescape')
+        self._file.write(line)
+
+
+def _format_csv_row(fields):
+    # RFC 4180: fields with separators, quotes or newlines are quoted, and quotes are doubled.
+    values = []
+    for field in fields:
+        value = field if isinstance(field, (str, type(u''))) else str(field)
+        if any(c in value for c in (',', '"', '\n', '\r')):
+            value = '"' + value.replace('"', '""') + '"'
+        values.append(value)
+    return ','.join(values) + '\r\n'
@@ -0,0 +1,170 @@
+"""
+Per-phase instrumentation for the tools: wall and CPU time, files listed and stat'ed, bytes read, subprocesses
+spawned and cache hits of each phase, printed as a table at exit (`--stats`), dumped as JSON (`--stats-json=path`),
+and optionally a cProfile of the whole run (`--profile=path`).
+
+Usage in a tool:
+```
+with utils.phase_stats.phase('list'):
+    for path in paths:
+        utils.phase_stats.count('files')
+...
+if __name__ == '__main__':
+    utils.parse_stats_options(sys.argv)
+    utils.run_with_stats(main)
+```
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from msg import print_msg
+
+
+# Counters, in the order they are printed.
+COUNTERS = ('files', 'files_stated', 'bytes_read', 'subprocesses', 'cache_hits', 'cache_misses')
+
+
+def _get_cpu_time():
+    # User and system time of this process (all its threads) and of its waited subprocesses.
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+class PhaseStats(object):
+    """
+    Stats of the phases of a run. A phase can be entered many times (eg. once per batch): its stats add up.
+    Counters can be incremented from any thread; they are added to the current phase.
+    """
+    def __init__(self):
+        self.phases = OrderedDict()  # Name -> dict of stats.
+        self._current = None
+        self._lock = threading.Lock()
+        self._start_wall = time.time()
+        self._start_cpu = _get_cpu_time()
+
+    @contextmanager
+    def phase(self, name):
+        previous = self._current
+        stats = self.phases.get(name)
+        if stats is None:
+            stats = self.phases[name] = _new_stats()
+        self._current = stats
+        start_wall = time.time()
+        start_cpu = _get_cpu_time()
+        try:
+            yield stats
+        finally:
+            stats['wall_s'] += time.time() - start_wall
+            stats['cpu_s'] += _get_cpu_time() - start_cpu
+            self._current = previous
+
+    def count(self, counter, n=1):
+        with self._lock:
+            stats = self._current
+            if stats is None:
+                stats = self.phases.setdefault('other', _new_stats())
+            stats[counter] += n
+
+    def get_totals(self):
+        totals = dict((c, sum(stats[c] for stats in self.phases.values())) for c in COUNTERS)
+        # The same files go through many phases: the total is the max, not the sum.
+        totals['files'] = max([stats['files'] for stats in self.phases.values()] or [0])
+        totals['wall_s'] = time.time() - self._start_wall
+        totals['cpu_s'] = _get_cpu_time() - self._start_cpu
+        return totals
+
+    def to_dict(self):
+        phases = OrderedDict()
+        for name, stats in self.phases.items():
+            phases[name] = _with_throughput(stats)
+        return OrderedDict([('phases', phases), ('total', _with_throughput(self.get_totals()))])
+
+    def format_table(self):
+        header = ('phase', 'wall s', 'cpu s', 'files', "stat'ed", 'MB read', 'MB/s', 'files/s', 'subproc',
+                  'cache hits', 'cache miss')
+        row_format = '{:<32}' + '{:>11}' * (len(header) - 1)
+        lines = [row_format.format(*header)]
+        stats_dict = self.to_dict()
+        rows = list(stats_dict['phases'].items()) + [('TOTAL', stats_dict['total'])]
+        for name, stats in rows:
+            lines.append(row_format.format(
+                name[:31], '{:.2f}'.format(stats['wall_s']), '{:.2f}'.format(stats['cpu_s']), stats['files'],
+                stats['files_stated'], '{:.1f}'.format(stats['bytes_read'] / 1e6), '{:.1f}'.format(stats['mb_per_s']),
+                '{:.0f}'.format(stats['files_per_s']), stats['subprocesses'], stats['cache_hits'],
+                stats['cache_misses']))
+        return '\n'.join(lines)
+
+
+phase_stats = PhaseStats()
+do_print_stats = False
+stats_json_path = None
+profile_path = None
+
+
+def parse_stats_options(argv):
+    """
+    Handle (and remove from `argv`) the options: `--stats`, `--stats-json=path` and `--profile[=path]`.
+    """
+    global do_print_stats, stats_json_path, profile_path
+    if '--stats' in argv:
+        argv.remove('--stats')
+        do_print_stats = True
+    for arg in argv:
+        if arg.startswith('--stats-json='):
+            stats_json_path = os.path.abspath(os.path.expanduser(arg.split('=', 1)[1]))
+            argv.remove(arg)
+            break
+    for arg in argv:
+        if arg == '--profile' or arg.startswith('--profile='):
+            if '=' in arg:
+                profile_path = os.path.abspath(os.path.expanduser(arg.split('=', 1)[1]))
+            else:
+                profile_path = os.path.abspath('{}.pstats'.format(os.path.splitext(os.path.basename(argv[0]))[0]))
+            argv.remove(arg)
+            break
+
+
+def run_with_stats(func, *args):
+    """
+    Call `func`, under cProfile with `--profile`, and then print and dump the stats as requested by the options.
+    This happens also when `func` exits early (eg. `sys.exit`).
+    """
+    profiler = None
+    if profile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        if profiler:
+            return profiler.runcall(func, *args)
+        return func(*args)
+    finally:
+        if profiler:
+            # Only the main thread is profiled: time spent in worker threads shows up as waits.
+            profiler.dump_stats(profile_path)
+            print_msg('\n> Profile written to: {} (read it with: python -m pstats {})'.format(
+                profile_path, profile_path))
+        if do_print_stats:
+            print_msg('\n> Stats:\n{}'.format(phase_stats.format_table()))
+        if stats_json_path:
+            with open(stats_json_path, 'w') as fout:
+                json.dump(phase_stats.to_dict(), fout, indent=2)
+            print_msg('\n> Stats written to: {}'.format(stats_json_path))
+
+
+def _new_stats():
+    return dict([('wall_s', 0.0), ('cpu_s', 0.0)] + [(counter, 0) for counter in COUNTERS])
+
+
+def _with_throughput(stats):
+    result = OrderedDict((key, round(stats[key], 3)) for key in ('wall_s', 'cpu_s'))
+    for counter in COUNTERS:
+        result[counter] = stats[counter]
+    wall_s = stats['wall_s']
+    result['mb_per_s'] = round(stats['bytes_read'] / 1e6 / wall_s, 1) if wall_s else 0.0
+    result['files_per_s'] = round(stats['files'] / wall_s, 1) if wall_s else 0.0
+    return result
+
@@ -0,0 +1,301 @@
+"""
+Apply a dedupe plan in-process, instead of running a generated Bash script with a `rm` process per file: delete the
+duplicated files, move them to a quarantine dir, or replace them with links to the kept file. Any path is fine, also
+with quotes, `$` or newlines in it.
+
+A plan is the NDJSON output of the tools (`--output-format=ndjson`), one group per line. In each group the first file
+is the one to keep, with its hardlinks (same dev and inode); the other files are the dupes to act on. The rm scripts
+written with `--write-rm-script` can be read too, to verify them (see `iter_rm_script`).
+
+Files are acted on in batches grouped by dir: each dir is opened once, and its files are stat'ed, unlinked or renamed
+relative to the dir fd (Python 3.3+ on Linux; full paths otherwise). Each file is stat'ed again right before being
+acted on: if its dev, inode, size or mtime changed since the scan, or if the kept file changed, it is skipped.
+Each action done is appended to an undo log, one JSON array per line:
+["delete", path, kept path] or ["quarantine", path, path in quarantine] or ["hardlink"|"reflink", path, kept path].
+"""
+import io
+import json
+import os
+import re
+import shutil
+import sys
+from collections import defaultdict
+
+from msg import print_msg, print_wrn
+from hashcache import get_mtime_ns
+from fileops import replace_with_hardlink, replace_with_reflink, get_tmp_path, replace_with_tmp_file
+
+
+APPLY_ACTIONS = ('delete', 'quarantine', 'hardlink', 'reflink')
+APPLY_BATCH_SIZE = 10000  # Files queued before acting on them, grouped by dir.
+_ANSI_C_ESCAPE_RE = re.compile(r'\\(x[0-9a-fA-F]{1,2}|.)')
+_HAS_DIR_FD = all(func in getattr(os, 'supports_dir_fd', ()) for func in (os.stat, os.unlink, os.rename))
+
+
+class PlanExecutor(object):
+    """
+    Act on the dupes of the groups added with `add_group`, in batches.
+    With `dry_run` the files are only checked, and the bytes that would be reclaimed are counted.
+    Files are moved to `quarantine_dir` with their full path, eg. /volume1/photo/1.jpg to
+    <quarantine_dir>/volume1/photo/1.jpg. It must be in the same filesystem (a move is a rename).
+    """
+    def __init__(self, action, quarantine_dir=None, dry_run=False, undo_log_path=None):
+        self.action = action
+        self.quarantine_dir = quarantine_dir
+        self.dry_run = dry_run
+        self.undo_log_path = undo_log_path
+        self.n_done = 0
+        self.n_skipped = 0
+        self.n_failed = 0
+        self.bytes_reclaimed = 0
+        self._pending = defaultdict(list)  # Dir path -> list of (name, file, kept file, inode state).
+        self._n_pending = 0
+        self._undo_log = None
+
+    def open(self):
+        if self.undo_log_path and not self.dry_run:
+            self._undo_log = io.open(self.undo_log_path, 'ab')
+        return self
+
+    def add_group(self, size, keep_files, remove_files):
+        """
+        Queue the dupes of a group. `keep_files` and `remove_files` are lists of dicts with: path, dev, inode and
+        optionally mtime_ns; the first of `keep_files` is the kept file.
+        All the paths to the same inode must be acted on to reclaim its space: the size is counted only then.
+        """
+        inode_states = {}
+        for remove_file in remove_files:
+            key = (remove_file['dev'], remove_file['inode'])
+            if key not in inode_states:
+                inode_states[key] = {'size': size, 'n_left': 0}
+            inode_states[key]['n_left'] += 1
+        for remove_file in remove_files:
+            dirpath, name = os.path.split(remove_file['path'])
+            inode_state = inode_states[(remove_file['dev'], remove_file['inode'])]
+            self._pending[dirpath].append((name, remove_file, keep_files[0], inode_state))
+            self._n_pending += 1
+        if self._n_pending >= APPLY_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        Act on the files queued, dir by dir.
+        """
+        pending, self._pending, self._n_pending = self._pending, defaultdict(list), 0
+        checked_keep_files = {}  # Kept path -> True if unchanged, checked once per batch.
+        for dirpath in sorted(pending):
+            dir_fd = None
+            if _HAS_DIR_FD:
+                try:
+                    dir_fd = os.open(dirpath, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+                except OSError as ex:
+                    print_wrn('WARNING: cannot open dir {}: {}'.format(dirpath, ex))
+                    self.n_failed += len(pending[dirpath])
+                    continue
+            try:
+                for name, remove_file, keep_file, inode_state in pending[dirpath]:
+                    keep_path = keep_file['path']
+                    if keep_path not in checked_keep_files:
+                        checked_keep_files[keep_path] = _is_unchanged(keep_file, inode_state['size'])
+                    if self._apply(dirpath, dir_fd, name, remove_file, keep_file, inode_state['size'],
+                                   checked_keep_files[keep_path]):
+                        inode_state['n_left'] -= 1
+                        if inode_state['n_left'] == 0:
+                            self.bytes_reclaimed += inode_state['size']
+            finally:
+                if dir_fd is not None:
+                    os.close(dir_fd)
+        if self._undo_log:
+            self._undo_log.flush()
+
+    def close(self):
+        self.flush()
+        if self._undo_log:
+            self._undo_log.close()
+            self._undo_log = None
+
+    def _apply(self, dirpath, dir_fd, name, remove_file, keep_file, size, is_keep_unchanged):
+        """
+        Return True if the action was done (or would be, with `dry_run`).
+        """
+        path = remove_file['path']
+        if not is_keep_unchanged:
+            print_wrn('WARNING: the file to keep changed since the scan, skipping: {} (keep: {})'.format(
+                path, keep_file['path']))
+            self.n_skipped += 1
+            return False
+        try:
+            st = os.lstat(name, dir_fd=dir_fd) if dir_fd is not None else os.lstat(path)
+        except OSError:
+            st = None
+        if st is None or not _matches(st, remove_file, size) or path == keep_file['path']:
+            print_wrn('WARNING: changed since the scan, skipping: {}'.format(path))
+            self.n_skipped += 1
+            return False
+        if self.dry_run:
+            self.n_done += 1
+            return True
+        try:
+            if self.action == 'delete':
+                _unlink(dirpath, dir_fd, name)
+                undo = ['delete', path, keep_file['path']]
+            elif self.action == 'quarantine':
+                to_path = os.path.join(self.quarantine_dir, path.lstrip(os.sep))
+                _move(dirpath, dir_fd, name, to_path)
+                undo = ['quarantine', path, to_path]
+            elif self.action == 'hardlink':
+                replace_with_hardlink(keep_file['path'], path)
+                undo = ['hardlink', path, keep_file['path']]
+            else:
+                replace_with_reflink(keep_file['path'], path)
+                undo = ['reflink', path, keep_file['path']]
+        except (IOError, OSError) as ex:
+            print_wrn('WARNING: cannot {} {}: {}'.format(self.action, path, ex))
+            self.n_failed += 1
+            return False
+        self.n_done += 1
+        if self._undo_log:
+            self._undo_log.write(_encode_line(undo))
+        return True
+
+
+def iter_plan(path):
+    """
+    Yield (size, hash, keep files, remove files) for each group in the plan at `path` (or stdin with '-'): see
+    `PlanExecutor.add_group`.
+    """
+    fin = io.open(sys.stdin.fileno(), 'rb', closefd=False) if path == '-' else io.open(path, 'rb')
+    try:
+        for line in fin:
+            if not line.strip():
+                continue
+            group = json.loads(line.decode('utf-8', 'surrogateescape'))
+            files = group['files']
+            keep_key = (files[0]['dev'], files[0]['inode'])
+            keep_files = [f for f in files if (f['dev'], f['inode']) == keep_key]
+            remove_files = [f for f in files if (f['dev'], f['inode']) != keep_key]
+            yield group['size'], group['hash'], keep_files, remove_files
+    finally:
+        fin.close()
+
+
+def iter_rm_script(path):
+    """
+    Yield (kept path, list of paths to remove) for each group in an rm script written with `--write-rm-script`, with
+    the paths quoted in double quotes (older scripts), in single quotes, or in ANSI-C quotes ($'...'). The kept
+    hardlinks are not listed. The script is read line by line.
+    """
+    keep_path = None
+    remove_paths = []
+    with io.open(path, 'rb') as fin:
+        for line in fin:
+            line = line.decode('utf-8', 'surrogateescape') if sys.version_info[0] >= 3 else line
+            line = line.rstrip('\r\n')
+            if line.startswith('# Keep: '):
+                if keep_path is not None and remove_paths:
+                    yield keep_path, remove_paths
+                keep_path = _unquote(line[len('# Keep: '):])
+                remove_paths = []
+            elif line.startswith('rm ') and keep_path is not None:
+                remove_paths.append(_unquote(line[len('rm '):]))
+    if keep_path is not None and remove_paths:
+        yield keep_path, remove_paths
+
+
+def _unquote(value):
+    if len(value) >= 3 and value.startswith("$'") and value.endswith("'"):  # ANSI-C quotes, see `quote_for_bash`.
+        return _ANSI_C_ESCAPE_RE.sub(_unescape_ansi_c, value[2:-1])
+    if len(value) >= 2 and value[0] == value[-1] == "'":
+        return value[1:-1].replace("'\\''", "'")
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return value[1:-1]
+    return value
+
+
+def _unescape_ansi_c(match):
+    escape = match.group(1)
+    if escape[0] == 'x' and len(escape) > 1:
+        return chr(int(escape[1:], 16))
+    return escape  # Eg. \\ or \'.
+
+
+def undo_actions(undo_log_path, dry_run=False):
+    """
+    Undo the actions in an undo log, from the last one: quarantined files are moved back, deleted files are restored
+    as copies of the kept file, hardlinks are replaced with copies. Reflinks are separate files already: nothing to do.
+    A path that exists again is not overwritten. Return the number of files restored and of files skipped.
+    """
+    with io.open(undo_log_path, 'rb') as fin:
+        actions = [json.loads(line.decode('utf-8', 'surrogateescape')) for line in fin if line.strip()]
+    n_restored = n_skipped = 0
+    for action, path, other_path in reversed(actions):
+        if action == 'reflink':
+            continue
+        if action in ('delete', 'quarantine') and os.path.lexists(path):
+            print_wrn('WARNING: exists already, skipping: {}'.format(path))
+            n_skipped += 1
+            continue
+        if dry_run:
+            print_msg('> Would restore: {}'.format(path))
+            n_restored += 1
+            continue
+        try:
+            if action == 'quarantine':
+                _makedirs(os.path.dirname(path))
+                os.rename(other_path, path)
+            elif action == 'delete':
+                _makedirs(os.path.dirname(path))
+                shutil.copy2(other_path, path)
+            else:  # A hardlink: replaced with a copy, with its own inode.
+                tmp_path = get_tmp_path(path)
+                shutil.copy2(other_path, tmp_path)
+                replace_with_tmp_file(tmp_path, path)
+        except (IOError, OSError) as ex:
+            print_wrn('WARNING: cannot restore {}: {}'.format(path, ex))
+            n_skipped += 1
+            continue
+        print_msg('> Restored: {}'.format(path))
+        n_restored += 1
+    return n_restored, n_skipped
+
+
+def _is_unchanged(file_entry, size):
+    try:
+        st = os.lstat(file_entry['path'])
+    except OSError:
+        return False
+    return _matches(st, file_entry, size)
+
+
+def _matches(st, file_entry, size):
+    if (st.st_dev, st.st_ino, st.st_size) != (file_entry['dev'], file_entry['inode'], size):
+        return False
+    # Plans written before mtimes were added to the output have no mtime_ns.
+    return file_entry.get('mtime_ns') is None or get_mtime_ns(st) == file_entry['mtime_ns']
+
+
+def _unlink(dirpath, dir_fd, name):
+    if dir_fd is not None:
+        os.unlink(name, dir_fd=dir_fd)
+    else:
+        os.unlink(os.path.join(dirpath, name))
+
+
+def _move(dirpath, dir_fd, name, to_path):
+    if os.path.lexists(to_path):  # A rename would replace it.
+        raise OSError('Exists already in the quarantine dir: {}'.format(to_path))
+    _makedirs(os.path.dirname(to_path))
+    if dir_fd is not None:
+        os.rename(name, to_path, src_dir_fd=dir_fd)
+    else:
+        os.rename(os.path.join(dirpath, name), to_path)
+
+
+def _makedirs(dirpath):
+    if not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+
+
+def _encode_line(values):
+    line = json.dumps(values) + '\n'
+    return line.encode('utf-8', 'surrogateescape') if sys.version_info[0] >= 3 else line
@@ -0,0 +1,171 @@
+"""
+Persistent index of the files in reference dirs (eg. a photo archive), stored in a SQLite db: path, size, mtime and
+inode of each file, and the checksum of its content once computed.
+
+The index is updated incrementally: a walk of a reference dir only stats its files, and the checksum of a file is
+dropped only when its size, mtime or inode changes. Checksums are computed lazily, by the caller, only for the files
+with the same size as a candidate file: most of the archive is never read.
+"""
+import os
+import sqlite3
+import sys
+
+from msg import exit_with_error_msg
+from hashcache import get_mtime_ns, encode_path, decode_path
+from walker import iter_files
+
+
+DEFAULT_REFERENCE_INDEX_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache')), 'nasutils',
+    'reference_index.sqlite')
+_COMMIT_EVERY = 1000
+
+
+class ReferenceIndex(object):
+    """
+    Index of the files in `roots` (absolute paths). Files are identified by their full path.
+    The same db can hold many reference dirs: only the ones in `roots` are walked and queried.
+    """
+    def __init__(self, roots, path=None):
+        self.roots = list(roots)
+        self.path = path or DEFAULT_REFERENCE_INDEX_PATH
+        self._db = None
+        self._n_uncommitted = 0
+
+    def open(self):
+        dirpath = os.path.dirname(self.path)
+        if dirpath and not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        try:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            if sys.version_info[0] < 3:  # Python 2: allow 8-bit bytestrings.
+                self._db.text_factory = str
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS reference_files ('
+                'root BLOB NOT NULL, path BLOB NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+                'dev INTEGER NOT NULL, ino INTEGER NOT NULL, kind TEXT, hashval TEXT, scan_id INTEGER NOT NULL, '
+                'PRIMARY KEY (root, path))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS reference_files_size ON reference_files (size)')
+            self._db.commit()
+        except sqlite3.DatabaseError as ex:
+            exit_with_error_msg('Cannot open the reference index {}: {}'.format(self.path, ex))
+        return self
+
+    def update(self, root, exclude_pathnames=(), exclude_names=(), on_file=None):
+        """
+        Walk the reference dir `root` and bring its entries up to date. Return the number of files found, of new or
+        changed files (their checksum is dropped) and of removed files.
+        `on_file` is called for each file found, eg. to count it.
+        """
+        encoded_root = encode_path(root)
+        row = self._db.execute('SELECT MAX(scan_id) FROM reference_files WHERE root=?', (encoded_root,)).fetchone()
+        scan_id = (row[0] or 0) + 1
+        n_files = n_changed = 0
+        for path, st in iter_files(root, exclude_pathnames, exclude_names):
+            if on_file:
+                on_file()
+            n_files += 1
+            encoded_path = encode_path(path)
+            row = self._db.execute(
+                'SELECT size, mtime_ns, dev, ino FROM reference_files WHERE root=? AND path=?',
+                (encoded_root, encoded_path)).fetchone()
+            if row is not None and tuple(row) == _get_stat_values(st):
+                self._db.execute('UPDATE reference_files SET scan_id=? WHERE root=? AND path=?',
+                                 (scan_id, encoded_root, encoded_path))
+            else:
+                self._set(encoded_root, encoded_path, st, scan_id)
+                n_changed += 1
+            self._maybe_commit()
+        # The files not seen in this walk do not exist anymore.
+        n_removed = self._db.execute('DELETE FROM reference_files WHERE root=? AND scan_id<>?',
+                                     (encoded_root, scan_id)).rowcount
+        self.commit()
+        return n_files, n_changed, n_removed
+
+    def is_indexed(self, root):
+        row = self._db.execute('SELECT 1 FROM reference_files WHERE root=? LIMIT 1', (encode_path(root),)).fetchone()
+        return row is not None
+
+    def has_size(self, size):
+        row = self._db.execute(
+            'SELECT 1 FROM reference_files WHERE size=? AND root IN ({}) LIMIT 1'.format(self._get_roots_params()),
+            (size,) + self._get_encoded_roots()).fetchone()
+        return row is not None
+
+    def get_files(self, size, kind):
+        """
+        Return a list of (full path, checksum) for the files with the given size, sorted by path. The checksum is None
+        if not computed yet, or computed with another `kind` (eg. another algorithm).
+        """
+        rows = self._db.execute(
+            'SELECT root, path, kind, hashval FROM reference_files WHERE size=? AND root IN ({})'.format(
+                self._get_roots_params()),
+            (size,) + self._get_encoded_roots()).fetchall()
+        files = []
+        for root, path, row_kind, hashval in rows:
+            files.append((os.path.join(decode_path(root), decode_path(path)), hashval if row_kind == kind else None))
+        return sorted(files)
+
+    def is_unchanged(self, full_path, st):
+        """
+        Return True if the entry for the file at `full_path` matches its stat result `st`.
+        """
+        root, path = self._split_path(full_path)
+        row = self._db.execute('SELECT size, mtime_ns, dev, ino FROM reference_files WHERE root=? AND path=?',
+                               (root, path)).fetchone()
+        return row is not None and tuple(row) == _get_stat_values(st)
+
+    def set_file(self, full_path, st, kind=None, hashval=None):
+        """
+        Add or replace the entry for the file at `full_path`, with its checksum if given.
+        """
+        root, path = self._split_path(full_path)
+        row = self._db.execute('SELECT MAX(scan_id) FROM reference_files WHERE root=?', (root,)).fetchone()
+        self._set(root, path, st, row[0] or 1, kind, hashval)
+        self._maybe_commit()
+
+    def remove_file(self, full_path):
+        self._db.execute('DELETE FROM reference_files WHERE root=? AND path=?', self._split_path(full_path))
+        self._maybe_commit()
+
+    def commit(self):
+        self._db.commit()
+        self._n_uncommitted = 0
+
+    def close(self):
+        if self._db is not None:
+            self.commit()
+            self._db.close()
+            self._db = None
+
+    def _set(self, root, path, st, scan_id, kind=None, hashval=None):
+        self._db.execute(
+            'INSERT OR REPLACE INTO reference_files (root, path, size, mtime_ns, dev, ino, kind, hashval, scan_id) '
+            'VALUES (?,?,?,?,?,?,?,?,?)', (root, path) + _get_stat_values(st) + (kind, hashval, scan_id))
+
+    def _maybe_commit(self):
+        self._n_uncommitted += 1
+        if self._n_uncommitted >= _COMMIT_EVERY:
+            self.commit()
+
+    def _split_path(self, full_path):
+        for root in self.roots:
+            if full_path.startswith(os.path.join(root, '')):
+                return encode_path(root), encode_path(full_path[len(os.path.join(root, '')):])
+        raise ValueError('Not in a reference dir: {}'.format(full_path))
+
+    def _get_encoded_roots(self):
+        return tuple(encode_path(root) for root in self.roots)
+
+    def _get_roots_params(self):
+        return ','.join('?' * len(self.roots))
+
+
+def _get_stat_values(st):
+    ino = st.st_ino
+    if ino >= 2 ** 63:  # SQLite integers are signed 64 bit.
+        ino -= 2 ** 64
+    return st.st_size, get_mtime_ns(st), st.st_dev, ino
+
@@ -0,0 +1,208 @@
+"""
+Compare 2 dir trees with a merge-join of their listings, dir by dir: the entries of each dir are listed (and lstat'ed)
+on both sides, sorted by name and merged, and only the subdirs found on both sides are walked into. A subtree on one
+side only is reported as a single entry, without walking it. No list of all paths is built nor sorted: the memory
+depends on the size of the dirs, not of the trees.
+
+Each side is listed by its own thread, one dir level ahead of the merge: when a dir is merged, its subdirs on both
+sides are queued to be listed, so 2 disks are read at the same time while the merge runs.
+"""
+import os
+import stat
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from msg import print_wrn
+from hashcache import get_mtime_ns
+from walker import scandir
+
+
+PREFETCH_DIRS = 64  # Max dirs listed ahead of the merge, on each side.
+
+DIFF_MISSING_IN_1 = 'missing in dir1'
+DIFF_MISSING_IN_2 = 'missing in dir2'
+DIFF_SIZE = 'size differs'
+DIFF_TYPE = 'type differs'
+SAME_SIZE = 'same size'  # Not a difference: 2 files with the same size, yielded only on request.
+
+
+class DirLister(object):
+    """
+    List the dirs of a tree in a background thread. Each listing is a list of (name, is_dir, size, mtime_ns, hash)
+    sorted by name, or None if the dir cannot be read. The hash is always None: only a manifest has hashes (see
+    `ManifestLister`). Symlinks and other special files are listed as files, with the size of the link (like
+    `find -printf %s`).
+    """
+    def __init__(self, root, on_error=None, max_prefetched=PREFETCH_DIRS):
+        self.root = root
+        self.on_error = on_error or _print_error
+        self.max_prefetched = max_prefetched
+        self.hash_algorithm = None  # Like a `ManifestLister` without checksums.
+        self.n_dirs = 0
+        self.n_entries = 0
+        self._pool = None
+        self._results = {}  # Relative dir path -> AsyncResult of its listing.
+        self._queues = []  # Stack of deques of relative dir paths to list, one for each level of the merge.
+
+    def open(self):
+        self._pool = ThreadPool(1)
+        return self
+
+    def prefetch(self, relative_dirpaths):
+        """
+        Queue these dirs to be listed in the background, in this order. They are the next ones to be listed, before
+        the dirs queued earlier: the merge walks depth first.
+        """
+        self._queues.append(deque(relative_dirpaths))
+        self._top_up()
+
+    def list_dir(self, relative_dirpath):
+        result = self._results.pop(relative_dirpath, None)
+        if result is None:
+            self._unqueue(relative_dirpath)
+            result = self._pool.apply_async(_list_dir, (self.root, relative_dirpath, self.on_error))
+        entries = result.get()
+        self._top_up()
+        if entries is not None:
+            self.n_dirs += 1
+            self.n_entries += len(entries)
+        return entries
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _top_up(self):
+        while len(self._results) < self.max_prefetched:
+            while self._queues and not self._queues[-1]:
+                self._queues.pop()
+            if not self._queues:
+                return
+            relative_dirpath = self._queues[-1].popleft()
+            self._results[relative_dirpath] = self._pool.apply_async(
+                _list_dir, (self.root, relative_dirpath, self.on_error))
+
+    def _unqueue(self, relative_dirpath):
+        for queue in reversed(self._queues):
+            if relative_dirpath in queue:
+                queue.remove(relative_dirpath)
+                return
+
+
+def iter_tree_diff(tree1, tree2, with_same_size=False):
+    """
+    Yield (status, relative path, entry in tree 1, entry in tree 2) for each difference between the 2 trees (see
+    `DirLister` and `ManifestLister`), in the order of a depth-first walk with the entries of each dir sorted by name.
+    An entry is a tuple (name, is_dir, size, mtime_ns, hash), or None on the side where it is missing.
+    The status is one of: DIFF_MISSING_IN_1, DIFF_MISSING_IN_2 (a file, or a whole dir with all of its content),
+    DIFF_SIZE (2 files with a different size) or DIFF_TYPE (a file on a side and a dir on the other).
+    With `with_same_size`, the files with the same size on both sides are yielded too, with SAME_SIZE as status: eg.
+    to compare their content.
+    """
+    tree1.prefetch([''])
+    tree2.prefetch([''])
+    stack = [_iter_merged_dir(tree1, tree2, '', with_same_size)]
+    while stack:
+        try:
+            status, relative_path, entry1, entry2 = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+        if status is None:  # A dir on both sides.
+            stack.append(_iter_merged_dir(tree1, tree2, relative_path, with_same_size))
+        else:
+            yield status, relative_path, entry1, entry2
+
+
+def _iter_merged_dir(tree1, tree2, relative_dirpath, with_same_size):
+    """
+    Yield (status, relative path, entry 1, entry 2) for each difference in the dir, and for each dir on both sides
+    with None as status (to walk into).
+    """
+    entries1 = tree1.list_dir(relative_dirpath)
+    entries2 = tree2.list_dir(relative_dirpath)
+    if entries1 is None or entries2 is None:  # Already reported by `on_error`.
+        return
+    common_dirs = _get_common_dirs(entries1, entries2, relative_dirpath)
+    tree1.prefetch(common_dirs)
+    tree2.prefetch(common_dirs)
+    i = j = 0
+    while i < len(entries1) or j < len(entries2):
+        entry1 = entries1[i] if i < len(entries1) else None
+        entry2 = entries2[j] if j < len(entries2) else None
+        if entry2 is None or (entry1 is not None and entry1[0] < entry2[0]):
+            yield DIFF_MISSING_IN_2, _join(relative_dirpath, entry1[0]), entry1, None
+            i += 1
+            continue
+        if entry1 is None or entry2[0] < entry1[0]:
+            yield DIFF_MISSING_IN_1, _join(relative_dirpath, entry2[0]), None, entry2
+            j += 1
+            continue
+        i += 1
+        j += 1
+        relative_path = _join(relative_dirpath, entry1[0])
+        if entry1[1] != entry2[1]:
+            yield DIFF_TYPE, relative_path, entry1, entry2
+        elif entry1[1]:
+            yield None, relative_path, entry1, entry2
+        elif entry1[2] != entry2[2]:
+            yield DIFF_SIZE, relative_path, entry1, entry2
+        elif with_same_size:
+            yield SAME_SIZE, relative_path, entry1, entry2
+
+
+def iter_subtree_files(tree, relative_dirpath):
+    """
+    Yield (relative path, entry) for each file in the subtree of `tree` at `relative_dirpath`, depth first, with the
+    subdirs of each dir sorted by name. Eg. to list a dir on one side only, that `iter_tree_diff` does not walk into:
+    right when it is yielded, the order of a manifest is kept.
+    """
+    stack = [relative_dirpath]
+    while stack:
+        dirpath = stack.pop()
+        entries = tree.list_dir(dirpath)
+        if entries is None:  # Already reported by `on_error`.
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry[1]:
+                subdirs.append(_join(dirpath, entry[0]))
+            else:
+                yield _join(dirpath, entry[0]), entry
+        tree.prefetch(subdirs)
+        stack.extend(reversed(subdirs))
+
+
+def _get_common_dirs(entries1, entries2, relative_dirpath):
+    dirs2 = set(entry[0] for entry in entries2 if entry[1])
+    return [_join(relative_dirpath, entry[0]) for entry in entries1 if entry[1] and entry[0] in dirs2]
+
+
+def _list_dir(root, relative_dirpath, on_error):
+    dirpath = os.path.join(root, relative_dirpath) if relative_dirpath else root
+    try:
+        dir_entries = list(scandir(dirpath))
+    except OSError as ex:
+        on_error(ex)
+        return None
+    entries = []
+    for entry in dir_entries:
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except OSError as ex:  # Eg. the file was deleted in the meanwhile.
+            on_error(ex)
+            continue
+        is_dir = stat.S_ISDIR(st.st_mode)
+        entries.append((entry.name, is_dir, 0 if is_dir else st.st_size, get_mtime_ns(st), None))
+    entries.sort()
+    return entries
+
+
+def _join(relative_dirpath, name):
+    return os.path.join(relative_dirpath, name) if relative_dirpath else name
+
+
+def _print_error(ex):
+    print_wrn('WARNING: {}'.format(ex))
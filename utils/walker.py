@@ -0,0 +1,142 @@
+"""
+Walk a dir tree with `os.scandir`, yielding the files as they are found: no list of all files is ever built, so the
+memory stays flat with millions of files, and the caller can start working while the walk is still running.
+"""
+import fnmatch
+import os
+import re
+import stat
+
+from msg import print_wrn
+
+
+# Synology index dirs and macOS Finder files, typically excluded on a NAS.
+NAS_EXCLUDE_PATHNAMES = ('*@eaDir*',)
+NAS_EXCLUDE_NAMES = ('.DS_Store',)
+
+
+class PathnameFilter(object):
+    """
+    Precompiled `find` exclusion rules: `! -path pattern` (matched on the full path, where `*` matches `/` too) and
+    `! -name pattern` (matched on the base name).
+    """
+    def __init__(self, exclude_pathnames=(), exclude_names=()):
+        self._pathname_regexes = [re.compile(fnmatch.translate(p)) for p in exclude_pathnames]
+        self._name_regexes = [re.compile(fnmatch.translate(p)) for p in exclude_names]
+        # A pattern ending with `*` matching "dir/" matches all paths in that dir: the subtree can be pruned.
+        self._prune_regexes = [re.compile(fnmatch.translate(p)) for p in exclude_pathnames if p.endswith('*')]
+
+    def is_excluded(self, path, name):
+        for regex in self._name_regexes:
+            if regex.match(name):
+                return True
+        for regex in self._pathname_regexes:
+            if regex.match(path):
+                return True
+        return False
+
+    def is_subtree_excluded(self, dirpath):
+        for regex in self._prune_regexes:
+            if regex.match(dirpath + os.sep):
+                return True
+        return False
+
+
+def iter_files(root, exclude_pathnames=(), exclude_names=(), on_error=None, start_after=None):
+    """
+    Yield (relative path, stat result) for each regular file in the tree at `root`, like:
+    $ find root -type f ! -path "pattern" ! -name "pattern"
+    Symlinks are not followed. Excluded subtrees are pruned, without descending into them.
+    The entries of each dir are sorted by name and subdirs are walked when met, so the order is the same at every
+    run: paths are sorted by their components.
+    Errors (eg. a dir that cannot be read) are passed to `on_error`, by default they are printed as warnings.
+    With `start_after` (a relative path) the walk resumes after that path: the files and dirs before it in the order
+    of the walk are skipped, without listing them.
+    """
+    pathname_filter = PathnameFilter(exclude_pathnames, exclude_names)
+    on_error = on_error or _print_error
+    start_after_names = _split_path(start_after) if start_after else None
+    stack = [_iter_dir(root, '', on_error, start_after_names)]
+    while stack:
+        try:
+            entry, relative_path, start_after_names = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                if not pathname_filter.is_subtree_excluded(entry.path):
+                    stack.append(_iter_dir(entry.path, relative_path, on_error, start_after_names))
+            elif entry.is_file(follow_symlinks=False):
+                if not pathname_filter.is_excluded(entry.path, entry.name):
+                    yield relative_path, entry.stat(follow_symlinks=False)
+        except OSError as ex:  # Eg. the file was deleted in the meanwhile.
+            on_error(ex)
+
+
+def _iter_dir(dirpath, relative_dirpath, on_error, start_after_names=None):
+    """
+    Yield (entry, relative path, names) for the entries in the dir. With `start_after_names`, the names of the
+    components of the path to resume after (relative to this dir), the entries before it are skipped, and `names` is
+    the rest of them for the dir on that path, None otherwise.
+    """
+    try:
+        entries = sorted(scandir(dirpath), key=lambda e: e.name)
+    except OSError as ex:
+        on_error(ex)
+        entries = []
+    for entry in entries:
+        names = None
+        if start_after_names:
+            if entry.name < start_after_names[0]:
+                continue
+            if entry.name == start_after_names[0]:
+                if len(start_after_names) == 1:  # The path itself.
+                    continue
+                names = start_after_names[1:]
+        yield entry, os.path.join(relative_dirpath, entry.name) if relative_dirpath else entry.name, names
+
+
+def _split_path(path):
+    names = []
+    while path:
+        path, name = os.path.split(path)
+        names.insert(0, name)
+    return names
+
+
+def _print_error(ex):
+    print_wrn('WARNING: {}'.format(ex))
+
+
+try:
+    scandir = os.scandir  # Python 3.5+.
+except AttributeError:
+    def scandir(dirpath):
+        """
+        Return the entries of a dir, like `os.scandir` (see `_DirEntry`).
+        """
+        return [_DirEntry(dirpath, name) for name in os.listdir(dirpath)]
+
+
+class _DirEntry(object):
+    """
+    A minimal `os.DirEntry` for Python 2.
+    """
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks:
+            return os.stat(self.path)
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return self._lstat
+
+    def is_dir(self, follow_symlinks=True):
+        return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+
+    def is_file(self, follow_symlinks=True):
+        return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
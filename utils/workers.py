@@ -0,0 +1,103 @@
+"""
+Pool of workers (threads or processes) with a cap on the number of tasks running at the same time on each device,
+so spinning disks are not thrashed by concurrent reads while fast volumes (SSD, RAID) are read fully in parallel.
+"""
+import os
+import threading
+from collections import defaultdict, deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+
+def is_rotational_device(st_dev):
+    """
+    Return True if the device is a spinning disk. Linux only: False when unknown.
+    """
+    try:
+        dirpath = '/sys/dev/block/{}:{}'.format(os.major(st_dev), os.minor(st_dev))
+    except (AttributeError, ValueError):
+        return False
+    # For partitions the queue dir is in the parent dir of the disk.
+    for path in (os.path.join(dirpath, 'queue', 'rotational'), os.path.join(dirpath, '..', 'queue', 'rotational')):
+        try:
+            with open(path) as fin:
+                return fin.read().strip() == '1'
+        except (IOError, OSError):
+            pass
+    return False
+
+
+def run_per_device(tasks, jobs=1, use_processes=False, max_jobs_per_device=None):
+    """
+    Run `tasks`, a list of (st_dev, func, args), and return the results in the same order as the tasks.
+
+    Tasks run in a pool of `jobs` threads, or processes with `use_processes` (then `func` must be a module-level
+    function). At most `max_jobs_per_device` tasks run at the same time on the same device; by default: 1 for
+    spinning disks, `jobs` otherwise.
+    An exception raised in a task is re-raised here.
+    """
+    if jobs <= 1 or len(tasks) <= 1:
+        return [func(*args) for _, func, args in tasks]
+
+    limits = {}
+    queues = defaultdict(deque)  # Device -> indexes of the tasks to run on that device.
+    for i, (st_dev, _, _) in enumerate(tasks):
+        if st_dev not in limits:
+            if max_jobs_per_device:
+                limits[st_dev] = max_jobs_per_device
+            else:
+                limits[st_dev] = 1 if is_rotational_device(st_dev) else jobs
+        queues[st_dev].append(i)
+
+    results = [None] * len(tasks)
+    running = defaultdict(int)
+    state = {'n_done': 0, 'n_running': 0, 'error': None}
+    condition = threading.Condition()
+
+    def on_done(i, st_dev):
+        def callback(outcome):
+            is_ok, value = outcome
+            with condition:
+                if is_ok:
+                    results[i] = value
+                elif state['error'] is None:
+                    state['error'] = value
+                running[st_dev] -= 1
+                state['n_running'] -= 1
+                state['n_done'] += 1
+                condition.notify()
+        return callback
+
+    pool = Pool(jobs) if use_processes else ThreadPool(jobs)
+    try:
+        with condition:
+            while state['n_done'] < len(tasks) and state['error'] is None:
+                # Submit as many tasks as the limits allow, round-robin on the devices.
+                for st_dev in sorted(queues):
+                    queue = queues[st_dev]
+                    while queue and running[st_dev] < limits[st_dev] and state['n_running'] < jobs:
+                        i = queue.popleft()
+                        _, func, args = tasks[i]
+                        running[st_dev] += 1
+                        state['n_running'] += 1
+                        pool.apply_async(_call, (func, args), callback=on_done(i, st_dev))
+                condition.wait()
+    except BaseException:
+        pool.terminate()
+        pool.join()
+        raise
+    if state['error'] is not None:
+        pool.terminate()
+        pool.join()
+        raise state['error']
+    pool.close()
+    pool.join()
+    return results
+
+
+def _call(func, args):
+    # Exceptions are returned, rather than raised, as Python 2 pools have no error callback.
+    try:
+        return True, func(*args)
+    except Exception as ex:
+        return False, ex